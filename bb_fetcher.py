@@ -5,16 +5,44 @@ The Bitbucket org-mgmt application periodically queries Bitbucket for org
 data and updates its own cache.  That application provides a REST API which
 we query here and make available to this application as dictionaries.
 
+The metadata is kept as a snapshot which is replaced as a whole when it is
+refreshed.  With a refresh interval set (BB_REFRESH_INTERVAL) a background
+thread polls the fetcher's cache timestamp and swaps in new metadata when it
+changes, so lookups in the request path never wait on the fetcher.
+
+Constructing a BBFetcher makes no request: the context check, the first
+metadata load and the refresher are started by 'warm_up'.
+
 Note(s):
     1. Requires Python 3
 """
-from collections import defaultdict
+import threading
+import time
+from datetime import datetime
 from urllib3.exceptions import HTTPError
+from urllib3.util.retry import Retry
 import requests
+from requests.adapters import HTTPAdapter
 
-from logger import LOGGER
+from logger import SampledLogger, module_logger
+from metrics import METRICS
 from parameters import PARAMS
 
+LOGGER = module_logger(__name__)
+# (for the per lookup messages)
+SAMPLED_LOGGER = SampledLogger(LOGGER)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+REQUEST_SECONDS = METRICS.histogram('cfstats_bb_request_seconds',
+                                    'BB fetcher request latency')
+REQUEST_ERRORS = METRICS.counter('cfstats_bb_request_errors_total',
+                                 'BB fetcher request errors')
+CACHE_LOOKUPS = METRICS.counter('cfstats_bb_cache_lookups_total',
+                                'BB metadata cache lookups', ['result'])
+CACHE_REFRESHES = METRICS.counter('cfstats_bb_cache_refreshes_total',
+                                  'BB metadata cache refreshes', ['result'])
+
 
 class InvalidFoundation(Exception):
     """
@@ -44,9 +72,27 @@ class BBFetcher(list):
         Initialize the Bitbucket org management interface object.
         """
         self._org_url = PARAMS['BB_ORG_FETCHER_URL']
-        self._cached_metadata = defaultdict(dict)
+        # org -> metadata snapshot; replaced (never modified) on refresh
+        self._cached_metadata = {}
         self._remote_cache_timestamp = None
         self._bb_request_time_limit = int(PARAMS["BB_REQUEST_TIME_LIMIT"])
+        self._session = self._make_session(int(PARAMS['BB_HTTP_RETRIES']))
+        # url -> (etag, last-modified, decoded body) for conditional GETs
+        self._validators = {}
+        self._http_lock = threading.Lock()
+        self._http_stats = {'requests': 0,
+                            'not_modified': 0,
+                            'errors': 0,
+                            'bytes': 0,
+                            'latency_secs_total': 0.0,
+                            'latency_secs_max': 0.0,
+                           }
+        self._refresh_interval = float(PARAMS['BB_REFRESH_INTERVAL'])
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+        self._last_refresh = None
+        self._refresh_failures = 0
 
         try:
             context_key = PARAMS['FOUNDATION'].split('-')[1][:3]
@@ -58,40 +104,209 @@ class BBFetcher(list):
             else:
                 self._context = None
 
-        if self._context:
-            available_contexts = self._context_list()
-            if not available_contexts \
-               or self._context not in available_contexts:
-                LOGGER.error("Context %s (foundation %s) not in context list %s",
-                             self._context,
-                             PARAMS['FOUNDATION'],
-                             ','.join(available_contexts) if available_contexts
-                                                          else "(no contexts)")
-                raise ContextNotAvailable
-
         LOGGER.info("Initialize fetcher (context(s): %s)", self._context)
         super().__init__()
 
+    def warm_up(self):
+        """
+        Check that the context is available from the fetcher, load the
+        metadata and start the background refresher (if a refresh interval
+        is set).
+
+        :raise ContextNotAvailable: if the fetcher does not serve the context
+        """
+        if not self._context:
+            return
+        available_contexts = self._context_list()
+        if not available_contexts \
+           or self._context not in available_contexts:
+            LOGGER.error("Context %s (foundation %s) not in context list %s",
+                         self._context,
+                         PARAMS['FOUNDATION'],
+                         ','.join(available_contexts) if available_contexts
+                                                      else "(no contexts)")
+            raise ContextNotAvailable
+        self._refresh_cached_metadata()
+        if self._refresh_interval > 0:
+            self.start_refresher()
+
+    @property
+    def ready(self):
+        """
+        True once the metadata has been loaded (or if there is no context
+        to load it for).
+        """
+        return not self._context or self._remote_cache_timestamp is not None
+
+    def start_refresher(self):
+        """
+        Start the background metadata refresh thread.  The first refresh
+        happens immediately (in the background) unless the metadata is
+        already loaded.
+        """
+        if self._refresher and self._refresher.is_alive():
+            return
+        LOGGER.info("Starting BB metadata refresher (every %ss)",
+                    self._refresh_interval)
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(target=self._run_refresher,
+                                           name='bb_refresher', daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        """
+        Stop the background metadata refresh thread.
+        """
+        self._stop_refresher.set()
+
+    def _run_refresher(self):
+        """
+        Background thread: refresh the metadata (if the fetcher's cache has
+        changed) every refresh interval.
+        """
+        if self._remote_cache_timestamp is not None:
+            self._stop_refresher.wait(self._refresh_interval)
+        while not self._stop_refresher.is_set():
+            try:
+                self._refresh_cached_metadata()
+            except Exception as exn:        # pylint: disable=broad-except
+                self._refresh_failures += 1
+                LOGGER.error("BB metadata refresh failed: %s", exn)
+            self._stop_refresher.wait(self._refresh_interval)
+
+    @property
+    def background_refresh(self):
+        """
+        True if the metadata is kept up to date by the background thread.
+        """
+        return bool(self._refresher and self._refresher.is_alive())
+
+    @property
+    def stats(self):
+        """
+        Metadata cache state.
+        """
+        return {'context': self._context,
+                'ready': self.ready,
+                'background_refresh': self.background_refresh,
+                'refresh_interval': self._refresh_interval,
+                'remote_cache_timestamp': self._remote_cache_timestamp,
+                'last_refresh': self._last_refresh,
+                'refresh_failures': self._refresh_failures,
+                'orgs': len(self._cached_metadata),
+                'http': self.http_stats,
+               }
+
+    @property
+    def metadata_version(self):
+        """
+        Version of the cached metadata: the fetcher cache timestamp it was
+        last refreshed from.
+        """
+        return self._remote_cache_timestamp
+
+    @property
+    def http_stats(self):
+        """
+        Fetcher HTTP request statistics: request, not modified (304) and
+        error counts, bytes received and latency.
+        """
+        with self._http_lock:
+            stats = dict(self._http_stats)
+        total = stats.pop('latency_secs_total')
+        stats['avg_latency_ms'] = round(1000 * total / stats['requests'], 3) \
+                                  if stats['requests'] else 0
+        stats['max_latency_ms'] = round(1000 * stats.pop('latency_secs_max'), 3)
+        return stats
+
+    @staticmethod
+    def _make_session(retries):
+        """
+        Create the HTTP session used for all fetcher requests: connections
+        are kept alive and reused, failed connections and gateway errors
+        are retried (with backoff), and compressed responses are requested.
+
+        :param retries: number of retries per request
+        :return: requests.Session
+        """
+        session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                              max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        return session
+
+    def _record_request(self, start, rsp=None):
+        """
+        Record a fetcher request in the HTTP statistics.
+
+        :param start: request start time (time.monotonic())
+        :param rsp: the response, or None if the request failed
+        """
+        elapsed = time.monotonic() - start
+        REQUEST_SECONDS.observe(elapsed)
+        if rsp is None or rsp.status_code >= 400:
+            REQUEST_ERRORS.inc()
+        with self._http_lock:
+            stats = self._http_stats
+            stats['requests'] += 1
+            stats['latency_secs_total'] += elapsed
+            stats['latency_secs_max'] = max(stats['latency_secs_max'], elapsed)
+            if rsp is None or rsp.status_code >= 400:
+                stats['errors'] += 1
+            else:
+                stats['not_modified'] += int(rsp.status_code
+                                             == requests.codes.not_modified)
+                # bytes on the wire (compressed) where the server says so
+                stats['bytes'] += int(rsp.headers.get('Content-Length')
+                                      or len(rsp.content))
+
     def _request(self, url, json=True):
         """
         Send get request to the given url and handle errors.
         Return json if indicated else raw data.
 
+        The request is conditional (If-None-Match / If-Modified-Since) if an
+        earlier response for the url carried an ETag or Last-Modified header;
+        on '304 Not Modified' the earlier response body is returned.
+
         :param url: the target url to send the get request to
         :param json: true if json result required or raw data if false
         :return: request response (json or raw)
         """
         LOGGER.debug("Fetcher GET request: %s", url)
         retn = None
+        headers = {}
+        etag, modified, cached_body = self._validators.get(url, (None, None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        start = time.monotonic()
         try:
-            rsp = requests.get(url, timeout=self._bb_request_time_limit)
+            rsp = self._session.get(url, headers=headers,
+                                    timeout=self._bb_request_time_limit)
         except HTTPError as err:
+            self._record_request(start)
             LOGGER.error("HTTP request error (url %s): %s", url, err)
         except Exception as exn:
+            self._record_request(start)
             LOGGER.error("Unknown error requesting from %s: %s", url, exn)
         else:
-            if rsp.status_code == requests.codes.ok:
-                retn = rsp.json() if json else rsp.data
+            self._record_request(start, rsp)
+            if rsp.status_code == requests.codes.not_modified \
+               and cached_body is not None:
+                LOGGER.debug("Fetcher response not modified: %s", url)
+                retn = cached_body
+            elif rsp.status_code == requests.codes.ok:
+                retn = rsp.json() if json else rsp.content
+                etag = rsp.headers.get('ETag')
+                modified = rsp.headers.get('Last-Modified')
+                if etag or modified:
+                    self._validators[url] = (etag, modified, retn)
             else:
                 LOGGER.info("Error requesting from BB fetcher: %s", url)
                 LOGGER.debug("Query error %d (%s): %s",
@@ -126,17 +341,33 @@ class BBFetcher(list):
     def _refresh_cached_metadata(self, org=None):
         """
         (Re)fill the local cache of metadata from the BB fetcher (if
-        the local cache is stale).
+        the local cache is stale).  The new metadata is merged into a copy
+        of the current snapshot which then replaces it, so readers never
+        see a partly updated cache.  Only one refresh runs at a time; a
+        caller finding a refresh in progress returns without waiting.
         """
         if not self._context:
             LOGGER.info("No valid Bitbucket fetcher context")
             return {}
 
+        if not self._refresh_lock.acquire(blocking=False):
+            LOGGER.debug("BB metadata refresh already in progress")
+            return
+        try:
+            self._refresh_from_fetcher(org)
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh_from_fetcher(self, org=None):
+        """
+        Fetch the metadata from the BB fetcher if its cache timestamp has
+        changed, and swap in the updated snapshot.
+        """
         remote_timestamp = self._get_fetcher_cache_timestamp()
         if not remote_timestamp or remote_timestamp == self._remote_cache_timestamp:
             LOGGER.info("Remote cache not ready (or timestamps match), skip refresh")
+            CACHE_REFRESHES.inc(('unchanged',))
             return
-        self._remote_cache_timestamp = remote_timestamp
 
         url = "{}/contexts/{}/orgs_metadata".format(self._org_url, self._context)
         if org:
@@ -145,11 +376,21 @@ class BBFetcher(list):
         LOGGER.debug("Requesting BB fetcher bulk download")
         metadata = self._request(url)
         if metadata:
-            self._cached_metadata.update({org: metadata[org]
-                                          for org in metadata
-                                          if metadata[org]})
+            snapshot = dict(self._cached_metadata)
+            snapshot.update({org: metadata[org]
+                             for org in metadata
+                             if metadata[org]})
+            self._cached_metadata = snapshot
             LOGGER.debug("Cached %d org entries for context %s",
                          len(metadata), self._context)
+        if metadata is not None:
+            # only note the timestamp once the data is in hand, so that a
+            # failed download is retried on the next refresh
+            self._remote_cache_timestamp = remote_timestamp
+            self._last_refresh = datetime.now().strftime(DATE_FORMAT)
+            CACHE_REFRESHES.inc(('updated',))
+        else:
+            CACHE_REFRESHES.inc(('failed',))
 
         LOGGER.debug("Cached %d orgs for context %s",
                      len(self._cached_metadata), self._context)
@@ -160,15 +401,21 @@ class BBFetcher(list):
 
         If the cache is empty or the given org is not in cache then refresh
         the whole cache.  The cache refresh will only refresh if the cache
-        timestamp has changed since the last refresh.
+        timestamp has changed since the last refresh.  When the background
+        refresher is running the current snapshot is returned as is and
+        the request is never blocked on a refresh.
         """
         org = org.lower()
-        if (org not in self._cached_metadata) and refresh_on_miss:
+        cached = self._cached_metadata
+        CACHE_LOOKUPS.inc(('hit' if org in cached else 'miss',))
+        if (org not in cached) and refresh_on_miss \
+           and not self.background_refresh:
             LOGGER.debug("Org not in cache, refresh")
             self._refresh_cached_metadata()
+            cached = self._cached_metadata
         else:
-            LOGGER.debug("Org/director retrieved from cache")
-        return self._cached_metadata.get(org, {})
+            SAMPLED_LOGGER.debug("Org/director retrieved from cache")
+        return cached.get(org, {})
 
     def director_by_org_name(self, org, refresh_on_miss=True):
         """
@@ -183,9 +430,9 @@ class BBFetcher(list):
         :return: director name(s)
         """
         org = org.lower()
-        LOGGER.debug("Lookup director for org %s", org)
+        SAMPLED_LOGGER.debug("Lookup director for org %s", org)
         meta = self.get_metadata_by_org_name(org,
                                              refresh_on_miss=refresh_on_miss)
         director = meta.get('director', 'Unknown')
-        LOGGER.debug("Org/director %s/%s", org, director)
+        SAMPLED_LOGGER.debug("Org/director %s/%s", org, director)
         return director
@@ -0,0 +1,138 @@
+"""
+T-Mobile PCF team cf-stats benchmark synthetic data.
+
+Generates a synthetic foundation: rows for every table in tables.py, plus
+the Bitbucket org-mgmt metadata for its orgs.  The data is deterministic
+for a given size and seed, so benchmark runs are reproducible.
+
+Note(s):
+    1. Requires Python 3
+"""
+import json
+import random
+import uuid
+
+from tables import (ALL_TABLES, CFApps, CFServiceBindings, CFServices,
+                    CFSpaces, CFOrganizations, CFRouteMapping, CFRoutes,
+                    CFDomains)
+
+BUILDPACKS = ('java_buildpack', 'nodejs_buildpack', 'python_buildpack',
+              'go_buildpack', 'staticfile_buildpack', None)
+SERVICE_TYPES = (('p-mysql', '100mb'), ('p-redis', 'shared-vm'),
+                 ('p-rabbitmq', 'standard'), ('p-config-server', 'standard'),
+                 ('user-provided', None))
+
+
+class FoundationSpec(object):
+    """
+    Size and shape of a synthetic foundation.
+    """
+    def __init__(self, apps, apps_per_space=20, spaces_per_org=5,
+                 services_per_space=8, bindings_per_app=2, routes_per_app=1,
+                 domains=4, seed=0):
+        """
+        :param apps: number of apps
+        :param apps_per_space: average apps per space
+        :param spaces_per_org: spaces per org
+        :param services_per_space: service instances per space
+        :param bindings_per_app: maximum service bindings per app
+        :param routes_per_app: maximum routes per app
+        :param domains: number of shared domains
+        :param seed: random seed
+        """
+        self.apps = apps
+        self.spaces = max(1, apps // apps_per_space)
+        self.orgs = max(1, self.spaces // spaces_per_org)
+        self.services_per_space = services_per_space
+        self.bindings_per_app = bindings_per_app
+        self.routes_per_app = routes_per_app
+        self.domains = domains
+        self.seed = seed
+        super().__init__()
+
+    def as_dict(self):
+        """
+        The spec as a dict (for the benchmark results).
+        """
+        return dict(self.__dict__)
+
+
+def _guid(rnd):
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def generate(spec):
+    """
+    Generate the table rows for a foundation.
+
+    :param spec: FoundationSpec
+    :return: 2-tuple: (dict of table name to list of row tuples in
+             table.columns order, dict of org name to org metadata)
+    """
+    rnd = random.Random(spec.seed)
+    rows = {table.name: [] for table in ALL_TABLES}
+
+    def add(table, **values):
+        rows[table.name].append(tuple(values.get(col) for col in table.columns))
+        return values
+
+    domains = [add(CFDomains, guid=_guid(rnd), name='apps{}.example.com'.format(i),
+                   type='shared')
+               for i in range(spec.domains)]
+    orgs = [add(CFOrganizations, guid=_guid(rnd), name='org-{:05d}'.format(i),
+                quotaDefinitionGUID=_guid(rnd))
+            for i in range(spec.orgs)]
+    spaces = [add(CFSpaces, guid=_guid(rnd), name='space-{:06d}'.format(i),
+                  organizationGUID=orgs[i % len(orgs)]['guid'], allowSSH='true')
+              for i in range(spec.spaces)]
+
+    services = {}
+    for space in spaces:
+        services[space['guid']] = []
+        for i in range(spec.services_per_space):
+            label, plan = rnd.choice(SERVICE_TYPES)
+            last_op = {'type': rnd.choice(('create', 'update')),
+                       'state': rnd.choice(('succeeded', 'succeeded', 'failed')),
+                       'description': '',
+                       'created_at': '2019-0{}-01T00:00:00Z'.format(rnd.randint(1, 9)),
+                       'updated_at': '2020-0{}-01T00:00:00Z'.format(rnd.randint(1, 9))}
+            services[space['guid']].append(add(
+                CFServices, guid=_guid(rnd),
+                name='{}-{}-{}'.format(label, space['name'], i),
+                lastOperation=json.dumps(last_op), serviceGUID=_guid(rnd),
+                serviceLabel=label, servicePlanGUID=_guid(rnd),
+                servicePlanName=plan, spaceGUID=space['guid'], tags='[]',
+                type='user_provided_service_instance' if plan is None
+                else 'managed_service_instance'))
+
+    for i in range(spec.apps):
+        space = spaces[i % len(spaces)]
+        app = add(CFApps, guid=_guid(rnd), name='app-{:07d}'.format(i),
+                  buildpack=rnd.choice(BUILDPACKS),
+                  diskQuota=rnd.choice((512, 1024, 2048)),
+                  healthCheckTimeout=60, healthCheckType='port',
+                  instances=rnd.randint(1, 4),
+                  memory=rnd.choice((256, 512, 1024, 2048, 4096)),
+                  packageState='STAGED',
+                  packageUpdatedAt='2020-{:02d}-{:02d}T00:00:00Z'.format(
+                      rnd.randint(1, 12), rnd.randint(1, 28)),
+                  spaceGUID=space['guid'], stackGUID=_guid(rnd),
+                  state=rnd.choice(('STARTED', 'STARTED', 'STOPPED')))
+        space_services = services[space['guid']]
+        for svc in rnd.sample(space_services,
+                              min(len(space_services),
+                                  rnd.randint(0, spec.bindings_per_app))):
+            add(CFServiceBindings, guid=_guid(rnd), appGUID=app['guid'],
+                serviceInstanceGUID=svc['guid'])
+        for _ in range(rnd.randint(0, spec.routes_per_app)):
+            route = add(CFRoutes, guid=_guid(rnd), host=app['name'], path='',
+                        port=None, domainGUID=rnd.choice(domains)['guid'],
+                        spaceGUID=space['guid'])
+            add(CFRouteMapping, guid=_guid(rnd), appGUID=app['guid'],
+                routeGUID=route['guid'])
+
+    metadata = {org['name']: {'director': 'Director {}'.format(i % 25),
+                              'cost_center': str(10000 + i % 300),
+                              'owner': 'owner{}@example.com'.format(i)}
+                for i, org in enumerate(orgs)}
+    return (rows, metadata)
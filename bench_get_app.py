@@ -0,0 +1,76 @@
+"""
+T-Mobile PCF team cf-stats get_app query strategy benchmark.
+
+Runs CFStatsAgent.get_app with each query strategy ('join': the single
+grouped 8-way join, 'decomposed': per-table queries merged with hash joins)
+against the configured fetcher database, checks that both return the same
+data and reports the timings.
+
+Usage:
+    python bench_get_app.py [--repeat N] [--appname NAME ...] [--showfield F ...]
+
+Note(s):
+    1. Requires Python 3
+    2. Uses the same environment (FOUNDATION, MYSQL_* or VCAP_SERVICES, ...)
+       as the foundrystats application.
+"""
+import argparse
+import statistics
+import time
+
+from werkzeug.datastructures import MultiDict
+
+from cfstats_agent import CFStatsAgent
+from logger import get_logger
+
+
+def time_strategy(agent, strategy, filters, repeat):
+    """
+    Run get_app 'repeat' times with the given strategy.
+
+    :return: 2-tuple: (list of durations in seconds, result of the last run)
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = agent.get_app(filters=filters, strategy=strategy)
+        durations.append(time.perf_counter() - start)
+    return (durations, result)
+
+
+def main():
+    """
+    Parse the arguments, run the benchmark and print the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per strategy (default 5)')
+    parser.add_argument('--appname', action='append', default=[],
+                        help='restrict to the named app(s)')
+    parser.add_argument('--showfield', action='append', default=[],
+                        help='restrict to the named field(s)')
+    args = parser.parse_args()
+
+    filters = MultiDict([('appname', name) for name in args.appname]
+                        + [('showfield', name) for name in args.showfield])
+    get_logger()
+    agent = CFStatsAgent()
+    agent.warm_up(background=False)
+
+    results = {}
+    for strategy in CFStatsAgent._app_strategies:  # pylint: disable=protected-access
+        durations, results[strategy] = time_strategy(agent, strategy, filters,
+                                                     args.repeat)
+        print("{:<12} rows {:>7}  min {:8.3f}s  median {:8.3f}s  max {:8.3f}s"
+              .format(strategy, len(results[strategy]), min(durations),
+                      statistics.median(durations), max(durations)))
+
+    def by_guid(rows):
+        return sorted(rows, key=lambda row: row.get('guid') or '')
+    same = by_guid(results['join']) == by_guid(results['decomposed'])
+    print("results {}".format("match" if same else "DIFFER"))
+
+
+if __name__ == "__main__":
+    main()
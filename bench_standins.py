@@ -0,0 +1,286 @@
+"""
+T-Mobile PCF team cf-stats benchmark local stand-ins.
+
+- SQLite stand-in for the fetcher MySQL database: 'sqlite_connector' returns
+  a connection factory which StatsDB can use in place of
+  mysql.connector.connect (StatsDB(connect=...)).  The MySQL specific SQL
+  the agent issues is translated to SQLite, and the index listing
+  (information_schema.STATISTICS) and EXPLAIN queries StatsDB makes are
+  answered from SQLite's own index list and query plans.
+- Stub Bitbucket org-mgmt fetcher: a local HTTP server answering the
+  requests BBFetcher makes, with ETag support.
+
+Note(s):
+    1. Requires Python 3
+    2. Timings against SQLite are not MySQL timings: use them to compare
+       versions of this service, not to size the database
+"""
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# MySQL -> SQLite translations
+_SQL_REWRITES = [
+    # SQLite has no SEPARATOR clause (and no separator with DISTINCT)
+    (re.compile(r'GROUP_CONCAT\(DISTINCT (.*?) SEPARATOR ", "\)'),
+     r'GROUP_CONCAT(DISTINCT \1)'),
+    (re.compile(r'%s'), '?'),
+]
+
+
+# SQLite query plan step: SCAN/SEARCH table [AS alias] [USING ... INDEX name]
+_PLAN_STEP = re.compile(r'^(SCAN|SEARCH)\s+(?:TABLE\s+)?(\w+)(?:\s+AS\s+(\w+))?(.*)$')
+_PLAN_INDEX = re.compile(r'INDEX\s+(\w+)')
+
+
+def _concat(*args):
+    """
+    MySQL CONCAT(): NULL if any argument is NULL.
+    """
+    if any(arg is None for arg in args):
+        return None
+    return ''.join(str(arg) for arg in args)
+
+
+class SQLiteCursor(object):
+    """
+    The subset of the mysql.connector cursor interface used by StatsDB.
+    """
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn.cursor()
+        self._rows = None           # emulated result rows
+        self.with_rows = False
+        self.description = None
+        super().__init__()
+
+    def _result(self, columns, rows):
+        """
+        Set an emulated result.
+        """
+        self._rows = list(rows)
+        self.description = [(col,) for col in columns]
+        self.with_rows = True
+
+    def _index_list(self, params):
+        """
+        information_schema.STATISTICS: (table, index, column) of the tables
+        named in the parameters (after the schema name).
+        """
+        rows = []
+        for table in sorted(set(params[1:])):
+            for index in self._conn.execute('PRAGMA index_list("{}")'.format(table)):
+                for column in self._conn.execute(
+                        'PRAGMA index_info("{}")'.format(index[1])):
+                    rows.append((table, index[1], column[2]))
+        self._result(('TABLE_NAME', 'INDEX_NAME', 'COLUMN_NAME'), rows)
+
+    def _explain(self, sql, params):
+        """
+        EXPLAIN: the SQLite query plan steps, as MySQL style plan rows.
+        """
+        rows = []
+        for step in self._conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            match = _PLAN_STEP.match(step[-1])
+            if not match:
+                continue
+            kind, table, alias, rest = match.groups()
+            index = _PLAN_INDEX.search(rest)
+            if kind == 'SEARCH':
+                access = 'ref'
+            else:
+                access = 'index' if index else 'ALL'
+            rows.append((alias or table, access, index.group(1) if index else None,
+                         None, step[-1]))
+        self._result(('table', 'type', 'key', 'rows', 'Extra'), rows)
+
+    def execute(self, sql, params=None):
+        for pattern, replacement in _SQL_REWRITES:
+            sql = pattern.sub(replacement, sql)
+        params = tuple(params or ())
+        self._rows = None
+        if 'information_schema.STATISTICS' in sql:
+            self._index_list(params)
+        elif sql.startswith('EXPLAIN '):
+            self._explain(sql[len('EXPLAIN '):], params)
+        else:
+            self._cursor.execute(sql, params)
+            self.description = self._cursor.description
+            self.with_rows = self.description is not None
+            if sql.startswith('CREATE INDEX '):
+                # like InnoDB, have statistics for the new index right away
+                self._conn.execute('ANALYZE {}'.format(sql.split()[2]))
+
+    def fetchall(self):
+        if self._rows is not None:
+            rows, self._rows = self._rows, []
+            return rows
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        if self._rows is not None:
+            rows, self._rows = self._rows[:size], self._rows[size:]
+            return rows
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection(object):
+    """
+    The subset of the mysql.connector connection interface used by StatsDB.
+    """
+    autocommit = True
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.create_function('CONCAT', -1, _concat)
+        super().__init__()
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    def cursor(self, buffered=True, prepared=False):   # pylint: disable=unused-argument
+        return SQLiteCursor(self._conn)
+
+    def start_transaction(self, consistent_snapshot=False,   # pylint: disable=unused-argument
+                          isolation_level=None, readonly=None):
+        # a SQLite read transaction sees one snapshot of the database
+        self._conn.execute('BEGIN')
+
+    def ping(self, reconnect=False, attempts=1, delay=0):  # pylint: disable=unused-argument
+        self._conn.execute('SELECT 1')
+
+    def is_connected(self):
+        return True
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+def sqlite_connector(path):
+    """
+    Get a StatsDB connection factory for a SQLite database file.
+
+    :param path: database file
+    :return: function(**mysql connect arguments) -> SQLiteConnection
+    """
+    return lambda **_: SQLiteConnection(path)
+
+
+def load_sqlite(path, tables, rows):
+    """
+    Create the tables and load the rows into a SQLite database file.
+
+    :param path: database file
+    :param tables: table objects (from tables.py)
+    :param rows: dict of table name to list of row tuples
+    """
+    conn = sqlite3.connect(path)
+    for table in tables:
+        conn.execute('DROP TABLE IF EXISTS {}'.format(table.name))
+        # (case insensitive, as the default MySQL collation)
+        conn.execute('CREATE TABLE {} ({})'.format(
+            table.name, ', '.join('"{}" COLLATE NOCASE'.format(col)
+                                  for col in table.columns)))
+        conn.executemany('INSERT INTO {} VALUES ({})'.format(
+            table.name, ', '.join('?' for _ in table.columns)), rows[table.name])
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BBFetcherStub(object):
+    """
+    Local stand-in for the Bitbucket org-mgmt fetcher REST API.
+    """
+    def __init__(self, context, metadata, cache_timestamp='1'):
+        """
+        :param context: context name served (e.g. 'PCF_NPE')
+        :param metadata: dict of org name to org metadata
+        :param cache_timestamp: fetcher cache timestamp reported
+        """
+        self.context = context
+        self.metadata = metadata
+        self.cache_timestamp = cache_timestamp
+        self.requests = 0
+        self._server = None
+        super().__init__()
+
+    def _body(self, path):
+        prefix = '/contexts/{}/orgs_metadata'.format(self.context)
+        if path == '/contexts/':
+            return [self.context]
+        if path == '/reader_status':
+            return {'cache_timestamp': self.cache_timestamp}
+        if path == prefix:
+            return self.metadata
+        if path.startswith(prefix + '/'):
+            org = path[len(prefix) + 1:]
+            return {org: self.metadata[org]} if org in self.metadata else None
+        return None
+
+    def start(self):
+        """
+        Start serving (on a free local port, in a background thread).
+
+        :return: the fetcher URL
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Fetcher request handler.
+            """
+            def log_message(self, *args):     # pylint: disable=arguments-differ
+                pass
+
+            def do_GET(self):                 # pylint: disable=invalid-name
+                stub.requests += 1
+                body = stub._body(self.path)  # pylint: disable=protected-access
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = json.dumps(body).encode()
+                etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, name='bb_stub',
+                         daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def stop(self):
+        """
+        Stop serving.
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
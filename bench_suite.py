@@ -0,0 +1,302 @@
+"""
+T-Mobile PCF team cf-stats benchmark suite.
+
+Times the CFStatsAgent methods and the REST endpoints against a synthetic
+foundation (see bench_data.py) of each requested size, served from local
+stand-ins (see bench_standins.py): a SQLite database in place of the fetcher
+MySQL database and a stub Bitbucket org-mgmt fetcher.  Reports the latency
+(p50/p99) and throughput of each case, and appends the results to a JSON
+lines file so that runs of different versions can be compared.
+
+Usage:
+    python bench_suite.py [--apps N ...] [--repeat N] [--case REGEX]
+                          [--output FILE] [--baseline FILE]
+
+Note(s):
+    1. Requires Python 3
+    2. The environment (FOUNDATION, BB_ORG_FETCHER_URL, MYSQL_*) is set up
+       by the suite; other parameters (e.g. APP_QUERY_STRATEGY,
+       REPLICA_ENABLED) may be set as usual
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from werkzeug.datastructures import MultiDict
+
+import bench_data
+from bench_standins import BBFetcherStub, load_sqlite, sqlite_connector
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+BB_CONTEXT = 'PCF_NPE'
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile.
+
+    :param values: list of numbers
+    :param pct: percentile (0-100)
+    :return: the percentile value
+    """
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def count_rows(result):
+    """
+    Number of rows in an agent result (list, page dict or message).
+    """
+    if isinstance(result, dict) and 'items' in result:
+        return len(result['items'])
+    if isinstance(result, list):
+        return len(result)
+    return 0
+
+
+def time_case(func, repeat, warmup, unit='rows'):
+    """
+    Run a case 'warmup' times untimed, then 'repeat' times timed.
+
+    :param func: function() returning the number of rows (or bytes) produced
+    :param unit: what func returns: 'rows' or 'bytes'
+    :return: dict of timing results
+    """
+    for _ in range(warmup):
+        func()
+    durations = []
+    size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = func()
+        durations.append(time.perf_counter() - start)
+    mean = sum(durations) / len(durations)
+    return {'runs': repeat,
+            unit: size,
+            'p50_ms': round(1000 * percentile(durations, 50), 3),
+            'p99_ms': round(1000 * percentile(durations, 99), 3),
+            'mean_ms': round(1000 * mean, 3),
+            'per_sec': round(1 / mean, 2) if mean else None,
+            '{}_per_sec'.format(unit): round(size / mean) if mean else None,
+           }
+
+
+def agent_cases(agent, sample):
+    """
+    The CFStatsAgent cases: (name, function returning a row count, 'rows').
+    """
+    def call(method, *args, **kwargs):
+        return lambda: count_rows(method(*args, **kwargs))
+
+    def filters(*pairs):
+        return MultiDict(list(pairs))
+
+    watermark = agent.get_app(filters(('since', '0')))['watermark']
+    cases = [
+        ('agent.get_app', call(agent.get_app, filters())),
+        ('agent.get_app[decomposed]', call(agent.get_app, filters(),
+                                           strategy='decomposed')),
+        ('agent.get_app[appname]', call(agent.get_app,
+                                        filters(('appname', sample['app'])))),
+        ('agent.get_app[showfield]', call(agent.get_app,
+                                          filters(('showfield', 'guid'),
+                                                  ('showfield', 'name'),
+                                                  ('showfield', 'memory')))),
+        ('agent.get_app[limit=100]', call(agent.get_app, filters(('limit', '100')))),
+        ('agent.get_app[since]', call(agent.get_app, filters(('since', watermark)))),
+        ('agent.get_app[stream]', lambda: sum(1 for _ in agent.get_app(filters(),
+                                                                       stream=True))),
+        ('agent.get_service', call(agent.get_service, filters=filters())),
+        ('agent.get_space', call(agent.get_space, filters())),
+        ('agent.get_org', call(agent.get_org, filters())),
+        ('agent.get_list[app]', call(agent.get_list, 'app', filters())),
+        ('agent.get_list[service]', call(agent.get_list, 'service', filters())),
+        ('agent.get_capacity[org]', call(agent.get_capacity, 'org')),
+        ('agent.get_capacity[space]', call(agent.get_capacity, 'space')),
+        ('agent.get_capacity[director]', call(agent.get_capacity, 'director')),
+    ]
+    return [(name, func, 'rows') for name, func in cases]
+
+
+def rest_cases(client, sample):
+    """
+    The REST endpoint cases: (name, function returning the response size,
+    'bytes').
+    """
+    def get(url, **headers):
+        def run():
+            rsp = client.get(url, headers=headers)
+            return len(rsp.get_data())
+        return run
+
+    cases = [
+        ('rest /get_app', get('/get_app')),
+        ('rest /get_app gzip', get('/get_app', **{'Accept-Encoding': 'gzip'})),
+        ('rest /get_app?stream=true', get('/get_app?stream=true')),
+        ('rest /get_app?format=csv', get('/get_app?format=csv')),
+        ('rest /get_app?appName', get('/get_app?appName={}'.format(sample['app']))),
+        ('rest /get_app?limit=100', get('/get_app?limit=100')),
+        ('rest /get_service', get('/get_service')),
+        ('rest /get_space', get('/get_space')),
+        ('rest /app_list', get('/app_list')),
+        ('rest /space_capacity', get('/space_capacity')),
+    ]
+    return [(name, func, 'bytes') for name, func in cases]
+
+
+def git_revision():
+    """
+    The current git revision (None if not available).
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_size(apps, args, stub):
+    """
+    Generate a foundation with 'apps' apps and time every case against it.
+
+    :return: result record (dict)
+    """
+    # imported here: the parameters are read from the environment on import
+    from bb_fetcher import BBFetcher
+    from cfstats_agent import CFStatsAgent
+    from foundrystats import CFStatsREST, FOUNDRYSTATS_REST_VERSION
+    from logger import get_logger
+    from statsdb import StatsDB
+
+    get_logger()
+
+    spec = bench_data.FoundationSpec(apps, seed=args.seed)
+    start = time.perf_counter()
+    rows, metadata = bench_data.generate(spec)
+    path = os.path.join(args.workdir, 'bench_{}.sqlite'.format(apps))
+    load_sqlite(path, bench_data.ALL_TABLES, rows)
+    print("{} apps: generated {} rows in {:.1f}s".format(
+        apps, sum(len(tbl) for tbl in rows.values()), time.perf_counter() - start))
+
+    stub.metadata = metadata
+    stub.cache_timestamp = str(apps)
+    stats_db = StatsDB(connect=sqlite_connector(path))
+    fetcher = BBFetcher()
+    agent = CFStatsAgent(stats_db=stats_db, bb_fetcher=fetcher)
+    # indexes, metadata and replica in place before anything is timed
+    if not agent.warm_up(background=False):
+        print("  warm up incomplete: {}".format(agent.readiness['components']))
+    client = CFStatsREST(service_name='bench', agent=agent).wsgi_app.test_client()
+
+    app_names = rows['applications']
+    name_col = bench_data.CFApps.columns.index('name')
+    sample = {'app': app_names[len(app_names) // 2][name_col]}
+
+    results = {}
+    cases = agent_cases(agent, sample) + rest_cases(client, sample)
+    for name, func, unit in cases:
+        if args.case and not re.search(args.case, name):
+            continue
+        results[name] = time_case(func, args.repeat, args.warmup, unit)
+        res = results[name]
+        print("  {:<32} p50 {:>10.3f}ms  p99 {:>10.3f}ms  {:>9}/s  {} {:>8}"
+              .format(name, res['p50_ms'], res['p99_ms'], res['per_sec'],
+                      unit, res[unit]))
+
+    agent.close()
+    return {'timestamp': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': git_revision(),
+            'version': FOUNDRYSTATS_REST_VERSION,
+            'python': platform.python_version(),
+            'params': {key: os.environ.get(key) for key in
+                       ('APP_QUERY_STRATEGY', 'REPLICA_ENABLED',
+                        'DB_PREPARED_STATEMENTS')},
+            'apps': apps,
+            'spec': spec.as_dict(),
+            'cases': results,
+           }
+
+
+def load_baseline(path):
+    """
+    Load the most recent result record per foundation size from a results file.
+
+    :return: dict of apps to result record
+    """
+    baseline = {}
+    with open(path) as results:
+        for line in results:
+            if line.strip():
+                record = json.loads(line)
+                baseline[record['apps']] = record
+    return baseline
+
+
+def compare(record, baseline):
+    """
+    Print the p50 change of each case relative to the baseline record.
+    """
+    print("  vs baseline {} ({}):".format(baseline.get('revision'),
+                                          baseline.get('timestamp')))
+    for name, res in record['cases'].items():
+        base = baseline['cases'].get(name)
+        if base and base['p50_ms']:
+            change = 100.0 * (res['p50_ms'] - base['p50_ms']) / base['p50_ms']
+            print("  {:<32} p50 {:>10.3f}ms -> {:>10.3f}ms  {:+7.1f}%"
+                  .format(name, base['p50_ms'], res['p50_ms'], change))
+
+
+def main():
+    """
+    Parse the arguments, run the benchmark and save the results.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--apps', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='foundation sizes, in apps (default 1000 10000 100000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed runs per case (default 5)')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='untimed runs per case (default 1)')
+    parser.add_argument('--case', help='only run cases matching this regex')
+    parser.add_argument('--seed', type=int, default=0, help='data random seed')
+    parser.add_argument('--workdir', default=tempfile.gettempdir(),
+                        help='directory for the SQLite databases')
+    parser.add_argument('--output', default='bench_results.jsonl',
+                        help='results file (appended to)')
+    parser.add_argument('--baseline', help='results file to compare against')
+    args = parser.parse_args()
+
+    stub = BBFetcherStub(BB_CONTEXT, {})
+    os.environ['BB_ORG_FETCHER_URL'] = stub.start()
+    os.environ['FOUNDATION'] = 'px-npe01'
+    for key in ('MYSQL_USER', 'MYSQL_PASSWORD', 'MYSQL_HOST', 'MYSQL_CF_DATABASE'):
+        os.environ.setdefault(key, 'bench')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # SQLite has no table checksums to derive ETags from
+    os.environ.setdefault('ETAG_ENABLED', 'false')
+    os.environ.pop('VCAP_SERVICES', None)
+
+    baseline = load_baseline(args.baseline) if args.baseline else {}
+    for apps in args.apps:
+        record = run_size(apps, args, stub)
+        with open(args.output, 'a') as results:
+            results.write(json.dumps(record, sort_keys=True) + '\n')
+        if apps in baseline:
+            compare(record, baseline[apps])
+    stub.stop()
+    print("Results appended to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,15 +10,41 @@ Note(s):
 
     3. TODO: the agent methods do not (yet) communicate with the fetcher,
        but rather depend on the fetcher to keep the DB updated.
+    4. Creating the agent does no I/O.  The database connections and
+       indexes, the Bitbucket metadata, the table replica and the change
+       logs are set up by 'warm_up' (in the background), and the agent
+       answers (from the
+       database, loading the metadata on demand) while that is under way.
 """
+import base64
+import binascii
+import contextlib
+import itertools
 import json
+import re
+import threading
+import time
+from collections import defaultdict
+from operator import itemgetter
+
+from werkzeug.datastructures import MultiDict
 
 from bb_fetcher import BBFetcher
-from logger import LOGGER
+from changes import ChangeLog, InvalidWatermark
+from logger import module_logger
+from metrics import add_timing
 from parameters import PARAMS
+from predicates import InvalidPredicate, parse_predicates
+from records import RowDecoder
+from replica import StatsReplica
 from statsdb import StatsDB
-from tables import (CFApps, CFServices, CFSpaces,
-                    CFOrganizations, CFRouteMapping)
+from tables import (CFApps, CFServices, CFSpaces, CFServiceBindings,
+                    CFOrganizations, CFRouteMapping, CFRoutes, CFDomains)
+
+LOGGER = module_logger(__name__)
+
+# characters allowed in a guid carried by a pagination cursor
+GUID_PATTERN = re.compile(r'^[\w.-]+$')
 
 
 class CFStatsAgent(object):
@@ -28,7 +54,95 @@ class CFStatsAgent(object):
        functions reside.  That module has no real knowledge of table structure.
        That knowledge resides here, and so the queries are formed here.
     """
-    def __init__(self):
+    # Use a list of tuples to assure ordering of labels and results
+    # The tuple pairs are "display name" and "source_table.column_name"
+    _app_fields = [('buildpack', 'ap.buildpack'),
+                   ('disk_quota', 'ap.diskQuota'),
+                   ('docker_image', 'ap.dockerImage'),
+                   ('guid', 'ap.guid'),
+                   ('health_check_timeout', 'ap.healthCheckTimeout'),
+                   ('health_check_type', 'ap.healthCheckType'),
+                   ('instances', 'ap.instances'),
+                   ('memory', 'ap.memory'),
+                   ('name', 'ap.name'),
+                   ('org_guid', 'og.guid'),
+                   ('org_name', 'og.name'),
+                   ('package_updated_at', 'ap.packageUpdatedAt'),
+                   ('space_guid', 'sp.guid'),
+                   ('space_name', 'sp.name'),
+                   ('stack_guid', 'ap.stackGUID'),
+                   ('state', 'ap.state'),
+                   ('service_names', 'GROUP_CONCAT(DISTINCT si.name SEPARATOR ", ")'),
+                   ('urls', 'GROUP_CONCAT(DISTINCT ' + \
+                            'CONCAT(rt.host, ".", dm.name) SEPARATOR ", ")'),
+                  ]
+    # Joins from the applications table: (alias, join, aliases it depends on)
+    _app_joins = [
+        ('sb', 'LEFT JOIN service_bindings AS sb ON sb.appGUID=ap.guid', ()),
+        ('si', 'LEFT JOIN service_instances AS si ON si.guid=sb.serviceInstanceGUID',
+         ('sb',)),
+        ('sp', 'LEFT JOIN spaces AS sp ON ap.spaceGUID=sp.guid', ()),
+        ('og', 'LEFT JOIN organizations AS og ON sp.organizationGUID=og.guid',
+         ('sp',)),
+        ('rm', 'LEFT JOIN route_mappings AS rm ON rm.appGUID=ap.guid', ()),
+        ('rt', 'LEFT JOIN routes AS rt ON rt.guid = rm.routeGUID', ('rm',)),
+        ('dm', 'LEFT JOIN domains AS dm ON dm.guid=rt.domainGUID', ('rt',)),
+    ]
+
+    _service_fields = [
+        ('bound_app_count', 'COUNT(DISTINCT sb.appGUID)'),
+        ('dashboard_url', 'si.dashboardURL'),
+        ('guid', 'si.guid'),
+        ('LAST_OPERATION', 'si.lastOperation'),
+        ('name', 'si.name'),
+        ('org_guid', 'org.guid'),
+        ('org_name', 'org.name'),
+        ('service', 'si.type'),
+        ('service_plan_guid', 'si.servicePlanGUID'),
+        ('service_guid', 'si.serviceGUID'),
+        ('service_plan', 'si.servicePlanName'),
+        ('space_guid', 'si.spaceGUID'),
+        ('space_name', 'sp.name'),
+    ]
+    # Decomposed get_app: queries for the aggregated (one to many) fields,
+    # each returning (app guid, value) pairs to be merged in by app guid
+    _app_aggregates = {
+        'service_names': ('SELECT sb.appGUID, si.name FROM service_bindings AS sb'
+                          ' JOIN service_instances AS si'
+                          ' ON si.guid=sb.serviceInstanceGUID', 'sb.appGUID'),
+        'urls': ('SELECT rm.appGUID, CONCAT(rt.host, ".", dm.name)'
+                 ' FROM route_mappings AS rm'
+                 ' JOIN routes AS rt ON rt.guid=rm.routeGUID'
+                 ' JOIN domains AS dm ON dm.guid=rt.domainGUID', 'rm.appGUID'),
+    }
+    _app_strategies = ('join', 'decomposed')
+
+    # Joins from the service_instances table
+    _service_joins = [
+        ('sp', 'LEFT JOIN spaces AS sp ON sp.guid=si.spaceGUID', ()),
+        ('org', 'LEFT JOIN organizations AS org ON org.guid=sp.organizationGUID',
+         ('sp',)),
+        ('sb', 'LEFT JOIN service_bindings AS sb ON sb.serviceInstanceGUID=si.guid',
+         ()),
+    ]
+    # Tables behind the source column aliases, for the 'where' filters
+    _alias_tables = {'ap': CFApps, 'sp': CFSpaces, 'og': CFOrganizations,
+                     'org': CFOrganizations, 'si': CFServices}
+    _lastop_map = {'type': 'last_operation',
+                   'state': 'last_operation_state',
+                   'created_at': 'created_at',
+                   'updated_at': 'updated_at'
+                  }
+
+    # Columns whose values change when a row is updated, scanned by the
+    # change logs answering 'since' (delta) queries
+    _change_markers = {CFApps.name: ('packageUpdatedAt', 'state', 'instances',
+                                     'memory', 'diskQuota', 'name', 'spaceGUID'),
+                       CFServices.name: ('lastOperation', 'name', 'servicePlanGUID',
+                                         'spaceGUID'),
+                      }
+
+    def __init__(self, stats_db=None, bb_fetcher=None):
         """
         Initialize the API object
 
@@ -36,15 +150,169 @@ class CFStatsAgent(object):
               fetcher in the event that data is not in the DB to request
               missing records and/or update the DB.
 
-        :params fetcher: the fetcher to contact for DB update
+        :param stats_db: StatsDB to query (created if not given)
+        :param bb_fetcher: BBFetcher for org metadata (created if not given)
         """
         self._foundation = PARAMS['FOUNDATION']
+        self._app_strategy = PARAMS['APP_QUERY_STRATEGY']
+        if self._app_strategy not in self._app_strategies:
+            LOGGER.warning("Unknown app query strategy %s, using 'join'",
+                           self._app_strategy)
+            self._app_strategy = 'join'
+        self._row_records = str(PARAMS['ROW_RECORDS']).lower() in ['true', 'yes']
         # Acquire the database connection(s)
-        self._cf_db = StatsDB()
-        self._bb_fetch = BBFetcher()
+        self._cf_db = StatsDB() if stats_db is None else stats_db
+        self._bb_fetch = BBFetcher() if bb_fetcher is None else bb_fetcher
+
+        # Optionally answer queries from an in-memory replica of the tables
+        # (loaded by warm_up)
+        self._replica = None
+        if str(PARAMS['REPLICA_ENABLED']).lower() in ['true', 'yes']:
+            self._replica = StatsReplica(
+                self._cf_db,
+                refresh_interval=float(PARAMS['REPLICA_REFRESH_INTERVAL']))
+
+        # Warm-up state of each component: (name, warm up function, the
+        # components it needs warmed up first)
+        self._components = [('db', self._cf_db.warm_up, ()),
+                            ('bb_fetcher', self._bb_fetch.warm_up, ())]
+        if self._replica:
+            self._components.append(('replica', self._warm_up_replica, ('db',)))
+        self._components.append(('change_logs', self._warm_up_change_logs,
+                                 ('replica',) if self._replica else ('db',)))
+        self._warm_state = {name: {'state': 'pending', 'attempts': 0, 'error': None}
+                            for name, _, _ in self._components}
+        self._warm_retry_interval = float(PARAMS['WARMUP_RETRY_INTERVAL'])
+        self._warm_started = None
+        self._warm_secs = None
+        self._warm_thread = None
+        self._stop_warm_up = threading.Event()
+
+        self._version_ttl = float(PARAMS['DATA_VERSION_TTL'])
+        self._version = (0, None)
+
+        # Change logs for 'since' queries, started by warm_up (or on first
+        # use); each table's log is started under its own lock
+        self._change_logs = {}
+        self._change_locks = {name: threading.Lock() for name in self._change_markers}
+
+        # Replica snapshot pinned (per thread) by consistent_view
+        self._local = threading.local()
 
         super().__init__()
 
+    def close(self):
+        """
+        Stop the background refresh threads and close the DB connections.
+        """
+        self._stop_warm_up.set()
+        if self._replica:
+            self._replica.stop()
+        for change_log in self._change_logs.values():
+            change_log.stop()
+        self._bb_fetch.stop_refresher()
+        self._cf_db.end()
+
+    def _warm_up_replica(self):
+        """
+        Load the table replica and start its refresh thread.
+        """
+        self._replica.refresh()
+        self._replica.start()
+
+    def _warm_up_change_logs(self):
+        """
+        Start the change logs (their first scan), so that no delta query
+        waits for it.
+        """
+        for table in (CFApps, CFServices):
+            self._change_log(table)
+
+    def _warm_up_components(self):
+        """
+        Warm up each component not yet warmed up (and whose prerequisites
+        are), noting failures.
+
+        :return: True if every component is warmed up
+        """
+        for name, warm_up, needs in self._components:
+            status = self._warm_state[name]
+            if status['state'] == 'ready' \
+               or any(self._warm_state[need]['state'] != 'ready' for need in needs):
+                continue
+            status['attempts'] += 1
+            try:
+                warm_up()
+            except Exception as exn:        # pylint: disable=broad-except
+                LOGGER.error("Warm up of %s failed (attempt %d): %s",
+                             name, status['attempts'], exn)
+                status.update(state='failed', error=str(exn) or type(exn).__name__)
+            else:
+                LOGGER.info("Warmed up %s", name)
+                status.update(state='ready', error=None)
+        return all(status['state'] == 'ready' for status in self._warm_state.values())
+
+    def _run_warm_up(self):
+        """
+        Background thread: warm up the components, retrying those which
+        failed every WARMUP_RETRY_INTERVAL seconds until all are ready.
+        """
+        while not self._warm_up_components():
+            if self._stop_warm_up.wait(self._warm_retry_interval):
+                return
+        self._warm_secs = round(time.monotonic() - self._warm_started, 3)
+        LOGGER.info("Warm up complete in %ss", self._warm_secs)
+
+    def warm_up(self, background=True):
+        """
+        Open the database connections (and create any missing indexes),
+        load the Bitbucket metadata and the table replica, and start their
+        refresh threads.  A component which cannot be warmed up (e.g. the
+        database is not reachable) is retried in the background; the agent
+        reports itself 'degraded' meanwhile (see readiness).
+
+        :param background: warm up in a background thread (else warm up
+                           each component once before returning)
+        :return: True if every component is ready (always False if
+                 'background' is set)
+        """
+        if self._warm_started is None:
+            self._warm_started = time.monotonic()
+        if not background:
+            return self._warm_up_components()
+        if self._warm_thread and self._warm_thread.is_alive():
+            return False
+        self._stop_warm_up.clear()
+        self._warm_thread = threading.Thread(target=self._run_warm_up,
+                                             name='warm_up', daemon=True)
+        self._warm_thread.start()
+        return False
+
+    @property
+    def readiness(self):
+        """
+        Get the agent readiness: 'warming' while components are being
+        warmed up, 'ready' once all are, 'degraded' if any failed to warm
+        up (queries may then fail or be slow), plus the state of each
+        component.  The Bitbucket fetcher is only ready once its metadata
+        has been loaded.
+        """
+        components = {name: dict(status) for name, status in self._warm_state.items()}
+        fetcher = components['bb_fetcher']
+        if fetcher['state'] == 'ready' and not self._bb_fetch.ready:
+            fetcher['state'] = 'warming'
+        states = {status['state'] for status in components.values()}
+        if 'failed' in states:
+            state = 'degraded'
+        elif states == {'ready'}:
+            state = 'ready'
+        else:
+            state = 'warming'
+        return {'state': state,
+                'warm_up_secs': self._warm_secs,
+                'components': components,
+               }
+
     @staticmethod
     def _missing_fields(requested, available):
         """
@@ -70,30 +338,403 @@ class CFStatsAgent(object):
     def _get_filter_list(filters, key, to_lower=False):
         """
         Given a MultiDict type filter object and a key get the list
-        corresponding to that key and turn all of the list entries
-        into quoted strings (suitable for SQL query).  If requested
-        make the values lower case.  If a key is present in the MultiDict
-        but the value is empty then the empty quoted string is NOT returned.
+        corresponding to that key.  If requested make the values lower
+        case.  If a key is present in the MultiDict but the value is
+        empty then the empty string is NOT returned.
 
         :param filters: the MultiDict
         :param key: the key whose list value is to be returned
         :param to_lower: flag indicating values are to be changed to lower case
-        :return: list of quoted string values
+        :return: list of string values
         """
-        lst = list(filter(None, filters.getlist(key)))
-        rtn = ['"{}"'.format(val) for val in lst]
+        rtn = list(filter(None, filters.getlist(key)))
         if to_lower:
             rtn = [itm.lower() for itm in rtn]
         return rtn
 
+    def _predicates(self, filters, fields):
+        """
+        Parse the 'where' filters (see predicates.py) of a query.  The
+        fields which are plain table columns may be filtered on.
+
+        :param filters: MultiDict of request filters
+        :param fields: list of (display name, source column) tuples
+        :return: 2-tuple: (list of Predicate objects, error or None)
+        """
+        columns = {name: column for name, column in fields
+                   if re.match(r'^\w+\.\w+$', column)}
+        numeric = set()
+        for column in columns.values():
+            alias, _, name = column.partition('.')
+            if name in getattr(self._alias_tables[alias], 'numeric_columns', ()):
+                numeric.add(column)
+        try:
+            return (parse_predicates(filters.getlist('where'), columns, numeric), None)
+        except InvalidPredicate as exn:
+            return ([], str(exn))
+
+    def _row_decoder(self, table, columns, discard=None, extra=(),
+                     foundation=True):
+        """
+        Compile the decoder of a query's rows (see records.py): dicts, or
+        records if the ROW_RECORDS parameter is set.
+
+        :param table: table object the query is on (names the record type)
+        :param columns: column name mapping
+        :param discard: fields to drop from each row (or None)
+        :param extra: fields set on each row after decoding
+        :param foundation: add the foundation to each row if true
+        :return: RowDecoder
+        """
+        return RowDecoder(columns, discard,
+                          {'foundation': self._foundation} if foundation else None,
+                          extra,
+                          '{}Record'.format(table.__name__) if self._row_records else None)
+
+    @staticmethod
+    def _where_in(column, values, params):
+        """
+        Build an SQL 'in' match condition using placeholders, appending the
+        values to the query parameter list.
+
+        :param column: the column to match
+        :param values: list of values to match
+        :param params: query parameter list (appended to)
+        :return: match condition string
+        """
+        marks, values = StatsDB.in_list(values)
+        params.extend(values)
+        return '{} in ({})'.format(column, marks)
+
+    @staticmethod
+    def _encode_cursor(guid):
+        """
+        Build an opaque pagination cursor from the last guid of a page.
+
+        :param guid: guid of the last row returned
+        :return: cursor string
+        """
+        return base64.urlsafe_b64encode(guid.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        """
+        Recover the guid from a pagination cursor.
+
+        :param cursor: cursor string (from a previous page's 'next')
+        :return: guid, or None if the cursor is not valid
+        """
+        try:
+            guid = base64.urlsafe_b64decode(
+                (cursor + '=' * (-len(cursor) % 4)).encode()).decode()
+        except (binascii.Error, ValueError):
+            return None
+        return guid if GUID_PATTERN.match(guid) else None
+
+    def _get_page(self, filters):
+        """
+        Get the pagination parameters ('limit' and 'after') from the filters.
+
+        :param filters: MultiDict with optional request filter(s)
+        :return: 3-tuple: (limit or None, after guid or None, error or None)
+        """
+        limit = after = None
+        if not filters:
+            return (limit, after, None)
+        if filters.get('limit'):
+            try:
+                limit = int(filters.get('limit'))
+            except ValueError:
+                limit = 0
+            if limit <= 0:
+                return (None, None, "limit must be a positive integer")
+        if filters.get('after'):
+            after = self._decode_cursor(filters.get('after'))
+            if after is None:
+                return (None, None, "Invalid 'after' cursor")
+        return (limit, after, None)
+
+    def _paginate(self, rows, limit, key):
+        """
+        Take one page (at most 'limit' rows) from guid ordered rows.  One
+        extra row is read to find out whether another page follows.
+
+        :param rows: iterable of rows, ordered by guid
+        :param limit: page size
+        :param key: function returning the guid of a row
+        :return: 2-tuple: (list of rows, next page cursor or None)
+        """
+        page = list(itertools.islice(rows, limit + 1))
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = self._encode_cursor(key(page[-1]))
+        return (page, next_cursor)
+
+    def _change_log(self, table):
+        """
+        Get the change log of a table, starting it (with a first, blocking
+        scan) if warm_up has not yet.  Only the queries on the same table
+        wait for that scan.  The log scans the table replica if it is
+        enabled (and loaded), so that the changes it reports are never newer
+        than the rows the replica returns.
+
+        :param table: table object (CFApps or CFServices)
+        :return: ChangeLog
+        """
+        change_log = self._change_logs.get(table.name)
+        if change_log is not None:
+            return change_log
+        with self._change_locks[table.name]:
+            change_log = self._change_logs.get(table.name)
+            if change_log is None:
+                columns = ('guid',) + self._change_markers[table.name]
+
+                def source():
+                    replica = self._replica_tables()
+                    if replica:
+                        return replica[table.name].rows
+                    return self._cf_db.select(table, list(columns), stream=True)
+
+                change_log = ChangeLog(
+                    table.name, source, self._change_markers[table.name],
+                    refresh_interval=float(PARAMS['DELTA_REFRESH_INTERVAL']),
+                    max_entries=int(PARAMS['DELTA_LOG_SIZE']))
+                change_log.start()
+                self._change_logs[table.name] = change_log
+        return change_log
+
+    def _changes_since(self, table, since):
+        """
+        Get the changes to a table since a watermark, for a delta query.
+
+        :param table: table object (CFApps or CFServices)
+        :param since: watermark from an earlier delta result ('0' for none)
+        :return: 3-tuple: (guids added or updated, or None if every row is
+                 to be returned; delta result dict without the items;
+                 error or None)
+        """
+        try:
+            changed, deleted, watermark = self._change_log(table).changes(since)
+        except InvalidWatermark:
+            return (None, None, "Invalid 'since' watermark")
+        return (changed, {'deleted': deleted, 'watermark': watermark,
+                          'full': changed is None}, None)
+
+    @property
+    def change_version(self):
+        """
+        Version of the change logs: changes whenever a log is scanned (so
+        the delta results, which depend on the scans, get a new ETag).
+        """
+        return ','.join('{}:{}'.format(name, change_log.version)
+                        for name, change_log in sorted(self._change_logs.items()))
+
+    @property
+    def change_log_stats(self):
+        """
+        Get the state of the change logs (empty until they are started).
+        """
+        return {name: change_log.stats
+                for name, change_log in self._change_logs.items()}
+
+    def _replica_tables(self):
+        """
+        Get the current replica snapshot (or the one pinned by
+        consistent_view), if the replica is enabled and loaded.
+
+        :return: dict of table name to TableReplica, or None
+        """
+        pinned = getattr(self._local, 'replica', None)
+        if pinned is not None:
+            return pinned
+        return self._replica.snapshot() if self._replica else None
+
+    @contextlib.contextmanager
+    def consistent_view(self, replica=None):
+        """
+        Answer the queries made in the context (by this thread) from one
+        view of the data: the current table replica snapshot if the replica
+        is loaded, else one database connection holding a consistent
+        snapshot transaction (see StatsDB.snapshot).  Non-streamed queries
+        only.
+
+        Queries answered from the replica need no connection and may be
+        run concurrently: other threads join the view by passing the
+        snapshot yielded here.
+
+        :param replica: replica snapshot yielded by consistent_view (in
+                        another thread), to answer from
+        :return: (context) the replica snapshot answered from, or None if
+                 the queries go to the database
+        """
+        replica = replica or self._replica_tables()
+        if not replica:
+            with self._cf_db.snapshot():
+                yield None
+            return
+        outer = getattr(self._local, 'replica', None)
+        self._local.replica = replica
+        try:
+            yield replica
+        finally:
+            self._local.replica = outer
+
+    _version_tables = (CFApps, CFServiceBindings, CFServices, CFSpaces,
+                       CFOrganizations, CFRouteMapping, CFRoutes, CFDomains)
+
+    @property
+    def data_version(self):
+        """
+        Get a fingerprint of the data the agent answers from: the table
+        replica generation (if the replica is enabled) or the database table
+        versions, plus the Bitbucket metadata version.  The fingerprint is
+        re-read at most once per DATA_VERSION_TTL seconds.
+
+        :return: version string, or None if the version is not known
+        """
+        expires, version = self._version
+        now = time.monotonic()
+        if now < expires:
+            return version
+
+        if self._replica:
+            tables = self._replica.version
+        else:
+            tables = self._cf_db.data_version(self._version_tables)
+        version = None
+        if tables is not None:
+            version = '{}|{}'.format(tables, self._bb_fetch.metadata_version)
+        self._version = (now + self._version_ttl, version)
+        return version
+
+    @property
+    def replica_stats(self):
+        """
+        Get the table replica state (None if the replica is not enabled).
+        """
+        return self._replica.stats if self._replica else None
+
+    @property
+    def db_pool_stats(self):
+        """
+        Get the database connection pool statistics.
+        """
+        return self._cf_db.pool_stats
+
+    @property
+    def bb_fetcher_stats(self):
+        """
+        Get the Bitbucket fetcher metadata cache state.
+        """
+        return self._bb_fetch.stats
+
+    @property
+    def db_statement_stats(self):
+        """
+        Get the prepared statement cache statistics.
+        """
+        return self._cf_db.statement_stats
+
+    def full_scans(self):
+        """
+        Report the query shapes run so far whose plans read a whole table
+        or index (see StatsDB.full_scans).
+        """
+        return self._cf_db.full_scans()
+
+    _list_tables = {'app': CFApps,
+                    'service': CFServices,
+                    'org': CFOrganizations,
+                    'space': CFSpaces,
+                   }
+
+    def columns(self, kind, filters=None):
+        """
+        Get the result columns of a kind of result, in order, for tabular
+        output: the order of the field tuples (for apps and services) or
+        the table columns, followed by the columns the agent adds.  Given
+        the request filters, only the columns of that request's rows (the
+        showField projection, the metadata if requested) are returned.
+
+        :param kind: one of 'app', 'service', 'org', 'space' or
+                     '<kind>_list'
+        :param filters: MultiDict of (lower case) request filters, or None
+        :return: list of column names
+        """
+        columns = self._columns(kind)
+        if filters is None:
+            return columns
+        extra = []
+        if kind == 'app':
+            columns.remove('metadata')
+            if filters.get('withmetadata', 'False').lower() in ['true', 'yes']:
+                extra.append('metadata')
+        requested_fields = set(filters.getlist('showfield'))
+        if requested_fields and kind in ('app', 'service'):
+            columns = [col for col in columns if col in requested_fields]
+        return columns + extra
+
+    def _columns(self, kind):
+        """
+        All the result columns of a kind of result, in order (see columns).
+        """
+        if kind.endswith('_list'):
+            return ['guid', 'name']
+        if kind.endswith('_capacity'):
+            level = kind[:-len('_capacity')]
+            keys = ['director', 'org_count'] if level == 'director' \
+                   else [name for name, _ in self._capacity_levels[level][1]] \
+                   + ['director']
+            return keys + self._capacity_totals
+        if kind == 'app':
+            return [name for name, _ in self._app_fields] \
+                   + ['foundation', 'director', 'metadata']
+        if kind == 'service':
+            return [name for name, _ in self._service_fields
+                    if name != 'LAST_OPERATION'] \
+                   + [self._lastop_map[key] for key in sorted(self._lastop_map)] \
+                   + ['foundation', 'director']
+        if kind == 'space':
+            return list(self._list_tables[kind].columns) + ['foundation']
+        return list(self._list_tables[kind].columns)
+
+    def get_list(self, kind, filters=None):
+        """
+        Get the (short) guid/name list of known apps, services, orgs or
+        spaces.  If a 'limit' filter is given a single page is returned
+        as {'items': [...], 'next': cursor}; pass the cursor as the 'after'
+        filter to get the following page.
+
+        :param kind: one of 'app', 'service', 'org', 'space'
+        :param filters: MultiDict with optional pagination filter(s)
+        :return: list of guid/name dicts, or a page dict
+        """
+        LOGGER.debug("Retrieve (short) %s list", kind)
+        table = self._list_tables[kind]
+        limit, after, error = self._get_page(filters)
+        if error:
+            LOGGER.error(error)
+            return error
+
+        replica = self._replica_tables()
+        if replica:
+            rows = ({'guid': row['guid'], 'name': row['name']}
+                    for row in replica[table.name].lookup(after=after))
+        else:
+            rows = self._cf_db.select(table, ['guid', 'name'], after=after,
+                                      limit=limit + 1 if limit else None)
+        if limit:
+            items, next_cursor = self._paginate(rows, limit, itemgetter('guid'))
+            return {'items': items, 'next': next_cursor}
+        return list(rows)
+
     @property
     def app_list(self):
         """
         Get the list of known apps.
         """
-        LOGGER.debug("Retrieve (short) app list")
-        applist = self._cf_db.select(CFApps, ['guid', 'name'])
-        return applist
+        return self.get_list('app')
 
     @property
     def service_list(self):
@@ -102,29 +743,85 @@ class CFStatsAgent(object):
 
         TODO: add service query (list all services of certain type)
         """
-        LOGGER.debug("Retrieve (short) service list")
-        svclist = self._cf_db.select(CFServices, ['guid', 'name'])
-        return svclist
+        return self.get_list('service')
 
     @property
     def org_list(self):
         """
         Get the list of known orgs.
         """
-        LOGGER.debug("Retrieve (short) org list")
-        orglist = self._cf_db.select(CFOrganizations, ['guid', 'name'])
-        return orglist
+        return self.get_list('org')
 
     @property
     def space_list(self):
         """
         Get the list of known spaces.
+        """
+        return self.get_list('space')
+
+    @staticmethod
+    def _project(fields, requested, required=()):
+        """
+        Select the fields to query: all of them if no particular fields were
+        requested, otherwise those requested plus any the agent itself needs.
+
+        :param fields: list of (display name, source column) tuples
+        :param requested: set of requested display names (or None for all)
+        :param required: display names which are always queried
+        :return: list of (display name, source column) tuples
+        """
+        if requested is None:
+            return list(fields)
+        return [fld for fld in fields if fld[0] in requested or fld[0] in required]
+
+    @staticmethod
+    def _join_sql(sources, joins):
+        """
+        Build the JOIN clauses needed by the given source columns: a join is
+        included only if one of the columns refers to its table alias (or a
+        needed join depends on it).
+
+        :param sources: list of source columns/expressions ("alias.column")
+        :param joins: list of (alias, join clause, aliases depended on),
+                      each join listed after those it depends on
+        :return: SQL string
+        """
+        needed = set(re.findall(r'(\w+)\.\w+', ' '.join(sources)))
+        for alias, _, depends in reversed(joins):
+            if alias in needed:
+                needed.update(depends)
+        return ''.join(' {}'.format(join) for alias, join, _ in joins
+                       if alias in needed)
+
+    @staticmethod
+    def _page_sql(where, params, after, limit, key, group_by=None):
+        """
+        Build the tail of a query: the WHERE clause (including the keyset
+        pagination condition), GROUP BY, and for a paginated query ORDER BY
+        and LIMIT.  One row more than the page size is requested so that
+        the presence of a following page can be detected.
 
-        TODO: convert to DB
+        :param where: list of match conditions
+        :param params: query parameter list (appended to)
+        :param after: guid to start after (or None)
+        :param limit: page size (or None)
+        :param key: the (guid) column to paginate on
+        :param group_by: column to group by (or None)
+        :return: SQL string
         """
-        LOGGER.debug("Retrieve (short) space list")
-        spclist = self._cf_db.select(CFSpaces, ['guid', 'name'])
-        return spclist
+        where = list(where)
+        if after:
+            where.append('{} > %s'.format(key))
+            params.append(after)
+        sql = ' WHERE {}'.format(' AND '.join(where)) if where else ''
+        if group_by:
+            sql += ' GROUP BY {}'.format(group_by)
+        if after or limit:
+            sql += ' ORDER BY {}'.format(key)
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit + 1)
+        return sql
 
     def get_org(self, filters=None):
         """
@@ -139,8 +836,14 @@ class CFStatsAgent(object):
                   + '   FROM {}'.format(table.name)
 
         orgs = None
-        if filters:
-            # fetch the filters, turn them into lists of quoted strings
+        org_guids = org_names = None
+        where = []
+        params = []
+        limit, after, orgs = self._get_page(filters)
+        if orgs:
+            LOGGER.error(orgs)
+        elif filters:
+            # fetch the filters, turn them into lists of strings
             org_guids = self._get_filter_list(filters, 'orgguid')
             org_names = self._get_filter_list(filters, 'orgname', True)
 
@@ -149,78 +852,280 @@ class CFStatsAgent(object):
                 LOGGER.error(orgs)
             else:
                 if org_guids:
-                    org_sql += ' WHERE guid in ({})'.format(','.join(org_guids))
+                    where.append(self._where_in('guid', org_guids, params))
                 if org_names:
-                    org_sql += ' WHERE name in ({})'.format(','.join(org_names))
+                    where.append(self._where_in('name', org_names, params))
 
         if not orgs:
-            cur = self._cf_db.query(org_sql)
-            orgs = [self._cf_db.row_to_dict(row, columns) for row in cur]
+            replica = self._replica_tables()
+            if replica:
+                org_rows = replica[table.name].lookup(guids=org_guids,
+                                                      names=org_names,
+                                                      after=after)
+                orgs = ({col: row.get(col) for col in columns}
+                        for row in org_rows)
+            else:
+                org_sql += self._page_sql(where, params, after, limit, 'guid')
+                cur = self._cf_db.query(org_sql, params)
+                orgs = map(self._row_decoder(table, columns, foundation=False).decode,
+                           cur)
+            if limit:
+                items, next_cursor = self._paginate(orgs, limit,
+                                                    itemgetter('guid'))
+                orgs = {'items': items, 'next': next_cursor}
+            else:
+                orgs = list(orgs)
         return orgs
 
-    def get_app(self, filters=None):
+    # Capacity rollups: per level, the (SQL) group key and the columns
+    # identifying each group: (result name, SQL expression)
+    _capacity_levels = {
+        'org': ('og.guid', [('org_guid', 'og.guid'),
+                            ('org_name', 'MAX(og.name)')],
+                'FROM organizations AS og'
+                ' LEFT JOIN spaces AS sp ON sp.organizationGUID=og.guid'),
+        'space': ('sp.guid', [('space_guid', 'sp.guid'),
+                              ('space_name', 'MAX(sp.name)'),
+                              ('org_guid', 'MAX(og.guid)'),
+                              ('org_name', 'MAX(og.name)')],
+                  'FROM spaces AS sp'
+                  ' LEFT JOIN organizations AS og ON og.guid=sp.organizationGUID'),
+    }
+    _capacity_app_fields = [
+        ('app_count', 'COUNT(ap.guid)'),
+        ('started_count', "SUM(CASE WHEN ap.state='STARTED' THEN 1 ELSE 0 END)"),
+        ('stopped_count', "SUM(CASE WHEN ap.state='STOPPED' THEN 1 ELSE 0 END)"),
+        ('instances', 'SUM(ap.instances)'),
+        ('memory_mb', 'SUM(ap.memory * ap.instances)'),
+        ('disk_mb', 'SUM(ap.diskQuota * ap.instances)'),
+    ]
+    _capacity_totals = [name for name, _ in _capacity_app_fields] \
+                       + ['service_instance_count']
+
+    def get_capacity(self, level, filters=None):
+        """
+        Get capacity rollups per org, space or director: app counts
+        (total, started, stopped), instances, memory and disk (memory and
+        disk quota times instances, in MB) and service instance counts.
+        The org and space aggregates are computed by the database (GROUP
+        BY); the director is looked up once per org and the director
+        rollup is the sum of its orgs.
+
+        :param level: 'org', 'space' or 'director'
+        :param filters: MultiDict with optional request filter(s): orgGuid,
+                        orgName, spaceGuid, spaceName (space level) or
+                        director (director level)
+        :return: list of rollup dicts, or an error message
+        """
+        filters = filters or MultiDict()
+        where = []
+        params = []
+        org_guids = self._get_filter_list(filters, 'orgguid')
+        org_names = self._get_filter_list(filters, 'orgname', True)
+        if org_guids:
+            where.append(self._where_in('og.guid', org_guids, params))
+        if org_names:
+            where.append(self._where_in('og.name', org_names, params))
+        if level == 'space':
+            spc_guids = self._get_filter_list(filters, 'spaceguid')
+            spc_names = self._get_filter_list(filters, 'spacename', True)
+            if spc_guids:
+                where.append(self._where_in('sp.guid', spc_guids, params))
+            if spc_names:
+                where.append(self._where_in('sp.name', spc_names, params))
+
+        replica = self._replica_tables()
+        if replica:
+            rollups = self._replica_capacity(replica, 'org' if level == 'director'
+                                             else level, filters)
+        else:
+            rollups = self._sql_capacity('org' if level == 'director' else level,
+                                         where, params)
+
+        # one director lookup per org
+        directors = {}
+        for row in rollups:
+            org = row.get('org_name')
+            if org not in directors:
+                directors[org] = self._bb_fetch.director_by_org_name(org) \
+                                 if org else 'Unknown'
+            row['director'] = directors[org] or 'Unknown'
+        if level != 'director':
+            return rollups
+
+        wanted = set(self._get_filter_list(filters, 'director', True))
+        by_director = {}
+        for row in rollups:
+            if wanted and row['director'].lower() not in wanted:
+                continue
+            total = by_director.setdefault(
+                row['director'], dict([('director', row['director']),
+                                       ('org_count', 0)]
+                                      + [(name, 0) for name in self._capacity_totals]))
+            total['org_count'] += 1
+            for name in self._capacity_totals:
+                total[name] += row[name]
+        return [by_director[name] for name in sorted(by_director)]
+
+    def _sql_capacity(self, level, where, params):
+        """
+        Compute the org or space rollups in the database: one grouped
+        query over the apps and one over the service instances, merged on
+        the group key.
+
+        :param level: 'org' or 'space'
+        :param where: list of conditions (on og.* / sp.*)
+        :param params: query parameters for 'where'
+        :return: list of rollup dicts, ordered by group key
+        """
+        key, key_fields, from_sql = self._capacity_levels[level]
+        where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+        app_fields = key_fields + self._capacity_app_fields
+        app_sql = 'SELECT {} {} LEFT JOIN applications AS ap ON ap.spaceGUID=sp.guid' \
+                  '{} GROUP BY {} ORDER BY {}'.format(
+                      ', '.join(expr for _, expr in app_fields), from_sql,
+                      where_sql, key, key)
+        svc_sql = 'SELECT {}, COUNT(si.guid) {}' \
+                  ' LEFT JOIN service_instances AS si ON si.spaceGUID=sp.guid' \
+                  '{} GROUP BY {}'.format(key, from_sql, where_sql, key)
+
+        columns = [name for name, _ in app_fields]
+        decode = RowDecoder(columns).decode
+        rollups = []
+        for row in self._cf_db.query(app_sql, list(params)):
+            rowdict = decode(row)
+            for name, _ in self._capacity_app_fields:
+                rowdict[name] = int(rowdict[name] or 0)
+            rollups.append(rowdict)
+        svc_counts = dict(self._cf_db.query(svc_sql, list(params)))
+        for rowdict in rollups:
+            rowdict['service_instance_count'] = \
+                int(svc_counts.get(rowdict[key_fields[0][0]]) or 0)
+        return rollups
+
+    def _replica_capacity(self, replica, level, filters):
+        """
+        Compute the org or space rollups from the table replica.
+
+        :param replica: replica snapshot (dict of table name to TableReplica)
+        :param level: 'org' or 'space'
+        :param filters: request filters (see get_capacity)
+        :return: list of rollup dicts, ordered by group key
+        """
+        orgs = replica[CFOrganizations.name]
+        spaces = replica[CFSpaces.name]
+        org_guids = set(self._get_filter_list(filters, 'orgguid'))
+        org_names = set(self._get_filter_list(filters, 'orgname', True))
+        spc_guids = set(self._get_filter_list(filters, 'spaceguid'))
+        spc_names = set(self._get_filter_list(filters, 'spacename', True))
+
+        def selected(org, space):
+            if (org_guids and org.get('guid') not in org_guids) \
+               or (org_names and (org.get('name') or '').lower() not in org_names):
+                return False
+            if level == 'space' and ((spc_guids and space.get('guid') not in spc_guids)
+                                     or (spc_names and (space.get('name') or '').lower()
+                                         not in spc_names)):
+                return False
+            return True
+
+        rollups = {}
+        groups = {}         # space guid -> rollup
+        if level == 'org':
+            for org in orgs.rows:
+                if selected(org, {}):
+                    rollups[org['guid']] = {'org_guid': org['guid'],
+                                            'org_name': org.get('name')}
+            for space in spaces.rows:
+                if space.get('organizationGUID') in rollups:
+                    groups[space['guid']] = rollups[space['organizationGUID']]
+        else:
+            for space in spaces.rows:
+                org = orgs.get(space.get('organizationGUID'))
+                if selected(org, space):
+                    groups[space['guid']] = rollups[space['guid']] = {
+                        'space_guid': space['guid'], 'space_name': space.get('name'),
+                        'org_guid': org.get('guid'), 'org_name': org.get('name')}
+        for rollup in rollups.values():
+            rollup.update((name, 0) for name in self._capacity_totals)
+
+        for space_guid, rollup in groups.items():
+            for app in replica[CFApps.name].index('spaceGUID', space_guid):
+                instances = int(app.get('instances') or 0)
+                rollup['app_count'] += 1
+                rollup['started_count'] += int(app.get('state') == 'STARTED')
+                rollup['stopped_count'] += int(app.get('state') == 'STOPPED')
+                rollup['instances'] += instances
+                rollup['memory_mb'] += int(app.get('memory') or 0) * instances
+                rollup['disk_mb'] += int(app.get('diskQuota') or 0) * instances
+            rollup['service_instance_count'] += \
+                len(replica[CFServices.name].index('spaceGUID', space_guid))
+        return [rollups[key] for key in sorted(rollups)]
+
+    def get_app(self, filters=None, stream=False, strategy=None):
         """
         Get the app data for all apps or just the one(s) specified if
         filters are given.
 
+        With a 'since' watermark only the apps added or updated since the
+        watermark are returned, as a delta result: {'items': [...],
+        'deleted': [guids removed], 'watermark': new watermark, 'full':
+        true if every app was returned (the watermark was too old)}.
+
         :param filters: ImmutableMultiDict with optional request filter(s)
+        :param stream: if true return a row iterator rather than a list
+                       (ignored when a page is requested with 'limit' or a
+                       delta with 'since')
+        :param strategy: query strategy, 'join' (a single grouped query) or
+                         'decomposed' (see _decomposed_app_rows); defaults
+                         to the APP_QUERY_STRATEGY parameter
         """
-        # Use a list of tuples to assure ordering of labels and results
-        # The tuple pairs are "display name" and "source_table.column_name"
-        fields = [('buildpack', 'ap.buildpack'),
-                  ('disk_quota', 'ap.diskQuota'),
-                  ('docker_image', 'ap.dockerImage'),
-                  ('guid', 'ap.guid'),
-                  ('health_check_timeout', 'ap.healthCheckTimeout'),
-                  ('health_check_type', 'ap.healthCheckType'),
-                  ('instances', 'ap.instances'),
-                  ('memory', 'ap.memory'),
-                  ('name', 'ap.name'),
-                  ('org_guid', 'og.guid'),
-                  ('org_name', 'og.name'),
-                  ('package_updated_at', 'ap.packageUpdatedAt'),
-                  ('space_guid', 'sp.guid'),
-                  ('space_name', 'sp.name'),
-                  ('stack_guid', 'ap.stackGUID'),
-                  ('state', 'ap.state'),
-                  ('service_names', 'GROUP_CONCAT(DISTINCT si.name SEPARATOR ", ")'),
-                  ('urls', 'GROUP_CONCAT(DISTINCT ' + \
-                           'CONCAT(rt.host, ".", dm.name) SEPARATOR ", ")'),
-                 ]
-
         non_query_fields = ('director', 'foundation')
-        app_params, col_names = zip(*fields)
-        app_sql = 'SELECT {} '.format(','.join(col_names))
-        app_sql += ('    FROM applications AS ap'
-                    '    LEFT JOIN service_bindings AS sb ON sb.appGUID=ap.guid'
-                    '    LEFT JOIN service_instances AS si ON si.guid=sb.serviceInstanceGUID'
-                    '    LEFT JOIN spaces AS sp ON ap.spaceGUID=sp.guid'
-                    '    LEFT JOIN organizations AS og ON sp.organizationGUID=og.guid'
-                    '    LEFT JOIN route_mappings AS rm ON rm.appGUID=ap.guid'
-                    '    LEFT JOIN routes AS rt ON rt.guid = rm.routeGUID'
-                    '    LEFT JOIN domains AS dm ON dm.guid=rt.domainGUID')
+        app_params = tuple(name for name, _ in self._app_fields)
 
         apps = None
         discard_fields = None
+        requested_available = None
         incl_meta = False
-        if filters:
-            # fetch the filters, turn them into lists of quoted strings
+        app_guids = app_spaces = app_names = None
+        predicates = []
+        delta = None
+        where = []
+        params = []
+        limit, after, apps = self._get_page(filters)
+        if apps:
+            LOGGER.error(apps)
+        elif filters:
+            # fetch the filters, turn them into lists of strings
             app_guids = self._get_filter_list(filters, 'appguid')
             app_spaces = self._get_filter_list(filters, 'spaceguid')
             app_names = self._get_filter_list(filters, 'appname', True)
+            since = filters.get('since')
             meta_flag = filters.get('withmetadata', 'False').lower()
             incl_meta = True if meta_flag in ['true', 'yes'] else incl_meta
 
-            if sum(map(bool, [app_guids, app_spaces, app_names])) > 1:
-                apps = "Specify only appGuid, spaceGuid or appName"
+            predicates, apps = self._predicates(filters, self._app_fields)
+            if apps:
+                LOGGER.error(apps)
+            elif sum(map(bool, [app_guids, app_spaces, app_names, since])) > 1:
+                apps = "Specify only appGuid, spaceGuid, appName or since"
+                LOGGER.error(apps)
+            elif since and (limit or after or predicates):
+                apps = "'since' cannot be combined with limit, after or where"
                 LOGGER.error(apps)
             else:
-                if app_guids:
-                    app_sql += ' WHERE ap.guid in ({})'.format(','.join(app_guids))
+                if since:
+                    app_guids, delta, apps = self._changes_since(CFApps, since)
+                    if apps:
+                        LOGGER.error(apps)
+                if app_guids and not delta:
+                    # (a delta's guids are queried in chunks, see _delta_rows)
+                    where.append(self._where_in('ap.guid', app_guids, params))
                 if app_spaces:
-                    app_sql += ' WHERE si.spaceGUID in ({})'.format(','.join(app_spaces))
+                    where.append(self._where_in('ap.spaceGUID', app_spaces, params))
                 if app_names:
-                    app_sql += ' WHERE ap.name in ({})'.format(','.join(app_names))
+                    where.append(self._where_in('ap.name', app_names, params))
+                where.extend(pred.sql(params) for pred in predicates)
 
             requested_fields = set(filters.getlist('showfield'))
             if requested_fields:
@@ -231,44 +1136,289 @@ class CFStatsAgent(object):
                                 requested_fields - requested_available)
                 discard_fields = set(all_fields) - requested_available
 
-        app_sql += ' GROUP BY ap.guid'
+        # Query only the requested fields (plus the guid, and the org name if
+        # the director or metadata is wanted) and only the joins they need
+        with_director = requested_available is None \
+                        or 'director' in requested_available
+        required = ['guid']
+        if with_director or incl_meta:
+            required.append('org_name')
+        fields = self._project(self._app_fields, requested_available, required)
+        app_params, col_names = zip(*fields)
+        stream = stream and not limit and delta is None
         if not apps:
-            cur = self._cf_db.query(app_sql)
-            # Create a list of all rows, with each row converted to a dictionary.
-            # Add foundation key/value to each list entry.
-            # apps = [dict(self._cf_db.row_to_dict(row, app_params),
-            #             **{'foundation': PARAMS['FOUNDATION']}) for row in cur]
-            apps = []
-            new_row = True
-            for row in cur:
-                rowdict = self._cf_db.row_to_dict(row, app_params)
-                rowdict['foundation'] = self._foundation
-                director = None
-                org = rowdict.get('org_name')
-                if org:
-                    director = \
-                        self._bb_fetch.director_by_org_name(org,
-                                                            refresh_on_miss=new_row)
-                    new_row = False
-                rowdict['director'] = director or 'Unknown'
-                if discard_fields:
-                    for f in discard_fields:
-                        rowdict.pop(f, None)
-                if incl_meta:
-                    rowdict['metadata'] = \
-                        self._bb_fetch.get_metadata_by_org_name(org,
-                                                                refresh_on_miss=new_row)
-                    new_row = False
+            replica = self._replica_tables()
+            if delta and not delta['full'] and not app_guids:
+                rows = []
+            elif replica:
+                rows = self._replica_app_rows(replica, fields, app_guids,
+                                              app_spaces, app_names, after,
+                                              predicates)
+            else:
+                def query(where, params):
+                    if (strategy or self._app_strategy) == 'decomposed':
+                        return self._decomposed_app_rows(fields, where, params,
+                                                         after, limit, predicates)
+                    app_sql = 'SELECT {} FROM applications AS ap'.format(
+                        ','.join(col_names))
+                    app_sql += self._join_sql(
+                        col_names + tuple(pred.column for pred in predicates),
+                        self._app_joins)
+                    app_sql += self._page_sql(where, params, after, limit,
+                                              'ap.guid', group_by='ap.guid')
+                    if stream:
+                        return self._cf_db.query_iter(app_sql, params)
+                    return self._cf_db.query(app_sql, params)
 
-                apps.append(rowdict)
+                if delta and app_guids:
+                    rows = self._delta_rows(app_guids, 'ap.guid', query)
+                else:
+                    rows = query(where, params)
+            if limit:
+                rows, next_cursor = self._paginate(
+                    rows, limit, itemgetter(app_params.index('guid')))
+            apps = self._app_rows(rows, app_params, discard_fields, incl_meta,
+                                  with_director)
+            if limit:
+                apps = {'items': list(apps), 'next': next_cursor}
+            elif delta:
+                apps = dict(items=list(apps), **delta)
+            elif not stream:
+                apps = list(apps)
         return apps
 
-    def get_space(self, filters=None):
+    def _decomposed_app_rows(self, fields, where, params, after, limit,
+                             predicates=()):
+        """
+        Generator: answer the get_app query without the single grouped
+        query, whose bindings x routes row fan-out grows quadratically for
+        apps with many of each.  The app rows (with their one to one space
+        and org joins) are fetched first, then each aggregated field is
+        fetched with one query over the app guid set and merged in with a
+        dict (hash) join.  Rows are shaped as the get_app SQL query rows.
+
+        :param fields: list of (display name, source column) tuples to return
+        :param where: list of app match conditions
+        :param params: query parameters for the match conditions
+        :param after: guid to start after (or None)
+        :param limit: page size (or None)
+        :param predicates: the 'where' filters (their conditions are in
+                           'where'; their columns may need joins)
+        """
+        base_fields = [fld for fld in fields if fld[0] not in self._app_aggregates]
+        base_cols = [src for _, src in base_fields]
+        app_sql = 'SELECT {} FROM applications AS ap'.format(','.join(base_cols))
+        app_sql += self._join_sql(base_cols + [pred.column for pred in predicates],
+                                  self._app_joins)
+        app_sql += self._page_sql(where, params, after, limit, 'ap.guid')
+        apps = self._cf_db.query(app_sql, params)
+
+        guid_idx = [name for name, _ in base_fields].index('guid')
+        # Unfiltered: read the whole aggregate tables rather than list
+        # every app guid
+        guids = [row[guid_idx] for row in apps] if where or after or limit \
+                else None
+        aggregates = {name: self._app_aggregate(name, guids)
+                      for name, _ in fields if name in self._app_aggregates}
+
+        base_idx = {name: idx for idx, (name, _) in enumerate(base_fields)}
+        for row in apps:
+            guid = row[guid_idx]
+            yield tuple(row[base_idx[name]] if name in base_idx
+                        else ', '.join(sorted(aggregates[name].get(guid, ()))) or None
+                        for name, _ in fields)
+
+    def _delta_rows(self, guids, column, query, chunk_size=1024):
+        """
+        Generator: the rows of a delta ('since') query, run for the changed
+        guids in chunks: a delta may list more guids than a statement may
+        have placeholders.
+
+        :param guids: the guids added or updated since the watermark
+        :param column: the guid column matched (e.g. 'ap.guid')
+        :param query: function(where, params) running the query for the
+                      rows matching the conditions and returning them
+        :param chunk_size: maximum number of guids per query
+        """
+        guids = sorted(guids)
+        for idx in range(0, len(guids), chunk_size):
+            params = []
+            where = [self._where_in(column, guids[idx:idx + chunk_size], params)]
+            yield from query(where, params)
+
+    def _app_aggregate(self, name, guids=None, chunk_size=1024):
+        """
+        Fetch an aggregated get_app field (see _app_aggregates) for the given
+        apps, as a hash table of app guid to the set of values.  Long guid
+        lists are queried in chunks.
+
+        :param name: the aggregated field display name
+        :param guids: list of app guids (or None for all apps)
+        :param chunk_size: maximum number of guids per query
+        :return: dict of app guid to set of values
+        """
+        sql, key = self._app_aggregates[name]
+        if guids is None:
+            chunks = [None]
+        else:
+            chunks = [guids[idx:idx + chunk_size]
+                      for idx in range(0, len(guids), chunk_size)]
+        values = defaultdict(set)
+        for chunk in chunks:
+            params = []
+            chunk_sql = sql
+            if chunk:
+                chunk_sql += ' WHERE {}'.format(self._where_in(key, chunk, params))
+            for guid, value in self._cf_db.query(chunk_sql, params):
+                if value is not None:
+                    values[guid].add(value)
+        return values
+
+    @staticmethod
+    def _replica_row(fields, sources, computed):
+        """
+        Build a result row (tuple ordered as 'fields') from replicated
+        table rows, mimicking the row the equivalent SQL query returns.
+
+        :param fields: list of (display name, source column) tuples
+        :param sources: dict of table alias to (joined) row dict
+        :param computed: dict of display name to pre-computed value
+        :return: tuple
+        """
+        row = []
+        for name, column in fields:
+            if name in computed:
+                row.append(computed[name])
+            else:
+                alias, _, col = column.partition('.')
+                row.append(sources[alias].get(col))
+        return tuple(row)
+
+    @staticmethod
+    def _replica_match(predicates, sources):
+        """
+        Check replicated table rows against 'where' filters.
+
+        :param predicates: list of Predicate objects
+        :param sources: dict of table alias to (joined) row dict
+        :return: True if every predicate holds
+        """
+        for pred in predicates:
+            alias, _, column = pred.column.partition('.')
+            if not pred.matches(sources[alias].get(column)):
+                return False
+        return True
+
+    def _replica_app_rows(self, replica, fields, app_guids, app_spaces,
+                          app_names, after=None, predicates=()):
+        """
+        Generator: answer the get_app query from the table replica, yielding
+        rows shaped as the get_app SQL query rows.
+
+        :param replica: dict of table name to TableReplica
+        :param fields: list of (display name, source column) tuples to return
+        :param app_guids: list of app guids to select (or None)
+        :param app_spaces: list of space guids to select apps in (or None)
+        :param app_names: list of (lower case) app names (or None)
+        :param after: only return apps with a guid greater than this
+        :param predicates: 'where' filters the apps must match
+        """
+        spaces = replica[CFSpaces.name]
+        orgs = replica[CFOrganizations.name]
+        services = replica[CFServices.name]
+        bindings = replica[CFServiceBindings.name]
+        mappings = replica[CFRouteMapping.name]
+        routes = replica[CFRoutes.name]
+        domains = replica[CFDomains.name]
+
+        apps = replica[CFApps.name].lookup(guids=app_guids, names=app_names,
+                                           column='spaceGUID', values=app_spaces,
+                                           after=after)
+        wanted = set(name for name, _ in fields)
+        for app in apps:
+            space = spaces.get(app.get('spaceGUID'))
+            org = orgs.get(space.get('organizationGUID'))
+            sources = {'ap': app, 'sp': space, 'og': org}
+            if not self._replica_match(predicates, sources):
+                continue
+            computed = {}
+            if 'service_names' in wanted:
+                svc_names = set(
+                    services.get(bnd.get('serviceInstanceGUID')).get('name')
+                    for bnd in bindings.index('appGUID', app['guid']))
+                svc_names.discard(None)
+                computed['service_names'] = ', '.join(sorted(svc_names)) or None
+            if 'urls' in wanted:
+                urls = set()
+                for mapping in mappings.index('appGUID', app['guid']):
+                    route = routes.get(mapping.get('routeGUID'))
+                    domain = domains.get(route.get('domainGUID'))
+                    if route.get('host') is not None \
+                       and domain.get('name') is not None:
+                        urls.add('{}.{}'.format(route['host'], domain['name']))
+                computed['urls'] = ', '.join(sorted(urls)) or None
+            yield self._replica_row(fields, sources, computed)
+
+    def _app_rows(self, rows, app_params, discard_fields, incl_meta,
+                  with_director=True):
+        """
+        Generator: convert app query rows to dictionaries, adding the
+        foundation, director and (optionally) org metadata to each.
+
+        :param rows: iterable of app query result rows
+        :param app_params: column name mapping
+        :param discard_fields: fields to drop from each row (or None)
+        :param incl_meta: include org metadata if true
+        :param with_director: look up the director if true
+        """
+        extra = (('director',) if with_director else ()) \
+                + (('metadata',) if incl_meta else ())
+        decode = self._row_decoder(CFApps, app_params, discard_fields, extra).decode
+        org_pos = app_params.index('org_name') if 'org_name' in app_params else None
+        # (the director and metadata are looked up once per org)
+        directors = {}
+        metadata = {}
+        new_row = True
+        enrich = 0.0
+        try:
+            for row in rows:
+                start = time.perf_counter()
+                rowdict = decode(row)
+                org = row[org_pos] if org_pos is not None else None
+                if with_director:
+                    try:
+                        director = directors[org]
+                    except KeyError:
+                        director = None
+                        if org:
+                            director = \
+                                self._bb_fetch.director_by_org_name(org,
+                                                                    refresh_on_miss=new_row)
+                            new_row = False
+                        director = directors[org] = director or 'Unknown'
+                    rowdict['director'] = director
+                if incl_meta:
+                    try:
+                        rowdict['metadata'] = metadata[org]
+                    except KeyError:
+                        rowdict['metadata'] = metadata[org] = \
+                            self._bb_fetch.get_metadata_by_org_name(org,
+                                                                    refresh_on_miss=new_row) \
+                            if org else {}
+                        new_row = False
+                enrich += time.perf_counter() - start
+                yield rowdict
+        finally:
+            add_timing('enrich', enrich)
+
+    def get_space(self, filters=None, stream=False):
         """
         Get the space data for all spaces or just the one(s) specified if
         filters are given.
 
         :param filters: ImmutableMultiDict with optional request filter(s)
+        :param stream: if true return a row iterator rather than a list
+                       (ignored when a page is requested with 'limit')
         """
         table = CFSpaces
         columns = table.columns
@@ -276,8 +1426,14 @@ class CFStatsAgent(object):
                   + '   FROM {}'.format(table.name)
 
         spaces = None
-        if filters:
-            # fetch the filters, turn them into lists of quoted strings
+        spc_guids = spc_names = None
+        where = []
+        params = []
+        limit, after, spaces = self._get_page(filters)
+        if spaces:
+            LOGGER.error(spaces)
+        elif filters:
+            # fetch the filters, turn them into lists of strings
             spc_guids = self._get_filter_list(filters, 'spaceguid')
             spc_names = self._get_filter_list(filters, 'spacename', True)
 
@@ -286,72 +1442,101 @@ class CFStatsAgent(object):
                 LOGGER.error(spaces)
             else:
                 if spc_guids:
-                    spc_sql += ' WHERE guid in ({})'.format(','.join(spc_guids))
+                    where.append(self._where_in('guid', spc_guids, params))
                 if spc_names:
-                    spc_sql += ' WHERE name in ({})'.format(','.join(spc_names))
+                    where.append(self._where_in('name', spc_names, params))
 
+        spc_sql += self._page_sql(where, params, after, limit, 'guid')
+        stream = stream and not limit
         if not spaces:
-            cur = self._cf_db.query(spc_sql)
-            spaces = []
-            for row in cur:
-                rowdict = self._cf_db.row_to_dict(row, columns)
-                rowdict['foundation'] = self._foundation
-                spaces.append(rowdict)
+            replica = self._replica_tables()
+            if replica:
+                rows = (tuple(row.get(col) for col in columns)
+                        for row in replica[table.name].lookup(guids=spc_guids,
+                                                              names=spc_names,
+                                                              after=after))
+            elif stream:
+                rows = self._cf_db.query_iter(spc_sql, params)
+            else:
+                rows = self._cf_db.query(spc_sql, params)
+            if limit:
+                rows, next_cursor = self._paginate(
+                    rows, limit, itemgetter(columns.index('guid')))
+            spaces = self._space_rows(rows, columns)
+            if limit:
+                spaces = {'items': list(spaces), 'next': next_cursor}
+            elif not stream:
+                spaces = list(spaces)
         return spaces
 
-    def get_service(self, fields=None, filters=None):
+    def _space_rows(self, rows, columns):
         """
-        Get the service data for all services or just the one(s) specified if
-        filters are given.
+        Generator: convert space query rows to dictionaries, adding the
+        foundation to each.
 
-        :param filters: ImmutableMultiDict with optional request filter(s)
+        :param rows: iterable of space query result rows
+        :param columns: column name mapping
+        """
+        yield from self._row_decoder(CFSpaces, columns).decode_rows(rows)
 
+    def get_service(self, fields=None, filters=None, stream=False):
         """
-        # Use a list of tuples to assure ordering of labels and results
-        # The tuple pairs are "display name" and "source_table.column_name"
-        fields = [
-            ('bound_app_count', 'COUNT(DISTINCT sb.appGUID)'),
-            ('dashboard_url', 'si.dashboardURL'),
-            ('guid', 'si.guid'),
-            ('LAST_OPERATION', 'si.lastOperation'),
-            ('name', 'si.name'),
-            ('org_guid', 'org.guid'),
-            ('org_name', 'org.name'),
-            ('service', 'si.type'),
-            ('service_plan_guid', 'si.servicePlanGUID'),
-            ('service_guid', 'si.serviceGUID'),
-            ('service_plan', 'si.servicePlanName'),
-            ('space_guid', 'si.spaceGUID'),
-            ('space_name', 'sp.name'),
-        ]
-        lastop_map = {'type': 'last_operation',
-                      'state': 'last_operation_state',
-                      'created_at': 'created_at',
-                      'updated_at': 'updated_at'
-                     }
+        Get the service data for all services or just the one(s) specified if
+        filters are given.  With a 'since' watermark only the services added
+        or updated since the watermark are returned, as a delta result (see
+        get_app).
 
-        svc_params, col_names = zip(*fields)
+        :param filters: ImmutableMultiDict with optional request filter(s)
+        :param stream: if true return a row iterator rather than a list
+                       (ignored when a page is requested with 'limit' or a
+                       delta with 'since')
+        """
+        lastop_map = self._lastop_map
+        svc_params = tuple(name for name, _ in self._service_fields)
         non_query_fields = ('director', 'foundation')
-        svc_sql = 'SELECT {} '.format(','.join(col_names))
-        svc_sql += ('FROM service_instances as si'
-                    ' LEFT JOIN spaces AS sp ON sp.guid=si.spaceGUID'
-                    ' LEFT JOIN organizations AS org ON org.guid=sp.organizationGUID'
-                    ' LEFT JOIN service_bindings AS sb ON sb.serviceInstanceGUID=si.guid ')
         services = None
         discard_fields = None
-        if filters:
-            # fetch the filters, turn them into lists of quoted strings
+        requested_available = None
+        svc_guids = svc_names = None
+        predicates = []
+        delta = None
+        where = []
+        params = []
+        limit, after, error = self._get_page(filters)
+        if error:
+            services = [error]
+            LOGGER.error(error)
+        elif filters:
+            # fetch the filters, turn them into lists of strings
             svc_guids = self._get_filter_list(filters, 'serviceguid')
             svc_names = self._get_filter_list(filters, 'servicename', True)
+            since = filters.get('since')
 
-            if sum(map(bool, [svc_guids, svc_names])) > 1:
-                services = ["Specify only serviceGuid or serviceName"]
+            # (the last operation is filtered on by its unpacked fields' names)
+            predicates, error = self._predicates(
+                filters, [fld for fld in self._service_fields
+                          if fld[0] != 'LAST_OPERATION'])
+            if error:
+                services = [error]
+                LOGGER.error(error)
+            elif sum(map(bool, [svc_guids, svc_names, since])) > 1:
+                services = ["Specify only serviceGuid, serviceName or since"]
+                LOGGER.error(services)
+            elif since and (limit or after or predicates):
+                services = ["'since' cannot be combined with limit, after or where"]
                 LOGGER.error(services)
             else:
-                if svc_guids:
-                    svc_sql += 'AND si.guid in ({}) '.format(','.join(svc_guids))
+                if since:
+                    svc_guids, delta, error = self._changes_since(CFServices, since)
+                    if error:
+                        services = [error]
+                        LOGGER.error(error)
+                if svc_guids and not delta:
+                    # (a delta's guids are queried in chunks, see _delta_rows)
+                    where.append(self._where_in('si.guid', svc_guids, params))
                 if svc_names:
-                    svc_sql += 'AND si.name in ({}) '.format(','.join(svc_names))
+                    where.append(self._where_in('si.name', svc_names, params))
+                where.extend(pred.sql(params) for pred in predicates)
 
             requested_fields = set(filters.getlist('showfield'))
             if requested_fields:
@@ -362,30 +1547,133 @@ class CFStatsAgent(object):
                     LOGGER.info("Requested fields not available: %s",
                                 requested_fields - requested_available)
                 discard_fields = set(all_fields) - requested_available
-        svc_sql += ('GROUP BY si.guid')
+        # Query only the requested fields (plus the guid, the org name if the
+        # director is wanted and the last operation if any of its fields are
+        # wanted) and only the joins they need
+        with_director = requested_available is None \
+                        or 'director' in requested_available
+        required = ['guid']
+        if with_director:
+            required.append('org_name')
+        if requested_available is not None \
+           and requested_available.intersection(lastop_map.values()):
+            required.append('LAST_OPERATION')
+        fields = self._project(self._service_fields, requested_available,
+                               required)
+        svc_params, col_names = zip(*fields)
+        stream = stream and not limit and delta is None
+
+        def query(where, params):
+            svc_sql = 'SELECT {} FROM service_instances AS si'.format(','.join(col_names))
+            svc_sql += self._join_sql(col_names + tuple(pred.column for pred in predicates),
+                                      self._service_joins)
+            svc_sql += self._page_sql(where, params, after, limit, 'si.guid',
+                                      group_by='si.guid')
+            if stream:
+                return self._cf_db.query_iter(svc_sql, params)
+            return self._cf_db.query(svc_sql, params)
+
         if not services:
-            cur = self._cf_db.query(svc_sql)
-            services = []
-            new_row = True
-            # Create a list of all rows, with each row converted to a dictionary.
-            # Add foundation key/value to each list entry, and unpack 'last
-            # operation' fields.
-            for row in cur:
-                rowdict = self._cf_db.row_to_dict(row, svc_params)
-                rowdict['foundation'] = self._foundation
-                if rowdict.get('org_name'):
-                    rowdict['director'] = \
-                        self._bb_fetch.director_by_org_name(rowdict['org_name'],
-                                                            refresh_on_miss=new_row)
-                    new_row = False
-                for k, v in json.loads(rowdict.pop('LAST_OPERATION')).items():
+            replica = self._replica_tables()
+            if delta and not delta['full'] and not svc_guids:
+                rows = []
+            elif replica:
+                rows = self._replica_service_rows(replica, fields, svc_guids,
+                                                  svc_names, after, predicates)
+            elif delta and svc_guids:
+                rows = self._delta_rows(svc_guids, 'si.guid', query)
+            else:
+                rows = query(where, params)
+            if limit:
+                rows, next_cursor = self._paginate(
+                    rows, limit, itemgetter(svc_params.index('guid')))
+            services = self._service_rows(rows, svc_params, lastop_map,
+                                          discard_fields, with_director)
+            if limit:
+                services = {'items': list(services), 'next': next_cursor}
+            elif delta:
+                services = dict(items=list(services), **delta)
+            elif not stream:
+                services = list(services)
+        return services
+
+    def _replica_service_rows(self, replica, fields, svc_guids, svc_names,
+                              after=None, predicates=()):
+        """
+        Generator: answer the get_service query from the table replica,
+        yielding rows shaped as the get_service SQL query rows.
+
+        :param replica: dict of table name to TableReplica
+        :param fields: list of (display name, source column) tuples to return
+        :param svc_guids: list of service instance guids (or None)
+        :param svc_names: list of (lower case) service instance names (or None)
+        :param after: only return services with a guid greater than this
+        :param predicates: 'where' filters the services must match
+        """
+        spaces = replica[CFSpaces.name]
+        orgs = replica[CFOrganizations.name]
+        bindings = replica[CFServiceBindings.name]
+
+        for svc in replica[CFServices.name].lookup(guids=svc_guids,
+                                                   names=svc_names,
+                                                   after=after):
+            space = spaces.get(svc.get('spaceGUID'))
+            org = orgs.get(space.get('organizationGUID'))
+            sources = {'si': svc, 'sp': space, 'org': org}
+            if not self._replica_match(predicates, sources):
+                continue
+            bound_apps = set(bnd.get('appGUID') for bnd in
+                             bindings.index('serviceInstanceGUID', svc['guid']))
+            bound_apps.discard(None)
+            yield self._replica_row(fields, sources,
+                                    {'bound_app_count': len(bound_apps)})
+
+    def _service_rows(self, rows, svc_params, lastop_map, discard_fields,
+                      with_director=True):
+        """
+        Generator: convert service query rows to dictionaries, adding the
+        foundation and director to each and unpacking the 'last operation'
+        fields.
+
+        :param rows: iterable of service query result rows
+        :param svc_params: column name mapping
+        :param lastop_map: mapping of 'last operation' keys to result fields
+        :param discard_fields: fields to drop from each row (or None)
+        :param with_director: look up the director if true
+        """
+        discard = set(discard_fields or ()) | {'LAST_OPERATION'}
+        lastop_pos = svc_params.index('LAST_OPERATION') \
+            if 'LAST_OPERATION' in svc_params else None
+        # (only the wanted 'last operation' fields are unpacked)
+        lastop_map = {key: field for key, field in lastop_map.items()
+                      if field not in discard} if lastop_pos is not None else {}
+        extra = (('director',) if with_director else ()) + tuple(lastop_map.values())
+        decode = self._row_decoder(CFServices, svc_params, discard, extra).decode
+        org_pos = svc_params.index('org_name') if 'org_name' in svc_params else None
+        directors = {}
+        new_row = True
+        enrich = 0.0
+        try:
+            for row in rows:
+                start = time.perf_counter()
+                rowdict = decode(row)
+                org = row[org_pos] if org_pos is not None else None
+                if with_director and org:
                     try:
-                        rowdict[lastop_map[k]] = v
+                        rowdict['director'] = directors[org]
                     except KeyError:
-                        # Ignore fields in result that we don't care to map
-                        pass
-                if discard_fields:
-                    for f in discard_fields:
-                        rowdict.pop(f, None)
-                services.append(rowdict)
-        return services
+                        rowdict['director'] = directors[org] = \
+                            self._bb_fetch.director_by_org_name(org,
+                                                                refresh_on_miss=new_row)
+                        new_row = False
+                if lastop_map and row[lastop_pos]:
+                    for k, v in json.loads(row[lastop_pos]).items():
+                        try:
+                            rowdict[lastop_map[k]] = v
+                        except KeyError:
+                            # Ignore fields in result that we don't care to map
+                            pass
+                enrich += time.perf_counter() - start
+                yield rowdict
+        finally:
+            add_timing('enrich', enrich)
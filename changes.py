@@ -0,0 +1,244 @@
+"""
+T-Mobile PCF team CloudFoundry 'cf-stats' change log.
+
+The fetcher tables carry change markers (applications.packageUpdatedAt,
+the created_at/updated_at times in service_instances.lastOperation), but a
+row which disappears leaves no trace.  A ChangeLog tracks one table: a
+background thread periodically scans the guids and change marker columns
+of the table and records, in observation order, the guids which were added
+or whose markers changed, and the guids which disappeared (tombstones).
+The changes since an earlier scan are found by a binary search of the log,
+at a cost proportional to the number of changes rather than the table size.
+
+Watermarks are opaque strings naming the change log (process) and the scan
+they were issued at.  A watermark issued by another process (e.g. another
+server worker) is answered with an overlap of one scan interval: changes
+near the watermark may be reported twice, but none is missed.
+
+Note(s):
+    1. Requires Python 3
+    2. The log is kept in memory, per process.  A watermark older than the
+       log (issued before its first scan, e.g. by a process since
+       restarted, or older than the entries retained) cannot be answered:
+       the caller has to return the full result instead
+"""
+import base64
+import binascii
+import bisect
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from logger import module_logger
+
+LOGGER = module_logger(__name__)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# watermark of a client which has no data yet
+INITIAL_WATERMARK = '0'
+
+
+class InvalidWatermark(ValueError):
+    """
+    The watermark was not issued by a change log.
+    """
+
+
+class ChangeLog(object):
+    """
+    Change log of one table, kept up to date by a background scan.
+    """
+    def __init__(self, name, source, marker_columns, refresh_interval=60,
+                 max_entries=100000):
+        """
+        Initialize the change log.  Nothing is scanned until 'start' or
+        'scan' is called.
+
+        :param name: name of the table tracked (for logging)
+        :param source: function() returning an iterable of row dicts with
+                       the 'guid' and marker columns of the table
+        :param marker_columns: columns whose values change when a row is
+                               updated
+        :param refresh_interval: seconds between scans
+        :param max_entries: number of changes retained
+        """
+        self.name = name
+        self._source = source
+        self._marker_columns = tuple(marker_columns)
+        self._refresh_interval = refresh_interval
+        self._max_entries = max_entries
+        self._origin = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._markers = None        # guid -> marker values at the last scan
+        self._times = []            # scan time of each change (ascending)
+        self._entries = []          # (guid, deleted) of each change
+        self._complete_since = None
+        self._scanned_at = None
+        self._scans = 0
+        self._scan_secs = None
+        self._failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+        super().__init__()
+
+    @property
+    def ready(self):
+        """
+        True once the table has been scanned.
+        """
+        return self._markers is not None
+
+    @property
+    def version(self):
+        """
+        Version of the log contents: changes at each scan (None before the
+        first scan).
+        """
+        return self._scans if self.ready else None
+
+    def scan(self):
+        """
+        Scan the table and log the rows added, updated and removed since
+        the previous scan.  The first scan only records the current rows.
+        """
+        with self._scan_lock:
+            start = time.monotonic()
+            markers = {}
+            for row in self._source():
+                markers[row['guid']] = tuple(row.get(col)
+                                             for col in self._marker_columns)
+            # changes are stamped with the end of the scan: every change
+            # seen by the scan was made before then
+            scanned_at = time.time()
+            previous = self._markers
+            changes = []
+            if previous is not None:
+                changes = [(guid, False) for guid, marker in markers.items()
+                           if previous.get(guid) != marker]
+                changes.extend((guid, True) for guid in previous
+                               if guid not in markers)
+            with self._lock:
+                if previous is None:
+                    self._complete_since = scanned_at
+                self._times.extend([scanned_at] * len(changes))
+                self._entries.extend(changes)
+                excess = len(self._entries) - self._max_entries
+                if excess > 0:
+                    self._complete_since = self._times[excess - 1]
+                    del self._times[:excess]
+                    del self._entries[:excess]
+                self._markers = markers
+                self._scanned_at = scanned_at
+                self._scans += 1
+            self._scan_secs = round(time.monotonic() - start, 3)
+        LOGGER.debug("Change log %s scanned in %ss: %d rows, %d changes",
+                     self.name, self._scan_secs, len(markers), len(changes))
+
+    def _encode(self, scanned_at):
+        """
+        Build a watermark for a scan of this log.  (The scan time is written
+        exactly: rounded down it would predate the first scan, and the log
+        could not answer.)
+        """
+        mark = '{}:{!r}'.format(self._origin, scanned_at)
+        return base64.urlsafe_b64encode(mark.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def _decode(watermark):
+        """
+        Recover the change log origin and scan time from a watermark.
+
+        :return: 2-tuple: (origin or None, scan time)
+        :raise InvalidWatermark: if the watermark is not valid
+        """
+        if watermark == INITIAL_WATERMARK:
+            return (None, 0.0)
+        try:
+            mark = base64.urlsafe_b64decode(
+                (watermark + '=' * (-len(watermark) % 4)).encode()).decode()
+            origin, scanned_at = mark.split(':')
+            return (origin, float(scanned_at))
+        except (binascii.Error, ValueError) as exn:
+            raise InvalidWatermark(watermark) from exn
+
+    def changes(self, watermark):
+        """
+        Get the changes since a watermark.  The table is scanned first if
+        it has not been scanned yet.
+
+        :param watermark: watermark returned by an earlier call, or
+                          INITIAL_WATERMARK
+        :return: 3-tuple: (guids added or updated, or None if the log cannot
+                 answer for the watermark; guids removed; new watermark)
+        :raise InvalidWatermark: if the watermark is not valid
+        """
+        origin, since = self._decode(watermark)
+        if not self.ready:
+            self.scan()
+        with self._lock:
+            if origin != self._origin:
+                # another process' scans are not in step with this one's
+                since -= self._refresh_interval
+            new_watermark = self._encode(self._scanned_at)
+            if since < self._complete_since:
+                return (None, [], new_watermark)
+            first = bisect.bisect_right(self._times, since)
+            latest = dict(self._entries[first:])
+        changed = sorted(guid for guid, deleted in latest.items() if not deleted)
+        removed = sorted(guid for guid, deleted in latest.items() if deleted)
+        return (changed, removed, new_watermark)
+
+    def _run(self):
+        """
+        Background thread: scan the table every refresh interval.
+        """
+        while not self._stop.wait(self._refresh_interval):
+            try:
+                self.scan()
+            except Exception as exn:        # pylint: disable=broad-except
+                self._failures += 1
+                LOGGER.error("Change log %s scan failed: %s", self.name, exn)
+
+    def start(self):
+        """
+        Scan the table (if not yet scanned) and start the background scan
+        thread.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        if not self.ready:
+            self.scan()
+        LOGGER.debug("Starting change log %s scan thread", self.name)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='changes_{}'.format(self.name),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background scan thread.
+        """
+        self._stop.set()
+
+    @property
+    def stats(self):
+        """
+        Change log state: last scan, duration, failures and entries.
+        """
+        scanned_at = self._scanned_at
+        complete_since = self._complete_since
+        return {'ready': self.ready,
+                'scanned_at': datetime.fromtimestamp(scanned_at).strftime(DATE_FORMAT)
+                              if scanned_at else None,
+                'complete_since': datetime.fromtimestamp(complete_since)
+                                  .strftime(DATE_FORMAT) if complete_since else None,
+                'scan_secs': self._scan_secs,
+                'refresh_interval': self._refresh_interval,
+                'failures': self._failures,
+                'rows': len(self._markers or ()),
+                'entries': len(self._entries),
+               }
@@ -0,0 +1,95 @@
+"""
+T-Mobile PCF team CloudFoundry 'cf-stats' request coalescing.
+
+When many identical requests arrive together (e.g. a dashboard refresh
+storm) only the first runs the query: the others, arriving while it is in
+flight, wait for it and are answered with its result ("single flight").
+Results are not cached: a request arriving after the query completed runs
+it again.
+
+Note(s):
+    1. Requires Python 3
+    2. Coalescing is per process: with the production (multi-worker)
+       server each worker runs its own copy of a query
+    3. The result is shared by every caller, so it must not be modified
+"""
+import threading
+
+from metrics import METRICS, timed
+
+COALESCED = METRICS.counter('cfstats_coalesced_requests_total',
+                            'Requests answered with the result of an identical '
+                            'request in flight', ['kind'])
+
+
+class _Call(object):
+    """
+    A call in flight: its result (or error) and the callers waiting on it.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        super().__init__()
+
+
+class SingleFlight(object):
+    """
+    Run a function once for concurrent callers passing the same key.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}            # key -> _Call in flight
+        self._stats = {'calls': 0, 'coalesced': 0}
+        super().__init__()
+
+    def do(self, kind, key, func):
+        """
+        Call a function, or wait for the identical call in flight.
+
+        :param kind: kind of call (metric label)
+        :param key: hashable key: calls with equal keys are identical
+        :param func: function() to call
+        :return: the function result
+        :raise: the exception the function raised (in every caller)
+        """
+        with self._lock:
+            call = self._calls.get((kind, key))
+            leader = call is None
+            if leader:
+                call = self._calls[(kind, key)] = _Call()
+                self._stats['calls'] += 1
+            else:
+                call.waiters += 1
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            COALESCED.inc((kind,))
+            with timed('coalesced'):
+                call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as exn:
+            call.error = exn
+            raise
+        finally:
+            with self._lock:
+                del self._calls[(kind, key)]
+            call.done.set()
+        return call.result
+
+    @property
+    def stats(self):
+        """
+        Coalescing statistics: calls run, calls coalesced and calls in
+        flight.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+        return stats
@@ -4,6 +4,15 @@ CloudFoundry stats tool Custom exceptions
 """
 
 
+"""
+Configuration errors.
+"""
+class MissingParameter(Exception):
+    """
+    A required (environment) parameter is not set.
+    """
+
+
 """
 REST object errors.
 """
@@ -72,3 +81,9 @@ class SQLMissingParameter(Exception):
     Attempted to create an SQL interface object, but missing
     required connection parameter(s).
     """
+
+class SQLPoolExhausted(Exception):
+    """
+    No database connection became available from the connection pool
+    within the checkout timeout.
+    """
@@ -0,0 +1,100 @@
+"""
+T-Mobile PCF team cf-stats query plan diagnostic.
+
+Runs each CFStatsAgent query shape (every get_* method, with each kind of
+filter and both get_app strategies) against the configured fetcher
+database, then EXPLAINs every query shape run and reports those whose plan
+reads a whole table or index.  The table indexes (see tables.py) are
+checked, and the missing ones created, first.
+
+Usage:
+    python explain_queries.py [--all]
+
+Note(s):
+    1. Requires Python 3
+    2. Uses the same environment (FOUNDATION, MYSQL_* or VCAP_SERVICES, ...)
+       as the foundrystats application
+    3. Scans of the small tables (organizations, domains) and of the table
+       every row of which is returned (e.g. applications for an unfiltered
+       get_app) are expected
+"""
+import argparse
+
+from werkzeug.datastructures import MultiDict
+
+from cfstats_agent import CFStatsAgent
+from logger import get_logger
+
+
+def sample_names(agent, kind):
+    """
+    Get the guid and name of an existing row of a kind ('app', 'org', ...)
+    and the cursor of the page following it.
+    """
+    page = agent.get_list(kind, MultiDict([('limit', '1')]))
+    if not page['items']:
+        return ('none', 'none', None)
+    return (page['items'][0]['guid'], page['items'][0]['name'], page['next'])
+
+
+def run_queries(agent):
+    """
+    Run every agent query shape once.
+    """
+    def filters(*pairs):
+        return MultiDict(list(pairs))
+
+    app_guid, app_name, app_next = sample_names(agent, 'app')
+    svc_guid, svc_name, _ = sample_names(agent, 'service')
+    spc_guid, spc_name, _ = sample_names(agent, 'space')
+    org_guid, org_name, _ = sample_names(agent, 'org')
+    for strategy in CFStatsAgent._app_strategies:  # pylint: disable=protected-access
+        for app_filters in (filters(), filters(('appguid', app_guid)),
+                            filters(('appname', app_name)),
+                            filters(('spaceguid', spc_guid)),
+                            filters(('limit', '10'), ('after', app_next or ''))):
+            agent.get_app(app_filters, strategy=strategy)
+    for svc_filters in (filters(), filters(('serviceguid', svc_guid)),
+                        filters(('servicename', svc_name)),
+                        filters(('limit', '10'))):
+        agent.get_service(filters=svc_filters)
+    for spc_filters in (filters(), filters(('spaceguid', spc_guid)),
+                        filters(('spacename', spc_name))):
+        agent.get_space(spc_filters)
+    for org_filters in (filters(), filters(('orgguid', org_guid)),
+                        filters(('orgname', org_name))):
+        agent.get_org(org_filters)
+        agent.get_capacity('org', org_filters)
+        agent.get_capacity('space', org_filters)
+    for kind in ('app', 'service', 'space', 'org'):
+        agent.get_list(kind, filters())
+
+
+def main():
+    """
+    Parse the arguments, run the queries and print the full scans.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--all', action='store_true',
+                        help='also print the SQL of each query reported')
+    args = parser.parse_args()
+
+    get_logger()
+    agent = CFStatsAgent()
+    agent.warm_up(background=False)
+    run_queries(agent)
+    report = agent.full_scans()
+    for item in report:
+        print(item['shape'])
+        if args.all:
+            print("    {}".format(item['sql']))
+        for scan in item['scans']:
+            print("    {:<24} {:<12} rows {}".format(scan['table'] or '', scan['type'],
+                                                   scan['rows'] if scan['rows'] is not None
+                                                   else '?'))
+    print("{} query shapes with full scans".format(len(report)))
+    agent.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,64 +3,133 @@ T-Mobile PCF team Cloud Foundry statistis gathering REST endpoint(s) (aka: agent
 
 Note(s):
     1. Requires Python 3
+    2. The server starts listening right away: the agent warms up (database
+       connections and indexes, Bitbucket metadata, table replica) in the
+       background, and 'state' reports its readiness meanwhile
+    3. 'batch' runs several data queries, POSTed as JSON, against one
+       consistent view of the data (see CFStatsAgent.consistent_view)
 """
+import os
 import werkzeug
 from collections import defaultdict
-from flask import jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, jsonify, request
 
+import excepts as exc
 from cfstats_agent import CFStatsAgent
-from logger import LOGGER
-from parameters import PARAMS
-from restobj import RESTObject, Endpoint
+from coalesce import SingleFlight
+from logger import get_logger, module_logger
+from metrics import METRICS
+from parameters import PARAMS, SYS_PARAMS
+from restobj import RESTObject, Endpoint, SERVER_MODES, serve_production
+from serializers import SERIALIZERS
+
+# (named, as __name__ is '__main__' when run as the main script)
+LOGGER = module_logger('foundrystats')
 
 FOUNDRYSTATS_REST_VERSION = '0.1'
 
+# most worker processes started for SERVER_WORKERS 0 (each worker has its
+# own DB pool, replica, change logs and refresher threads)
+MAX_AUTO_WORKERS = 4
+
 class CFStatsREST(RESTObject):
     """
     The REST API: field incoming requests and dispatch to
     the appropriate handler.
     """
     version = FOUNDRYSTATS_REST_VERSION
-    def __init__(self, service_name=None, port=None):
+    # filters which do not change the agent result (only its presentation)
+    _presentation_filters = ('format',)
+    _svc_params = ['bound_app_count', 'created_at', 'dashboardUrl',
+                   'guid' 'lastOperation', 'last_operation_state',
+                   'name', 'org_guid', 'org_name', 'service',
+                   'service_guid', 'service_plan', 'servicePlanGuid',
+                   'service_provider', 'service_version', 'spaceGUID',
+                   'space_name', 'updated_at'
+                  ]
+
+    def __init__(self, service_name=None, port=None, agent=None):
         """
         Initialize the REST object.
+
+        :param agent: CFStatsAgent to query (created if not given)
         """
         self._additional_endpoints = [
             Endpoint('apps', 'get app info (same as get_app)',
                      self._get_app,
-                     filters=["appGuid", "spaceGuid", "appName", "showField"]),
+                     filters=["appGuid", "spaceGuid", "appName", "showField",
+                              "where", "stream", "format", "limit", "after", "since"]),
             Endpoint('services', 'get service info (same as get_service)',
                      self._get_service,
-                     filters=["serviceGuid", "serviceName", "showField"]),
+                     filters=["serviceGuid", "serviceName", "showField",
+                              "where", "stream", "format", "limit", "after", "since"]),
             Endpoint('app_list', 'get the list of all apps',
-                     self._app_list),
+                     self._app_list, filters=["format", "limit", "after"]),
             Endpoint('get_app', 'get app info for all or specific apps(s)',
                      self._get_app,
                      filters=["appGuid", "spaceGuid", "appName",
-                              "showField", "withMetadata"]),
+                              "showField", "withMetadata", "where", "stream", "format", "limit",
+                              "after", "since"]),
             Endpoint('get_org', 'get org info for all or specific org(s)',
-                     self._get_org, filters=["orgGuid", "orgName"]),
+                     self._get_org,
+                     filters=["orgGuid", "orgName", "format", "limit", "after"]),
             Endpoint('get_service', 'get service info',
                      self._get_service,
-                     filters=["serviceGuid", "serviceName", "showField"]),
+                     filters=["serviceGuid", "serviceName", "showField",
+                              "where", "stream", "format", "limit", "after", "since"]),
             Endpoint('org_list', 'get the list of all org guid/names',
-                     self._org_list),
+                     self._org_list, filters=["format", "limit", "after"]),
             Endpoint('service_list', 'get the list of all service guid/names',
-                     self._service_list),
+                     self._service_list, filters=["format", "limit", "after"]),
             Endpoint('space_list', 'get of all spaces',
-                     self._space_list),
+                     self._space_list, filters=["format", "limit", "after"]),
             Endpoint('get_space', 'get space info for all or specific spaces',
-                     self._get_space, filters=["spaceGuid", "spaceName"]),
+                     self._get_space,
+                     filters=["spaceGuid", "spaceName", "stream", "format", "limit", "after"]),
+            Endpoint('org_capacity', 'get capacity rollups per org',
+                     self._org_capacity, filters=["orgGuid", "orgName", "format"]),
+            Endpoint('space_capacity', 'get capacity rollups per space',
+                     self._space_capacity,
+                     filters=["orgGuid", "orgName", "spaceGuid", "spaceName", "format"]),
+            Endpoint('director_capacity', 'get capacity rollups per director',
+                     self._director_capacity, filters=["director", "format"]),
         ]
 
         LOGGER.debug("Initializing CFStatsRest object")
         super().__init__(port=port, service_name=service_name)
         LOGGER.debug("Register endpoints")
         self.register_multiple_endpoints(self._additional_endpoints)
+        self._data_endpoints = set(ep.name for ep in self._additional_endpoints)
+        self.register_endpoint(Endpoint('metrics', 'service metrics (Prometheus format)',
+                                        self._metrics))
+        self.register_endpoint(Endpoint('batch', 'run several data endpoint queries '
+                                        'against one view of the data (POST '
+                                        '{"requests": [{"endpoint": ..., "filters": '
+                                        '{...}}, ...]})',
+                                        self._batch, filters=["format"],
+                                        methods=['GET', 'POST']))
+        self._batch_max_requests = int(PARAMS['BATCH_MAX_REQUESTS'])
+        self._batch_workers = int(PARAMS['BATCH_WORKERS'])
+        self._etag_enabled = str(PARAMS['ETAG_ENABLED']).lower() in ['true', 'yes']
+        self.compress = str(PARAMS['COMPRESS_ENABLED']).lower() in ['true', 'yes']
+        self.compress_level = int(PARAMS['COMPRESS_LEVEL'])
+        self.compress_min_size = int(PARAMS['COMPRESS_MIN_SIZE'])
+        self.server_timing = str(PARAMS['SERVER_TIMING']).lower() in ['true', 'yes']
+        self.profile_token = PARAMS['PROFILE_TOKEN']
+        # identical concurrent queries share one agent call
+        self._coalescer = None
+        if str(PARAMS['COALESCE_ENABLED']).lower() in ['true', 'yes']:
+            self._coalescer = SingleFlight()
 
         #  The fetcher object encapsulates the interface to the Cloud Foundry
         #  DB fetcher.  This is currently a placeholder (see note in agent)
-        self._cfagent = CFStatsAgent()
+        #  An agent created here is warmed up in the background; one passed
+        #  in is warmed up (or not) by the caller.
+        if agent is None:
+            agent = CFStatsAgent()
+            agent.warm_up()
+        self._cfagent = agent
 
     @staticmethod
     def _keys_to_lower(filters):
@@ -73,12 +142,133 @@ class CFStatsREST(RESTObject):
         newfilt = werkzeug.datastructures.MultiDict(convert_dict)
         return newfilt
 
+    def _respond(self, filters, kind, getter):
+        """
+        Run an agent query and build the response in the requested format
+        (streamed if requested and the agent returned a row iterator).
+
+        :param filters: MultiDict of (lower case) request filters
+        :param kind: result kind, for the column order (see agent 'columns')
+        :param getter: function(stream) running the agent query
+        """
+        fmt, error = self.output_format(filters)
+        if not error and filters.get('since') and SERIALIZERS[fmt].records:
+            error = "'since' requires the json or msgpack format"
+        if error:
+            LOGGER.error(error)
+            return jsonify(error)
+        result = self._query(filters, kind, getter)
+        return self.respond(result, fmt, self._cfagent.columns(kind, filters))
+
+    def _agent_query(self, endpoint, filters):
+        """
+        The agent query behind a data endpoint.
+
+        :param endpoint: data endpoint name
+        :param filters: MultiDict of (lower case) request filters
+        :return: 2-tuple: (result kind, for the column order (see agent
+                 'columns'); function(stream) running the query)
+        """
+        agent = self._cfagent
+        queries = {
+            'app_list': ('app_list', lambda _: agent.get_list('app', filters)),
+            'get_app': ('app', lambda stream: agent.get_app(filters=filters,
+                                                            stream=stream)),
+            'get_org': ('org', lambda _: agent.get_org(filters)),
+            'get_service': ('service', lambda stream: agent.get_service(
+                fields=self._svc_params, filters=filters, stream=stream)),
+            'get_space': ('space', lambda stream: agent.get_space(filters,
+                                                                  stream=stream)),
+            'org_list': ('org_list', lambda _: agent.get_list('org', filters)),
+            'service_list': ('service_list',
+                             lambda _: agent.get_list('service', filters)),
+            'space_list': ('space_list', lambda _: agent.get_list('space', filters)),
+            'org_capacity': ('org_capacity',
+                             lambda _: agent.get_capacity('org', filters)),
+            'space_capacity': ('space_capacity',
+                               lambda _: agent.get_capacity('space', filters)),
+            'director_capacity': ('director_capacity',
+                                  lambda _: agent.get_capacity('director', filters)),
+        }
+        queries['apps'] = queries['get_app']
+        queries['services'] = queries['get_service']
+        return queries[endpoint]
+
+    def _query(self, filters, kind, getter):
+        """
+        Run an agent query.  Unless a streamed response was requested, a
+        query identical (same kind and filters, in any order) to one in
+        flight waits for that one's result instead of running again.
+
+        :param filters: MultiDict of (lower case) request filters
+        :param kind: result kind
+        :param getter: function(stream) running the agent query
+        :return: the agent result
+        """
+        stream = self.stream_requested(filters)
+        if stream or self._coalescer is None:
+            return getter(stream)
+        key = tuple(sorted((name, val) for name, vals in filters.lists()
+                           if name not in self._presentation_filters
+                           for val in vals))
+        return self._coalescer.do(kind, key, lambda: getter(False))
+
+    def _state_info(self):
+        """
+        Add the agent readiness, DB connection pool, prepared statement
+        cache, BB fetcher metadata cache, table replica, change log and
+        request coalescing statistics to the service state.
+        """
+        state = {'readiness': self._cfagent.readiness,
+                 'db_pool': self._cfagent.db_pool_stats,
+                 'db_statements': self._cfagent.db_statement_stats,
+                 'bb_fetcher': self._cfagent.bb_fetcher_stats}
+        replica_stats = self._cfagent.replica_stats
+        if replica_stats:
+            state['replica'] = replica_stats
+        change_log_stats = self._cfagent.change_log_stats
+        if change_log_stats:
+            state['change_logs'] = change_log_stats
+        if self._coalescer:
+            state['coalescing'] = self._coalescer.stats
+        return state
+
+    def _data_version(self, rest_request):
+        """
+        The agent data version for the data endpoints (ETags are not used
+        for 'state', 'help', etc.).  Delta ('since') results also depend on
+        the change logs.
+        """
+        if not self._etag_enabled or rest_request not in self._data_endpoints:
+            return None
+        version = self._cfagent.data_version
+        if version is not None and any(key.lower() == 'since' for key in request.args):
+            version = '{}|{}'.format(version, self._cfagent.change_version)
+        return version
+
+    def shutdown(self):
+        """
+        Stop the agent's background threads and close its DB connections.
+        """
+        LOGGER.info("Shutting down (pid %d)", os.getpid())
+        self._cfagent.close()
+
+    @staticmethod
+    def _metrics(*args):            #  pylint: disable=unused-argument
+        """
+        Report the service metrics in the Prometheus text format
+        """
+        return Response(METRICS.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
     def _app_list(self, *args):
         """
         Get the list of all apps
         """
         LOGGER.debug("REST requested app list")
-        return jsonify(self._cfagent.app_list)
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('app_list', filters))
 
     def _get_app(self, *args):
         """
@@ -86,8 +276,8 @@ class CFStatsREST(RESTObject):
         """
         LOGGER.debug("REST requested app data")
         (_, filters) = args
-        apps = self._cfagent.get_app(filters=self._keys_to_lower(filters))
-        return jsonify(apps)
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('get_app', filters))
 
     def _get_org(self, *args):
         """
@@ -95,7 +285,8 @@ class CFStatsREST(RESTObject):
         """
         LOGGER.debug("REST requested org data")
         (_, filters) = args
-        return jsonify(self._cfagent.get_org(self._keys_to_lower(filters)))
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('get_org', filters))
 
     def _get_service(self, *args):
         """
@@ -103,17 +294,8 @@ class CFStatsREST(RESTObject):
         """
         LOGGER.debug("REST requested service data")
         (_, filters) = args
-        svc_params = ['bound_app_count', 'created_at', 'dashboardUrl',
-                      'guid' 'lastOperation', 'last_operation_state',
-                      'name', 'org_guid', 'org_name', 'service',
-                      'service_guid', 'service_plan', 'servicePlanGuid',
-                      'service_provider', 'service_version', 'spaceGUID',
-                      'space_name', 'updated_at'
-                     ]
-
-        svcs = self._cfagent.get_service(fields=svc_params,
-                                         filters=self._keys_to_lower(filters))
-        return jsonify(svcs)
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('get_service', filters))
 
     def _get_space(self, *args):
         """
@@ -121,33 +303,189 @@ class CFStatsREST(RESTObject):
         """
         LOGGER.debug("REST requested space data")
         (_, filters) = args
-        return jsonify(self._cfagent.get_space(self._keys_to_lower(filters)))
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('get_space', filters))
 
     def _org_list(self, *args):
         """
         Get the list of all orgs
         """
         LOGGER.debug("REST requested org list")
-        return jsonify(self._cfagent.org_list)
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('org_list', filters))
 
     def _service_list(self, *args):
         """
         Get the list of all service guid/names
         """
         LOGGER.debug("REST requested service list")
-        return jsonify(self._cfagent.service_list)
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('service_list', filters))
 
     def _space_list(self, *args):
         """
         Get the list of all spaces
         """
         LOGGER.debug("REST requested space list")
-        return jsonify(self._cfagent.space_list)
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('space_list', filters))
+
+    def _batch_requests(self, body):
+        """
+        Parse the sub-requests of a batch request body.  Sub-request filters
+        are given as a JSON object of filter name to value (or list of
+        values); 'stream' and 'format' are ignored.  Delta ('since')
+        queries are refused: they are answered from the change logs, which
+        are not part of the batch's view of the data.
+
+        :param body: decoded JSON request body
+        :return: 2-tuple: (list of (endpoint, filters MultiDict), error
+                 message or None)
+        """
+        if isinstance(body, dict):
+            body = body.get('requests')
+        if not isinstance(body, list) or not body:
+            return ([], 'Batch requires a JSON body: {"requests": '
+                        '[{"endpoint": ..., "filters": {...}}, ...]}')
+        if len(body) > self._batch_max_requests:
+            return ([], "At most {} requests per batch".format(self._batch_max_requests))
+        subs = []
+        for sub in body:
+            endpoint = sub.get('endpoint') if isinstance(sub, dict) else None
+            if endpoint not in self._data_endpoints:
+                return ([], "Unknown batch endpoint: {}".format(endpoint))
+            sub_filters = sub.get('filters') or {}
+            if not isinstance(sub_filters, dict):
+                return ([], "Batch filters must be an object ({})".format(endpoint))
+            if any(name.lower() == 'since' for name in sub_filters):
+                return ([], "'since' is not supported in a batch ({})".format(endpoint))
+            pairs = [(name.lower(), str(val))
+                     for name, value in sub_filters.items()
+                     for val in (value if isinstance(value, list) else [value])
+                     if name.lower() not in ('stream', 'format')]
+            subs.append((endpoint, werkzeug.datastructures.MultiDict(pairs)))
+        return (subs, None)
+
+    def _batch(self, *args):
+        """
+        Run several data endpoint queries in one request and return their
+        results (in request order), all answered from one view of the data:
+        one table replica snapshot, or one DB connection and transaction.
+        Sub-requests answered from the replica are run concurrently.
+        """
+        LOGGER.debug("REST requested batch")
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        fmt, error = self.output_format(filters)
+        if not error:
+            subs, error = self._batch_requests(request.get_json(silent=True))
+        if error:
+            LOGGER.error(error)
+            return jsonify(error)
+
+        def run(sub):
+            endpoint, sub_filters = sub
+            _, getter = self._agent_query(endpoint, sub_filters)
+            return {'endpoint': endpoint, 'result': getter(False)}
+
+        with self._cfagent.consistent_view() as replica:
+            if replica and len(subs) > 1 and self._batch_workers > 1:
+                def run_in_view(sub):
+                    with self._cfagent.consistent_view(replica):
+                        return run(sub)
+                with ThreadPoolExecutor(max_workers=min(self._batch_workers,
+                                                        len(subs))) as pool:
+                    results = list(pool.map(run_in_view, subs))
+            else:
+                results = [run(sub) for sub in subs]
+        return self.respond({'results': results}, fmt)
+
+    def _org_capacity(self, *args):
+        """
+        Get the capacity rollups per org
+        """
+        LOGGER.debug("REST requested org capacity")
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('org_capacity', filters))
+
+    def _space_capacity(self, *args):
+        """
+        Get the capacity rollups per space
+        """
+        LOGGER.debug("REST requested space capacity")
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('space_capacity', filters))
+
+    def _director_capacity(self, *args):
+        """
+        Get the capacity rollups per director
+        """
+        LOGGER.debug("REST requested director capacity")
+        (_, filters) = args
+        filters = self._keys_to_lower(filters)
+        return self._respond(filters, *self._agent_query('director_capacity', filters))
+
+
+def create_app():
+    """
+    App factory: create the REST API object.  The production server calls
+    this in each worker process; it may also be used by any WSGI server,
+    e.g.: gunicorn 'foundrystats:create_app().wsgi_app'
+
+    :return: CFStatsREST object
+    :raise MissingParameter: if a required parameter is not set
+    """
+    SYS_PARAMS.check_required()
+    get_logger()
+    return CFStatsREST(service_name=__name__)
+
+
+def server_options():
+    """
+    Production server options from the parameters.  SERVER_WORKERS of 0
+    means one worker per CPU the process may run on, up to MAX_AUTO_WORKERS
+    (the host's core count is no measure of a container's CPU share).
+
+    :return: dict of serve_production keyword arguments
+    """
+    workers = int(PARAMS['SERVER_WORKERS'])
+    if not workers:
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+               else os.cpu_count() or 1
+        workers = min(cpus, MAX_AUTO_WORKERS)
+    return {'workers': workers,
+            'threads': int(PARAMS['SERVER_THREADS']),
+            'max_requests': int(PARAMS['SERVER_MAX_REQUESTS']),
+            'max_requests_jitter': int(PARAMS['SERVER_MAX_REQUESTS_JITTER']),
+            'timeout': int(PARAMS['SERVER_TIMEOUT']),
+            'graceful_timeout': int(PARAMS['SERVER_GRACEFUL_TIMEOUT']),
+           }
 
 
 if __name__ == "__main__":
+    get_logger()
     LOGGER.debug("Main starting")
+    try:
+        SYS_PARAMS.check_required()
+    except exc.MissingParameter as err:
+        LOGGER.critical("ERROR: %s", err)
+        exit(1)
+
+    server_mode = PARAMS['SERVER_MODE'].lower()
+    if server_mode not in SERVER_MODES:
+        LOGGER.warning("Unknown server mode %s, using 'production'", server_mode)
+        server_mode = 'production'
 
-    # Instantiate and start the REST API
-    cfstats = CFStatsREST(service_name=__name__)
-    cfstats.start(port=PARAMS['STATS_PORT'])
+    if server_mode == 'production':
+        # The workers each create their own REST API object
+        serve_production(create_app, '0.0.0.0', PARAMS['STATS_PORT'],
+                         **server_options())
+    else:
+        # Instantiate and start the REST API
+        cfstats = create_app()
+        cfstats.start(port=PARAMS['STATS_PORT'])
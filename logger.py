@@ -1,33 +1,251 @@
 """
 foundrystats logger functions.
+
+LOGGER is the application-wide logger, and each module logs to its own
+child of it (see module_logger), so that the level of each module can be
+set on its own (LOG_LEVELS).  Importing this module does not configure
+them: the application entry points call get_logger (once) to add the
+output handler and set the levels.
+
+Output is asynchronous (LOG_ASYNC): the logging threads only queue each
+record, a background thread writes them out.  If the queue is full DEBUG
+and INFO records are dropped (and counted) rather than block a request;
+records of higher levels always wait for room.  Records are written as text
+(the message only) or, with LOG_FORMAT 'json', as one JSON object per line.
+
+Call sites run once per row (or per lookup) log through a SampledLogger,
+which passes at most LOG_SAMPLE_RATE records per second per message and
+counts the others, so that enabling DEBUG does not multiply the cost of a
+large result.
 """
+import atexit
+import json
 import logging
+import os
+import queue
 import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
+from metrics import METRICS
 from parameters import PARAMS
 
 APPNAME = 'foundrystats'
 
+LEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO,
+          'WARNING': logging.WARNING, 'ERROR': logging.ERROR,
+          'CRITICAL': logging.CRITICAL}
 
-def get_logger(appname=None, level=None):
+DROPPED = METRICS.counter('cfstats_log_records_dropped_total',
+                          'Log records dropped because the log queue was full')
+SUPPRESSED = METRICS.counter('cfstats_log_records_suppressed_total',
+                             'Log records suppressed by the per call site rate limit')
+
+# the asynchronous output: queue handler, its listener and the process
+# which started the listener
+_ASYNC = {'handler': None, 'listener': None, 'pid': None}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Structured output: each record as a JSON object (time, level, logger,
+    thread, message, the 'extra' fields and any exception).
+    """
+    _standard = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) \
+                | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created,
+                                                timezone.utc).isoformat(),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        entry.update((key, val) for key, val in vars(record).items()
+                     if key not in self._standard)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Queue handler which drops DEBUG and INFO records, rather than block,
+    when the queue is full.
+    """
+    def emit(self, record):
+        if record.levelno < logging.WARNING and self.queue.full():
+            DROPPED.inc()
+            return
+        super().emit(record)
+
+    def enqueue(self, record):
+        if record.levelno < logging.WARNING:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                DROPPED.inc()
+        else:
+            self.queue.put(record)
+
+
+def _start_listener(handler, output):
+    """
+    Start writing out the records queued by the queue handler (on a new
+    queue).
+    """
+    handler.queue = queue.Queue(int(PARAMS['LOG_QUEUE_SIZE']))
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    _ASYNC.update(handler=handler, listener=listener, pid=os.getpid())
+
+
+def _restart_after_fork():
+    """
+    In a forked (e.g. gunicorn worker) process: the listener thread was not
+    forked, start a new one.
+    """
+    if _ASYNC['listener'] is not None:
+        _start_listener(_ASYNC['handler'], _ASYNC['listener'].handlers[0])
+
+
+def _stop_listener():
     """
-    Get a logger object for application-wide use.
+    Write out the queued records and stop the listener (at exit).
     """
-    avail_levels = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO,
-                    'WARNING': logging.WARNING, 'ERROR': logging.ERROR,
-                    'CRITICAL': logging.CRITICAL}
+    if _ASYNC['listener'] is not None and _ASYNC['pid'] == os.getpid():
+        _ASYNC['listener'].stop()
+        _ASYNC['listener'] = None
 
+
+def _make_handler():
+    """
+    Make the output handler: stdout, in the LOG_FORMAT format, behind a
+    queue if LOG_ASYNC is set.
+    """
+    output = logging.StreamHandler(sys.stdout)
+    if str(PARAMS['LOG_FORMAT']).lower() == 'json':
+        output.setFormatter(JSONFormatter())
+    if str(PARAMS['LOG_ASYNC']).lower() not in ['true', 'yes']:
+        return output
+    handler = _QueueHandler(None)
+    _start_listener(handler, output)
+    atexit.register(_stop_listener)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_restart_after_fork)
+    return handler
+
+
+def _module_levels(spec):
+    """
+    Parse the LOG_LEVELS parameter: 'module=LEVEL,...'.
+
+    :return: list of (module, level name) tuples
+    """
+    levels = []
+    for item in str(spec or '').split(','):
+        module, _, level = item.partition('=')
+        if module.strip():
+            levels.append((module.strip(), level.strip().upper()))
+    return levels
+
+
+def get_logger(appname=None, level=None):
+    """
+    Get a logger object for application-wide use, configured with an
+    output (stdout) handler, the LOG_LEVEL level and the LOG_LEVELS
+    module levels.  Calling this again only changes the levels.
+    """
     appname = appname or PARAMS.get('APPNAME', APPNAME)
     loglevel = str(level or PARAMS['LOG_LEVEL']).upper()
 
     logger = logging.getLogger(appname)
-    logger.addHandler(logging.StreamHandler(sys.stdout))
-    if loglevel in avail_levels:
-        print("Setting log level to {}".format(loglevel))
-        logger.setLevel(avail_levels[loglevel])
+    if not logger.handlers:
+        logger.addHandler(_make_handler())
+    if loglevel in LEVELS:
+        logger.setLevel(LEVELS[loglevel])
+        logger.info("Log level set to %s", loglevel)
     else:
-        print("Can't set log level to {}".format(loglevel))
+        logger.warning("Can't set log level to %s", loglevel)
+    for module, modlevel in _module_levels(PARAMS['LOG_LEVELS']):
+        if modlevel in LEVELS:
+            logging.getLogger('{}.{}'.format(appname, module)).setLevel(LEVELS[modlevel])
+            logger.info("Log level of %s set to %s", module, modlevel)
+        else:
+            logger.warning("Can't set log level of %s to %s", module, modlevel)
     return logger
 
 
-LOGGER = get_logger()
+def module_logger(name):
+    """
+    Get the logger of a module: a child of the application logger (its
+    level is that of the application unless set in LOG_LEVELS).
+
+    :param name: module name
+    :return: logging.Logger
+    """
+    return logging.getLogger('{}.{}'.format(APPNAME, name))
+
+
+class SampledLogger(object):
+    """
+    Rate limited logger, for call sites run once per row: at most 'rate'
+    records per second are passed per message (format string).  The count
+    of the records suppressed since is added to the next record passed.
+    """
+    def __init__(self, logger, rate=None):
+        """
+        :param logger: logger to log to
+        :param rate: records per second per message (LOG_SAMPLE_RATE if
+                     not given; 0 passes every record)
+        """
+        self._logger = logger
+        self._rate = int(PARAMS['LOG_SAMPLE_RATE'] if rate is None else rate)
+        self._lock = threading.Lock()
+        self._sites = {}            # message -> [window start, passed, suppressed]
+        super().__init__()
+
+    def _log(self, level, msg, args):
+        if not self._logger.isEnabledFor(level):
+            return
+        suppressed = 0
+        if self._rate:
+            now = time.monotonic()
+            with self._lock:
+                site = self._sites.get(msg)
+                if site is None:
+                    site = self._sites[msg] = [now, 0, 0]
+                elif now - site[0] >= 1.0:
+                    site[0] = now
+                    site[1] = 0
+                if site[1] >= self._rate:
+                    site[2] += 1
+                    SUPPRESSED.inc()
+                    return
+                site[1] += 1
+                suppressed, site[2] = site[2], 0
+        if suppressed:
+            self._logger.log(level, msg + " (%d similar suppressed)",
+                             *(args + (suppressed,)),
+                             extra={'suppressed': suppressed}, stacklevel=3)
+        else:
+            self._logger.log(level, msg, *args, stacklevel=3)
+
+    def debug(self, msg, *args):
+        """
+        Log a DEBUG message (if not over the rate).
+        """
+        self._log(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        """
+        Log an INFO message (if not over the rate).
+        """
+        self._log(logging.INFO, msg, args)
+
+
+LOGGER = logging.getLogger(APPNAME)
@@ -0,0 +1,255 @@
+"""
+T-Mobile PCF team CloudFoundry 'cf-stats' metrics.
+
+Counters and histograms reported in the Prometheus text exposition format.
+Updates are made on per-thread shards (no lock is taken when a value is
+updated); the shards are summed when the metrics are collected.  Shards of
+threads which have exited are folded into a retired total.
+
+Also per-request phase timing: the time spent in each phase (db, enrich,
+serialize) of the request being handled by the current thread.
+
+Note(s):
+    1. Requires Python 3
+    2. Metrics are per process: with the production (multi-worker) server
+       each worker reports its own values
+"""
+import bisect
+import contextlib
+import threading
+import time
+import weakref
+from collections import OrderedDict, defaultdict
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _ShardedValues(object):
+    """
+    A mapping of keys to numbers, updated on per-thread shards.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []           # (weakref to thread, shard dict)
+        self._retired = defaultdict(float)
+        super().__init__()
+
+    def add(self, key, amount):
+        """
+        Add to the value of a key (on this thread's shard).
+        """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = defaultdict(float)
+            with self._lock:
+                self._shards.append((weakref.ref(threading.current_thread()),
+                                     shard))
+        shard[key] += amount
+
+    def collect(self):
+        """
+        Sum the shards.
+
+        :return: dict of key to total value
+        """
+        totals = defaultdict(float)
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                alive = thread() is not None and thread().is_alive()
+                target = totals if alive else self._retired
+                for key, val in shard.copy().items():
+                    target[key] += val
+                if alive:
+                    live.append((thread, shard))
+            self._shards = live
+            for key, val in self._retired.items():
+                totals[key] += val
+        return totals
+
+
+def _format_labels(names, values, extra=()):
+    """
+    Format a Prometheus label set.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for name, val in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Counter(object):
+    """
+    A monotonically increasing counter (per label values).
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = _ShardedValues()
+        super().__init__()
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increment the counter.
+
+        :param labels: tuple of label values (in the order of 'labels')
+        :param amount: amount to add
+        """
+        self._values.add(tuple(labels), amount)
+
+    def samples(self):
+        """
+        :return: list of (sample name, label string, value)
+        """
+        return [(self.name, _format_labels(self.labels, key), val)
+                for key, val in sorted(self._values.collect().items())]
+
+
+class Histogram(object):
+    """
+    A histogram of observed values (per label values).
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = _ShardedValues()
+        super().__init__()
+
+    def observe(self, value, labels=()):
+        """
+        Record an observation.
+
+        :param value: observed value
+        :param labels: tuple of label values (in the order of 'labels')
+        """
+        labels = tuple(labels)
+        self._values.add((labels, bisect.bisect_left(self.buckets, value)), 1)
+        self._values.add((labels, 'sum'), value)
+
+    def samples(self):
+        """
+        :return: list of (sample name, label string, value)
+        """
+        values = self._values.collect()
+        series = sorted(set(key[0] for key in values))
+        samples = []
+        for labels in series:
+            count = 0
+            for index, bound in enumerate(self.buckets + (float('inf'),)):
+                count += values.get((labels, index), 0)
+                samples.append(('{}_bucket'.format(self.name),
+                                _format_labels(self.labels, labels,
+                                               [('le', '+Inf' if index == len(self.buckets)
+                                                 else repr(bound))]),
+                                count))
+            samples.append(('{}_sum'.format(self.name),
+                            _format_labels(self.labels, labels),
+                            values.get((labels, 'sum'), 0)))
+            samples.append(('{}_count'.format(self.name),
+                            _format_labels(self.labels, labels), count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    The set of metrics reported by the service.
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        super().__init__()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labels=()):
+        """
+        Get (create if need be) a counter.
+        """
+        return self._register(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Get (create if need be) a histogram.
+        """
+        return self._register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        """
+        Report all metrics in the Prometheus text exposition format.
+
+        :return: str
+        """
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            lines.extend('{}{} {}'.format(name, labels, _format_value(value))
+                         for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+_timing = threading.local()
+
+
+def start_timing():
+    """
+    Start timing the phases of the current thread's request.
+    """
+    _timing.phases = OrderedDict()
+
+
+def stop_timing():
+    """
+    Stop timing the current thread's request.
+
+    :return: OrderedDict of phase name to seconds (None if not started)
+    """
+    phases = getattr(_timing, 'phases', None)
+    _timing.phases = None
+    return phases
+
+
+def add_timing(phase, seconds):
+    """
+    Add time to a phase of the current thread's request (ignored if the
+    request is not being timed).
+
+    :param phase: phase name
+    :param seconds: time spent
+    """
+    phases = getattr(_timing, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + seconds
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """
+    Context manager: add the time spent in the block to a phase.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(phase, time.perf_counter() - start)
@@ -1,11 +1,54 @@
 """
 foundrystats application-wide parameters
+
+The parameters are read from the environment when this module is imported.
+Importing it has no other effect: missing required parameters are only
+reported when the application checks for them (check_required).
 """
 import os
 
-DEFAULT_LOG_LEVEL = 'DEBUG'
+import excepts as exc
+
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_LEVELS = ''
+DEFAULT_LOG_FORMAT = 'text'
+DEFAULT_LOG_ASYNC = True
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DEFAULT_LOG_SAMPLE_RATE = 10
 DEFAULT_TOOL_PORT = 8080
 DEFAULT_BB_REQUEST_TIME_LIMIT = 10
+DEFAULT_BB_REFRESH_INTERVAL = 60
+DEFAULT_BB_HTTP_RETRIES = 3
+DEFAULT_DB_POOL_MIN_SIZE = 1
+DEFAULT_DB_POOL_MAX_SIZE = 10
+DEFAULT_DB_POOL_TIMEOUT = 5
+DEFAULT_DB_POOL_PING_INTERVAL = 30
+DEFAULT_DB_FETCH_BATCH_SIZE = 1000
+DEFAULT_DB_PREPARED_STATEMENTS = True
+DEFAULT_DB_STATEMENT_CACHE_SIZE = 64
+DEFAULT_REPLICA_ENABLED = False
+DEFAULT_APP_QUERY_STRATEGY = 'join'
+DEFAULT_REPLICA_REFRESH_INTERVAL = 60
+DEFAULT_DELTA_REFRESH_INTERVAL = 60
+DEFAULT_DELTA_LOG_SIZE = 100000
+DEFAULT_SERVER_MODE = 'production'
+DEFAULT_ETAG_ENABLED = True
+DEFAULT_COMPRESS_ENABLED = True
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+DEFAULT_SERVER_TIMING = True
+DEFAULT_DATA_VERSION_TTL = 5
+DEFAULT_SERVER_WORKERS = 0
+DEFAULT_SERVER_THREADS = 4
+DEFAULT_SERVER_MAX_REQUESTS = 1000
+DEFAULT_SERVER_MAX_REQUESTS_JITTER = 100
+DEFAULT_SERVER_TIMEOUT = 120
+DEFAULT_SERVER_GRACEFUL_TIMEOUT = 30
+DEFAULT_WARMUP_RETRY_INTERVAL = 30
+DEFAULT_COALESCE_ENABLED = True
+DEFAULT_BATCH_MAX_REQUESTS = 20
+DEFAULT_BATCH_WORKERS = 4
+DEFAULT_ROW_RECORDS = False
 
 
 class SysParams(object):
@@ -20,27 +63,72 @@ class SysParams(object):
 
     _overridable = {
         'LOG_LEVEL': DEFAULT_LOG_LEVEL,
+        'LOG_LEVELS': DEFAULT_LOG_LEVELS,
+        'LOG_FORMAT': DEFAULT_LOG_FORMAT,
+        'LOG_ASYNC': DEFAULT_LOG_ASYNC,
+        'LOG_QUEUE_SIZE': DEFAULT_LOG_QUEUE_SIZE,
+        'LOG_SAMPLE_RATE': DEFAULT_LOG_SAMPLE_RATE,
         'STATS_PORT': DEFAULT_TOOL_PORT,
         'CF_URL': None,
         'BB_REQUEST_TIME_LIMIT': DEFAULT_BB_REQUEST_TIME_LIMIT,
+        'BB_REFRESH_INTERVAL': DEFAULT_BB_REFRESH_INTERVAL,
+        'BB_HTTP_RETRIES': DEFAULT_BB_HTTP_RETRIES,
+        'DB_POOL_MIN_SIZE': DEFAULT_DB_POOL_MIN_SIZE,
+        'DB_POOL_MAX_SIZE': DEFAULT_DB_POOL_MAX_SIZE,
+        'DB_POOL_TIMEOUT': DEFAULT_DB_POOL_TIMEOUT,
+        'DB_POOL_PING_INTERVAL': DEFAULT_DB_POOL_PING_INTERVAL,
+        'DB_FETCH_BATCH_SIZE': DEFAULT_DB_FETCH_BATCH_SIZE,
+        'DB_PREPARED_STATEMENTS': DEFAULT_DB_PREPARED_STATEMENTS,
+        'DB_STATEMENT_CACHE_SIZE': DEFAULT_DB_STATEMENT_CACHE_SIZE,
+        'REPLICA_ENABLED': DEFAULT_REPLICA_ENABLED,
+        'APP_QUERY_STRATEGY': DEFAULT_APP_QUERY_STRATEGY,
+        'REPLICA_REFRESH_INTERVAL': DEFAULT_REPLICA_REFRESH_INTERVAL,
+        'DELTA_REFRESH_INTERVAL': DEFAULT_DELTA_REFRESH_INTERVAL,
+        'DELTA_LOG_SIZE': DEFAULT_DELTA_LOG_SIZE,
+        'SERVER_MODE': DEFAULT_SERVER_MODE,
+        'ETAG_ENABLED': DEFAULT_ETAG_ENABLED,
+        'COMPRESS_ENABLED': DEFAULT_COMPRESS_ENABLED,
+        'COMPRESS_LEVEL': DEFAULT_COMPRESS_LEVEL,
+        'COMPRESS_MIN_SIZE': DEFAULT_COMPRESS_MIN_SIZE,
+        'SERVER_TIMING': DEFAULT_SERVER_TIMING,
+        'PROFILE_TOKEN': None,
+        'DATA_VERSION_TTL': DEFAULT_DATA_VERSION_TTL,
+        'SERVER_WORKERS': DEFAULT_SERVER_WORKERS,
+        'SERVER_THREADS': DEFAULT_SERVER_THREADS,
+        'SERVER_MAX_REQUESTS': DEFAULT_SERVER_MAX_REQUESTS,
+        'SERVER_MAX_REQUESTS_JITTER': DEFAULT_SERVER_MAX_REQUESTS_JITTER,
+        'SERVER_TIMEOUT': DEFAULT_SERVER_TIMEOUT,
+        'SERVER_GRACEFUL_TIMEOUT': DEFAULT_SERVER_GRACEFUL_TIMEOUT,
+        'WARMUP_RETRY_INTERVAL': DEFAULT_WARMUP_RETRY_INTERVAL,
+        'COALESCE_ENABLED': DEFAULT_COALESCE_ENABLED,
+        'BATCH_MAX_REQUESTS': DEFAULT_BATCH_MAX_REQUESTS,
+        'BATCH_WORKERS': DEFAULT_BATCH_WORKERS,
+        'ROW_RECORDS': DEFAULT_ROW_RECORDS,
     }
 
     def __init__(self):
-        #  Get required environment variables, fail if any are missing.
-        missing = []
+        #  Get required environment variables, note any that are missing.
+        self.missing = []
         for key in self._required_env:
             try:
                 self.__params[key] = os.environ[key]
             except KeyError:
-                missing.append(key)
-        if missing:
-            print("ERROR: missing environment variable(s): {}".format(missing))
-            exit(1)
+                self.missing.append(key)
 
         #  Get optional/overridable environment variables
         self.__params.update({key: os.getenv(key, val) for
                               key, val in self._overridable.items()})
 
+    def check_required(self):
+        """
+        Check that all required environment variables are set.
+
+        :raise MissingParameter: if any is missing
+        """
+        if self.missing:
+            raise exc.MissingParameter("Missing environment variable(s): {}".format(
+                ', '.join(self.missing)))
+
     @property
     def params(self):
         """
@@ -49,4 +137,5 @@ class SysParams(object):
         return self.__params
 
 
-PARAMS = SysParams().params
+SYS_PARAMS = SysParams()
+PARAMS = SYS_PARAMS.params
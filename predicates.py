@@ -0,0 +1,151 @@
+"""
+T-Mobile PCF team CloudFoundry 'cf-stats' filter expressions.
+
+A 'where' request filter selects the results by a predicate on one of their
+fields: <field><operator><value>, for example
+
+    memory>2048     instances>=3     state=STARTED
+    org_name^=px-   space_name=dev|test    buildpack!=java_buildpack
+
+The operators are =, != (a '|' separated list of values is a match of any
+one), <, <=, >, >= and ^= (prefix match; '|' separated prefixes are a match
+of any one).  Several 'where' filters must all match.  Predicates are
+compiled to parameterized SQL conditions on the table columns behind the
+fields (so that they are answered by the database, with its indexes), or
+to a row matching function for the table replica.
+
+Note(s):
+    1. Requires Python 3
+    2. Values of numeric columns (see the tables' numeric_columns) are
+       compared as numbers, other values as (case insensitive) strings, as
+       with the default MySQL collation.  A NULL (missing) value matches no
+       predicate
+"""
+import re
+
+# longest operators first, so that '>=' is not read as '>' '=...'
+_PREDICATE = re.compile(r'^\s*(\w+)\s*(>=|<=|!=|\^=|=|>|<)\s*(.*?)\s*$')
+_SQL_OPERATORS = {'=': '=', '!=': '<>', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+# LIKE escape character ('\' is not portable: MySQL string literals use it)
+_LIKE_ESCAPE = '!'
+
+
+class InvalidPredicate(ValueError):
+    """
+    A 'where' filter is not a valid predicate on a known field.
+    """
+
+
+def _like_prefix(prefix):
+    """
+    Escape a prefix for a LIKE pattern matching the strings starting with it.
+    """
+    for char in (_LIKE_ESCAPE, '%', '_'):
+        prefix = prefix.replace(char, _LIKE_ESCAPE + char)
+    return prefix + '%'
+
+
+class Predicate(object):
+    """
+    A predicate on a result field: field, operator and value(s).
+    """
+    def __init__(self, field, operator, values, column, numeric=False):
+        """
+        :param field: result field name
+        :param operator: one of =, !=, <, <=, >, >=, ^=
+        :param values: list of values (numbers for numeric columns)
+        :param column: source column ("alias.column")
+        :param numeric: compare as numbers
+        """
+        self.field = field
+        self.operator = operator
+        self.values = values
+        self.column = column
+        self.numeric = numeric
+        super().__init__()
+
+    def sql(self, params):
+        """
+        Build the SQL condition, appending its values to the query
+        parameter list.
+
+        :param params: query parameter list (appended to)
+        :return: condition string
+        """
+        if self.operator == '^=':
+            params.extend(_like_prefix(val) for val in self.values)
+            cond = ' OR '.join("{} LIKE %s ESCAPE '{}'".format(self.column, _LIKE_ESCAPE)
+                               for _ in self.values)
+            return '({})'.format(cond) if len(self.values) > 1 else cond
+        params.extend(self.values)
+        if len(self.values) > 1:
+            return '{} {}IN ({})'.format(self.column,
+                                         'NOT ' if self.operator == '!=' else '',
+                                         ','.join(['%s'] * len(self.values)))
+        return '{} {} %s'.format(self.column, _SQL_OPERATORS[self.operator])
+
+    def matches(self, value):
+        """
+        Check a value against the predicate.
+
+        :param value: the field value (None if NULL)
+        :return: True if the predicate holds
+        """
+        if value is None:
+            return False
+        if self.numeric:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return False
+        else:
+            value = str(value).lower()
+        if self.operator == '^=':
+            return any(value.startswith(val) for val in self.values)
+        if self.operator == '=':
+            return value in self.values
+        if self.operator == '!=':
+            return value not in self.values
+        val = self.values[0]
+        return {'<': value < val, '<=': value <= val,
+                '>': value > val, '>=': value >= val}[self.operator]
+
+
+def parse_predicates(texts, columns, numeric_columns=()):
+    """
+    Parse 'where' filters.
+
+    :param texts: list of predicate strings
+    :param columns: dict of the fields which may be filtered on to their
+                    source columns ("alias.column")
+    :param numeric_columns: set of the source columns holding numbers
+    :return: list of Predicate objects
+    :raise InvalidPredicate: if a predicate cannot be parsed, names an
+                             unknown field or compares a number to text
+    """
+    predicates = []
+    for text in texts:
+        match = _PREDICATE.match(text)
+        if not match:
+            raise InvalidPredicate("Invalid 'where' filter: {}".format(text))
+        field, operator, value = match.groups()
+        field = field.lower()
+        if field not in columns:
+            raise InvalidPredicate("Cannot filter on '{}' (one of: {})".format(
+                field, ', '.join(sorted(columns))))
+        column = columns[field]
+        numeric = column in numeric_columns
+        values = value.split('|') if operator in ('=', '!=', '^=') else [value]
+        if numeric:
+            if operator == '^=':
+                raise InvalidPredicate("'^=' is for text fields: {}".format(text))
+            try:
+                values = [float(val) for val in values]
+            except ValueError:
+                raise InvalidPredicate("'{}' is a number: {}".format(field, text)) \
+                    from None
+            values = [int(val) if val.is_integer() else val for val in values]
+        else:
+            values = [val.lower() for val in values]
+        predicates.append(Predicate(field, operator, values, column, numeric))
+    return predicates
@@ -0,0 +1,177 @@
+"""
+T-Mobile PCF team CloudFoundry 'cf-stats' query row decoders and records.
+
+A RowDecoder converts the rows (tuples) of one query to result rows.  It is
+compiled once per query: the positions of the columns kept are resolved
+up front, the columns dropped (see 'discard') are never copied and the
+fields which are the same in every row (e.g. the foundation) are added in
+the same step, so decoding a row is a single call.
+
+Result rows are dicts or, with the ROW_RECORDS parameter, records: objects
+with a __slots__ attribute per field (no per-row dict), their types derived
+from the query columns (see record_type).  Records are read-only mappings
+(fields may be set, but not added or removed), so that code reading result
+rows works with either; the serializers write them without converting them
+to dicts.
+
+Note(s):
+    1. Requires Python 3
+    2. The row decoders do not check the length of each row: the agent
+       builds the query select list and the decoder columns from the same
+       field list
+"""
+import functools
+from collections.abc import Mapping
+from operator import attrgetter, itemgetter
+
+
+def _values_getter(names):
+    """
+    Get a function returning the values of the named attributes as a
+    tuple (attrgetter returns a single value rather than a 1-tuple).
+    """
+    if len(names) == 1:
+        get = attrgetter(names[0])
+        return lambda obj: (get(obj),)
+    return attrgetter(*names)
+
+
+class Record(Mapping):
+    """
+    Base record type: a mapping of a fixed set of fields to their values.
+    Record types are made by record_type.
+    """
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(name, getattr(self, name))
+                                         for name in self._fields))
+
+    def _values(self):
+        """
+        The field values, in field order.
+        """
+        raise NotImplementedError
+
+    def _asdict(self):
+        """
+        The record as a dict.
+        """
+        return dict(zip(self._fields, self._values()))
+
+
+@functools.lru_cache(maxsize=256)
+def record_type(name, fields):
+    """
+    Make (or get the already made) record type with the given fields.
+
+    :param name: type name (the agent names them after the table queried,
+                 see tables.py, e.g. 'CFSpacesRecord')
+    :param fields: tuple of field names (identifiers); the constructor
+                   takes their values as arguments, in order, all of them
+                   defaulting to None
+    :return: Record subclass
+    """
+    for field in fields:
+        if not field.isidentifier() or field.startswith('_'):
+            raise ValueError("Invalid record field name: {}".format(field))
+    # (generated, as namedtuple does, to set every slot in one call)
+    args = ', '.join('_{}=None'.format(pos) for pos in range(len(fields)))
+    body = ''.join('\n    self.{} = _{}'.format(field, pos)
+                   for pos, field in enumerate(fields)) or '\n    pass'
+    namespace = {}
+    exec('def __init__(self{}):{}'.format(', ' + args if args else '', body),  # pylint: disable=exec-used
+         namespace)
+    get_values = _values_getter(fields) if fields else lambda _: ()
+
+    def _values(self):
+        return get_values(self)
+
+    return type(name, (Record,), {'__slots__': tuple(fields),
+                                  '_fields': tuple(fields),
+                                  '_field_set': frozenset(fields),
+                                  '__init__': namespace['__init__'],
+                                  '_values': _values})
+
+
+class RowDecoder(object):
+    """
+    Query row decoder, compiled for one query's columns.
+    """
+    def __init__(self, columns, discard=None, constants=None, extra=(),
+                 record_name=None):
+        """
+        :param columns: column (result field) names of the query rows, in
+                        row order
+        :param discard: names of the columns and constants not wanted in
+                        the result rows (or None)
+        :param constants: dict of fields with the same value in every row,
+                          added to each after its columns
+        :param extra: names of fields the caller sets on each row after
+                      decoding (records declare them, set to None)
+        :param record_name: if given produce records (of a type of this
+                            name) rather than dicts
+        """
+        discard = set(discard or ())
+        positions = [pos for pos, col in enumerate(columns) if col not in discard]
+        self.fields = tuple(columns[pos] for pos in positions)
+        constants = {name: value for name, value in (constants or {}).items()
+                     if name not in discard}
+
+        if len(positions) == len(columns):
+            get_values = None
+        elif not positions:
+            # (only fields which are not columns wanted, e.g. the director)
+            get_values = lambda row: ()
+        elif len(positions) == 1:
+            pos = positions[0]
+            get_values = lambda row: (row[pos],)
+        else:
+            get_values = itemgetter(*positions)
+
+        fields = self.fields
+        if record_name:
+            self.record_type = record_type(record_name, fields + tuple(constants)
+                                           + tuple(extra))
+            make = self.record_type
+            const_values = tuple(constants.values())
+            if get_values is None:
+                self.decode = lambda row: make(*row, *const_values)
+            else:
+                self.decode = lambda row: make(*get_values(row), *const_values)
+        else:
+            self.record_type = None
+            if get_values is None:
+                self.decode = lambda row: dict(zip(fields, row), **constants)
+            else:
+                self.decode = lambda row: dict(zip(fields, get_values(row)),
+                                               **constants)
+        super().__init__()
+
+    def decode_rows(self, rows):
+        """
+        Generator: decode query rows.
+
+        :param rows: iterable of query rows
+        :return: (generator) result rows
+        """
+        yield from map(self.decode, rows)
@@ -0,0 +1,244 @@
+"""
+T-Mobile PCF team CloudFoundry 'cf-stats' in-memory table replica.
+
+The fetcher tables only change when the fetcher writes them, so rather than
+re-running SQL for every request the agent may answer queries from an
+in-memory copy of the tables.  Each replicated table is indexed by guid,
+by lower-cased name and by the columns the agent joins on.  The replica is
+reloaded periodically by a background thread and the new copy is swapped
+in as a whole, so readers always see a consistent snapshot.
+
+Note(s):
+    1. Requires Python 3
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from logger import module_logger
+from tables import (CFApps, CFServiceBindings, CFServices, CFSpaces,
+                    CFOrganizations, CFRouteMapping, CFRoutes, CFDomains)
+
+LOGGER = module_logger(__name__)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# replicated tables and the (join) columns to index each one on
+REPLICATED_TABLES = [(CFApps, ('spaceGUID',)),
+                     (CFServiceBindings, ('appGUID', 'serviceInstanceGUID')),
+                     (CFServices, ('spaceGUID',)),
+                     (CFSpaces, ('organizationGUID',)),
+                     (CFOrganizations, ()),
+                     (CFRouteMapping, ('appGUID',)),
+                     (CFRoutes, ()),
+                     (CFDomains, ()),
+                    ]
+
+
+class TableReplica(object):
+    """
+    In-memory copy of one table: rows (dicts) ordered by guid, plus
+    hash indexes on guid, lower-cased name and any requested columns.
+    """
+    def __init__(self, table, rows, index_columns=()):
+        """
+        Build the table copy and its indexes.
+
+        :param table: table object (from tables.py) the rows belong to
+        :param rows: iterable of row dicts
+        :param index_columns: columns to build (non-unique) indexes on
+        """
+        self.name = table.name
+        self.columns = table.columns
+        self.rows = sorted(rows, key=lambda row: row.get('guid') or '')
+        self._guids = [row.get('guid') or '' for row in self.rows]
+        self.by_guid = {}
+        self.by_name = defaultdict(list)
+        self._indexes = {col: defaultdict(list) for col in index_columns}
+        for row in self.rows:
+            if row.get('guid') is not None:
+                self.by_guid[row['guid']] = row
+            if row.get('name') is not None:
+                self.by_name[row['name'].lower()].append(row)
+            for col, index in self._indexes.items():
+                index[row.get(col)].append(row)
+        super().__init__()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, guid):
+        """
+        Look up a single row by guid.
+
+        :param guid: the guid to look up (may be None)
+        :return: row dict, or an empty dict if not found
+        """
+        return self.by_guid.get(guid, {})
+
+    def index(self, column, value):
+        """
+        Look up the rows with the given value in an indexed column.
+
+        :param column: indexed column name
+        :param value: column value to match
+        :return: list of row dicts
+        """
+        return self._indexes[column].get(value, [])
+
+    def lookup(self, guids=None, names=None, column=None, values=None,
+               after=None):
+        """
+        Select rows matching any of the given guids, or names (case
+        insensitive), or values of an indexed column.  With no criteria
+        all rows are returned.  Rows are returned in guid order.
+
+        :param guids: list of guids
+        :param names: list of names
+        :param column: indexed column name to match 'values' against
+        :param values: list of column values
+        :param after: only return rows with a guid greater than this
+        :return: list of row dicts
+        """
+        if not (guids or names or (column and values)):
+            if after is None:
+                return self.rows
+            return self.rows[bisect.bisect_right(self._guids, after):]
+
+        if guids:
+            found = [self.by_guid[guid] for guid in set(guids)
+                     if guid in self.by_guid]
+        elif names:
+            found = [row for name in set(nm.lower() for nm in names)
+                     for row in self.by_name.get(name, [])]
+        else:
+            found = [row for value in set(values)
+                     for row in self.index(column, value)]
+        if after is not None:
+            found = [row for row in found if (row.get('guid') or '') > after]
+        return sorted(found, key=lambda row: row.get('guid') or '')
+
+
+class StatsReplica(object):
+    """
+    A periodically refreshed, in-memory replica of the fetcher tables.
+    """
+    def __init__(self, stats_db, refresh_interval=60):
+        """
+        Initialize the replica.  Nothing is loaded until 'start' or
+        'refresh' is called.
+
+        :param stats_db: StatsDB object to load tables from
+        :param refresh_interval: seconds between reloads
+        """
+        self._db = stats_db
+        self._refresh_interval = refresh_interval
+        self._tables = None
+        self._generation = 0
+        self._loaded_at = None
+        self._load_secs = None
+        self._failures = 0
+        self._stop = threading.Event()
+        self._thread = None
+        super().__init__()
+
+    @property
+    def ready(self):
+        """
+        True once the replica has been loaded.
+        """
+        return self._tables is not None
+
+    def table(self, table):
+        """
+        Get the current copy of a table.
+
+        :param table: table object (from tables.py)
+        :return: TableReplica, or None if the replica is not loaded
+        """
+        tables = self._tables
+        return tables[table.name] if tables else None
+
+    def snapshot(self):
+        """
+        Get the current copy of all tables.  The returned mapping is never
+        modified, so callers joining several tables see a consistent view.
+
+        :return: dict of table name to TableReplica, or None if not loaded
+        """
+        return self._tables
+
+    @property
+    def version(self):
+        """
+        Version of the replica contents: changes each time it is reloaded
+        (None if not loaded).
+        """
+        return self._generation if self.ready else None
+
+    def refresh(self):
+        """
+        Reload every replicated table and swap the new copy in.
+        """
+        LOGGER.debug("Refreshing table replica")
+        start = time.monotonic()
+        tables = {}
+        for table, index_columns in REPLICATED_TABLES:
+            rows = self._db.select(table, table.columns, stream=True)
+            tables[table.name] = TableReplica(table, rows, index_columns)
+        self._tables = tables
+        self._generation += 1
+        self._loaded_at = datetime.now().strftime(DATE_FORMAT)
+        self._load_secs = round(time.monotonic() - start, 3)
+        LOGGER.info("Table replica loaded in %ss (%s)", self._load_secs,
+                    ', '.join('{} {}'.format(name, len(tbl))
+                              for name, tbl in tables.items()))
+
+    def _run(self):
+        """
+        Background thread: refresh the replica every refresh interval.
+        """
+        if self.ready:
+            self._stop.wait(self._refresh_interval)
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as exn:        # pylint: disable=broad-except
+                self._failures += 1
+                LOGGER.error("Table replica refresh failed: %s", exn)
+            self._stop.wait(self._refresh_interval)
+
+    def start(self):
+        """
+        Start the background refresh thread (the first load happens
+        immediately, in the background, unless the replica is loaded).
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        LOGGER.debug("Starting table replica refresh thread")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='replica',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background refresh thread.
+        """
+        self._stop.set()
+
+    @property
+    def stats(self):
+        """
+        Replica state: load time, duration, failures and table sizes.
+        """
+        tables = self._tables or {}
+        return {'ready': self.ready,
+                'loaded_at': self._loaded_at,
+                'load_secs': self._load_secs,
+                'refresh_interval': self._refresh_interval,
+                'failures': self._failures,
+                'rows': {name: len(tbl) for name, tbl in tables.items()},
+               }
@@ -4,29 +4,129 @@ T-Mobile PCF team generic REST object.
 Note(s):
     1. Requires Python 3
     2. For Flask API see: http://flask.pocoo.org/docs/0.11/api
+    3. The 'production' server mode requires gunicorn (Unix only)
+    4. Brotli and zstd response compression are used if the 'brotli' and
+       'zstandard' packages are installed
 """
+import cProfile
+import hashlib
+import hmac
+import io
+import pstats
 import threading
+import time
+import types
+import zlib
 from datetime import datetime
 from sortedcontainers import SortedDict
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 
-from logger import LOGGER
+from logger import module_logger
+from metrics import METRICS, start_timing, stop_timing, timed
+from records import Record
+from serializers import SERIALIZERS, JSONProvider
 from excepts import AlreadyRegistered, NoSuchEndpoint, CannotUnregister
 
+LOGGER = module_logger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+STREAM_CHUNK_SIZE = 64 * 1024
+SERVER_MODES = ('development', 'production')
+PROFILE_TOP_FUNCTIONS = 40
+
+REQUESTS = METRICS.counter('cfstats_http_requests_total',
+                           'HTTP requests by endpoint and status',
+                           ['endpoint', 'status'])
+REQUEST_SECONDS = METRICS.histogram('cfstats_http_request_seconds',
+                                    'HTTP request latency by endpoint '
+                                    '(streamed responses: until fully sent)',
+                                    ['endpoint'])
+RESPONSE_BYTES = METRICS.counter('cfstats_http_response_bytes_total',
+                                 'HTTP response body bytes by endpoint',
+                                 ['endpoint'])
+
+
+class _GzipStream(object):
+    """
+    Incremental gzip compressor.
+    """
+    def __init__(self, level):
+        self._zobj = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data):
+        return self._zobj.compress(data)
+
+    def flush(self):
+        return self._zobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._zobj.flush()
+
+
+class _BrotliStream(object):
+    """
+    Incremental brotli compressor.
+    """
+    def __init__(self, level):
+        self._cobj = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self._cobj.process(data)
+
+    def flush(self):
+        return self._cobj.flush()
+
+    def finish(self):
+        return self._cobj.finish()
+
+
+class _ZstdStream(object):
+    """
+    Incremental zstd compressor.
+    """
+    def __init__(self, level):
+        self._cobj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._cobj.compress(data)
+
+    def flush(self):
+        return self._cobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._cobj.flush()
+
+
+# content codings supported, in order of preference
+COMPRESSORS = [(name, compressor) for name, compressor, available in
+               [('br', _BrotliStream, brotli is not None),
+                ('zstd', _ZstdStream, zstandard is not None),
+                ('gzip', _GzipStream, True)]
+               if available]
 
 class Endpoint(object):
     """
     Constructor for defining REST endpoint(s).
     """
-    def __init__(self, name, description, handler, filters=None):
+    def __init__(self, name, description, handler, filters=None, methods=None):
         """
-        Setup the endpoint object internal variables.
+        Setup the endpoint object internal variables.  Endpoints answer GET
+        requests, and the other HTTP 'methods' given (e.g. ['POST']).
         """
         self._name = name
         self._handler = handler
         self._filters = filters
+        self._methods = tuple(methods or ('GET',))
         self._descr = description
         if filters:
             filter_str = "(filter(s): {})".format(', '.join(filters))
@@ -54,6 +154,13 @@ class Endpoint(object):
         """
         return self._handler
 
+    @property
+    def methods(self):
+        """
+        HTTP methods the endpoint answers.
+        """
+        return self._methods
+
 
 class RESTObject(object):
     """
@@ -63,6 +170,14 @@ class RESTObject(object):
     """
     _commands = {}
     _flaskapp = None
+    # response compression: enabled, level and minimum (unstreamed) size
+    compress = True
+    compress_level = 6
+    compress_min_size = 1024
+    # add a Server-Timing header; token required for '?profile=true' (if None
+    # profiling is disabled)
+    server_timing = True
+    profile_token = None
 
     def __init__(self, port=None, service_name=None, autostart=False,
                  name='endpoints'):
@@ -79,6 +194,9 @@ class RESTObject(object):
         self._default_epoint_names = [ep.name for ep in self._default_endpoints]
 
         LOGGER.debug("Creating RESTObject")
+        self._commands = {}
+        # endpoints answering methods other than GET: name -> methods
+        self._other_methods = {}
         self._service_name = service_name
         self._flask_port = port
         self._host_ip = '0.0.0.0'
@@ -90,11 +208,15 @@ class RESTObject(object):
 
         # See: http://flask.pocoo.org/docs/0.11/api/#url-route-registrations
         self._flaskapp = Flask(__name__)
+        # (result rows may be records, see records.py)
+        self._flaskapp.json = JSONProvider(self._flaskapp)
         LOGGER.debug("RESTObject adding flask rules")
         self._flaskapp.add_url_rule('/', view_func=self._service_request,
                                     defaults={'rest_request': '__empty'})
         self._flaskapp.add_url_rule('/<rest_request>',
                                     view_func=self._service_request)
+        for epoint_name, methods in self._other_methods.items():
+            self._add_method_rule(epoint_name, methods)
         if autostart:
             LOGGER.debug("RESTObject create thread object")
             self._flask_thread = threading.Thread(target=self.start,
@@ -103,9 +225,25 @@ class RESTObject(object):
             LOGGER.debug("RESTObject starting background thread and flask app")
             self._flask_thread.start()
 
+    @property
+    def wsgi_app(self):
+        """
+        The WSGI application serving the registered endpoints.
+        """
+        return self._flaskapp
+
+    def shutdown(self):
+        """
+        Release resources (background threads, connections) on shutdown.
+        Inheriting (child) classes may override this; it is called when
+        a production server worker exits.
+        """
+        pass
+
     def start(self, *args, **kwargs):
         """
-        Run the flask thread.
+        Run the flask thread (the Werkzeug development server).  See
+        serve_production for running with multiple worker processes.
         """
         hostaddr = kwargs.get('host', self._host_ip)
         portnum = kwargs.get('port', self._flask_port)
@@ -128,6 +266,22 @@ class RESTObject(object):
 
         LOGGER.debug("RESTObject register endpoint %s", endpoint.name)
         self._commands[endpoint.name] = (endpoint.description, endpoint.handler)
+        methods = [method for method in endpoint.methods if method != 'GET']
+        if methods:
+            self._other_methods[endpoint.name] = methods
+            if self._flaskapp is not None:
+                self._add_method_rule(endpoint.name, methods)
+
+    def _add_method_rule(self, epoint_name, methods):
+        """
+        Add the flask rule routing the methods other than GET of one
+        endpoint (only GET is routed to every endpoint).
+        """
+        self._flaskapp.add_url_rule('/{}'.format(epoint_name),
+                                    endpoint='{}_{}'.format(epoint_name, '_'.join(methods)),
+                                    view_func=self._service_request,
+                                    defaults={'rest_request': epoint_name},
+                                    methods=methods)
 
     def unregister_endpoint_by_name(self, endpoint_name):
         """
@@ -155,8 +309,19 @@ class RESTObject(object):
                    }
         if hasattr(self, 'version'):
             rtn_dict['version'] = self.version
+        rtn_dict.update(self._state_info())
         return jsonify(rtn_dict)
 
+    def _state_info(self):
+        """
+        Additional service state reported by the 'state' endpoint.
+        Inheriting (child) classes may override this to add their own
+        state items.
+
+        :return: dict of state items
+        """
+        return {}
+
     def _cmd_show_all(self, *args):  #  pylint: disable=unused-argument
         """
         command: show all registered commands.
@@ -169,6 +334,194 @@ class RESTObject(object):
                 showlist[sublabel][epoint] = val[0]
         return jsonify(showlist)
 
+    def _data_version(self, rest_request):  #  pylint: disable=unused-argument
+        """
+        Version of the data behind an endpoint, used to compute its ETag.
+        Inheriting (child) classes may override this; endpoints for which
+        None is returned (the default) get no ETag.
+
+        :param rest_request: endpoint name
+        :return: version string or None
+        """
+        return None
+
+    @staticmethod
+    def make_etag(version, rest_request, args, accept=''):
+        """
+        Compute the (strong) ETag of a response from the data version, the
+        endpoint and the normalized request arguments (lower case keys, in
+        sorted order, so equivalent queries share an ETag).
+
+        :param version: data version string
+        :param rest_request: endpoint name
+        :param args: request arguments (MultiDict)
+        :param accept: request Accept header (it selects the format)
+        :return: ETag string (unquoted)
+        """
+        items = sorted((key.lower(), val) for key, vals in args.lists()
+                       for val in vals)
+        digest = hashlib.sha1(repr((version, rest_request, items,
+                                    accept)).encode())
+        return digest.hexdigest()
+
+    def _compress_response(self, response):
+        """
+        Compress the response body with the best content coding the client
+        accepts (Accept-Encoding).  Streamed responses are compressed chunk
+        by chunk (each chunk is flushed, so the client receives the rows
+        as they are produced); other responses only if they are at least
+        compress_min_size bytes.  The response ETag is suffixed with the
+        coding, since the body differs.
+
+        :param response: flask Response object
+        :return: the (possibly modified) response
+        """
+        if not self.compress or response.status_code != 200 \
+           or 'Content-Encoding' in response.headers \
+           or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(
+            [name for name, _ in COMPRESSORS])
+        if encoding is None:
+            return response
+        compressor = dict(COMPRESSORS)[encoding](self.compress_level)
+
+        if response.is_streamed:
+            chunks = response.response
+
+            def generate():
+                try:
+                    for chunk in chunks:
+                        if isinstance(chunk, str):
+                            chunk = chunk.encode('utf-8')
+                        yield compressor.compress(chunk) + compressor.flush()
+                    yield compressor.finish()
+                finally:
+                    if hasattr(chunks, 'close'):
+                        chunks.close()
+            response.response = generate()
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.compress_min_size:
+                return response
+            with timed('compress'):
+                response.set_data(compressor.compress(data) + compressor.finish())
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag('{}-{}'.format(etag, encoding), weak)
+        return response
+
+    @staticmethod
+    def stream_requested(filters):
+        """
+        Determine whether streaming was requested: 'stream=true' (or 'yes',
+        'json', 'ndjson'; 'stream=ndjson' also selects the NDJSON format).
+
+        :param filters: MultiDict of (lower case) request filters
+        :return: True if streaming requested
+        """
+        return filters.get('stream', '').lower() in ('true', 'yes', 'json', 'ndjson')
+
+    @staticmethod
+    def output_format(filters):
+        """
+        Determine the response format: the 'format' filter if given, else
+        the best match for the request 'Accept' header, else JSON.
+
+        :param filters: MultiDict of (lower case) request filters
+        :return: 2-tuple: (format name, error message or None)
+        """
+        fmt = filters.get('format', '').lower()
+        if fmt:
+            if fmt not in SERIALIZERS:
+                return (None, "Unsupported format {} (one of: {})".format(
+                    fmt, ', '.join(sorted(SERIALIZERS))))
+            return (fmt, None)
+        if filters.get('stream', '').lower() == 'ndjson':
+            return ('ndjson', None)
+        # JSON first: it is the default for '*/*'
+        names = ['json'] + sorted(name for name in SERIALIZERS if name != 'json')
+        mimetype = request.accept_mimetypes.best_match(
+            [SERIALIZERS[name].mimetype for name in names])
+        for name in names:
+            if SERIALIZERS[name].mimetype == mimetype:
+                return (name, None)
+        return ('json', None)
+
+    @staticmethod
+    def _serialize_rows(serializer, rows):
+        """
+        Serialize rows as they are produced, gathered into chunks of roughly
+        STREAM_CHUNK_SIZE bytes.
+
+        :param serializer: Serializer object
+        :param rows: iterable of rows
+        :return: generator of bytes chunks
+        """
+        chunk = []
+        size = 0
+        count = 0
+        for row in rows:
+            if not count:
+                chunk.append(serializer.head(row))
+            item = serializer.item(row, count)
+            count += 1
+            chunk.append(item)
+            size += len(item)
+            if size >= STREAM_CHUNK_SIZE:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        if not count:
+            chunk.append(serializer.head(None))
+        chunk.append(serializer.tail(count))
+        yield b''.join(chunk)
+
+    def respond(self, result, fmt='json', columns=None):
+        """
+        Build the response for a handler result in the requested format.
+        A generator result (row iterator) is streamed (chunked) as rows are
+        produced, so the full result set is never held in memory (under the
+        format's stream media type, if it has one).  For
+        record formats (NDJSON, CSV) a page result is written as its items,
+        with the next page cursor in the 'X-Next-Cursor' header; results
+        which are not rows (e.g. messages) are returned as JSON.
+
+        :param result: rows (list or iterator), page dict, or other result
+        :param fmt: format name (see serializers.SERIALIZERS)
+        :param columns: result columns, in order (for CSV)
+        :return: flask Response object
+        """
+        serializer = SERIALIZERS[fmt](columns)
+        headers = {}
+        with timed('serialize'):
+            if isinstance(result, types.GeneratorType):
+                response = Response(self._serialize_rows(serializer, result),
+                                    mimetype=serializer.stream_mimetype
+                                    or serializer.mimetype)
+            elif fmt == 'json':
+                response = jsonify(result)
+            elif not serializer.records:
+                response = Response(serializer.document(result),
+                                    mimetype=serializer.mimetype)
+            else:
+                rows = result
+                if isinstance(result, dict) and 'items' in result:
+                    rows = result['items']
+                    if result.get('next'):
+                        headers['X-Next-Cursor'] = result['next']
+                if not (isinstance(rows, list)
+                        and all(isinstance(row, (dict, Record)) for row in rows)):
+                    response = jsonify(result)
+                else:
+                    response = Response(b''.join(self._serialize_rows(serializer, rows)),
+                                        mimetype=serializer.mimetype, headers=headers)
+        response.vary.add('Accept')
+        return response
+
     @staticmethod
     def _unknown_request(*args, **kwargs):
         """
@@ -191,6 +544,178 @@ class RESTObject(object):
                 b. the cf_agent catchall will parse org/space/etc
                    from the URL, and __IT__ will dispatch to the handler
         """
+        start = time.monotonic()
+        if request.args.get('profile', 'False').lower() in ['true', 'yes']:
+            response = self._profile(rest_request)
+        else:
+            start_timing()
+            try:
+                response = self._dispatch(rest_request)
+            finally:
+                phases = stop_timing()
+            if self.server_timing:
+                phases['total'] = time.monotonic() - start
+                response.headers['Server-Timing'] = ', '.join(
+                    '{};dur={:.3f}'.format(phase, 1000 * secs)
+                    for phase, secs in phases.items())
+        endpoint = rest_request if rest_request in self._commands else 'unknown'
+        return self._record_request(endpoint, start, response)
+
+    def _profile(self, rest_request):
+        """
+        Run the request under cProfile (including sending any streamed
+        response) and return the top functions by cumulative time, as text.
+        The request must carry the admin token in the 'X-Admin-Token' header.
+        """
+        token = request.headers.get('X-Admin-Token', '')
+        if not self.profile_token \
+           or not hmac.compare_digest(token.encode(), self.profile_token.encode()):
+            LOGGER.warning("Unauthorized profile request for %s", rest_request)
+            response = jsonify('Profiling not permitted')
+            response.status_code = 403
+            return response
+
+        LOGGER.info("Profiling request for %s", rest_request)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            response = self._dispatch(rest_request)
+            size = len(response.get_data())
+        finally:
+            profiler.disable()
+        output = io.StringIO()
+        output.write('{} {}: status {}, {} bytes\n\n'.format(
+            rest_request, request.query_string.decode(), response.status_code, size))
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative') \
+            .print_stats(PROFILE_TOP_FUNCTIONS)
+        return Response(output.getvalue(), mimetype='text/plain')
+
+    @staticmethod
+    def _record_request(endpoint, start, response):
+        """
+        Record the request metrics: count, latency and response size.  For
+        streamed responses they are recorded once the response is sent.
+
+        :param endpoint: endpoint (metric label)
+        :param start: request start time (time.monotonic())
+        :param response: flask Response object
+        :return: the response
+        """
+        def record(size):
+            REQUESTS.inc((endpoint, str(response.status_code)))
+            REQUEST_SECONDS.observe(time.monotonic() - start, (endpoint,))
+            RESPONSE_BYTES.inc((endpoint,), size)
+
+        if not response.is_streamed:
+            record(response.content_length or 0)
+            return response
+
+        chunks = response.response
+
+        def generate():
+            size = 0
+            try:
+                for chunk in chunks:
+                    size += len(chunk)
+                    yield chunk
+            finally:
+                record(size)
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+        response.response = generate()
+        return response
+
+    def _dispatch(self, rest_request):
+        """
+        Call the handler registered for the endpoint, answering conditional
+        requests and compressing the response.
+        """
         _, epoint_entry = self._commands.get(rest_request,
                                              ('', self._unknown_request))
-        return epoint_entry(rest_request, request.args)
+
+        # Answer a conditional request for unchanged data without running
+        # the handler at all
+        etag = None
+        version = None
+        if rest_request in self._commands:
+            version = self._data_version(rest_request)
+        if version is not None:
+            etag = self.make_etag(version, rest_request, request.args,
+                                  request.headers.get('Accept', ''))
+            # (compressed responses carry the ETag suffixed with the coding:
+            # a suffixed tag only matches if that coding is still accepted)
+            codings = [name for name, _ in COMPRESSORS
+                       if self.compress and request.accept_encodings[name] > 0]
+            for tag in [etag] + ['{}-{}'.format(etag, name) for name in codings]:
+                if request.if_none_match.contains_weak(tag):
+                    LOGGER.debug("RESTObject %s not modified", rest_request)
+                    response = Response(status=304)
+                    response.set_etag(tag)
+                    return response
+
+        response = epoint_entry(rest_request, request.args)
+        if etag is not None and response.status_code == 200:
+            response.set_etag(etag)
+        return self._compress_response(response)
+
+
+def serve_production(app_factory, host, port, workers=1, threads=1,
+                     max_requests=0, max_requests_jitter=0, timeout=30,
+                     graceful_timeout=30):
+    """
+    Serve a WSGI app with the gunicorn pre-fork server: a master process
+    supervises 'workers' worker processes, each serving requests on
+    'threads' threads.  The app is created by 'app_factory' in each worker
+    after the fork, so no connections or threads are shared between workers.
+    Workers are recycled (restarted) after max_requests (+ random jitter)
+    requests, and on SIGTERM are given graceful_timeout seconds to finish
+    in-flight requests.
+
+    :param app_factory: callable returning a RESTObject
+    :param host: address to bind to
+    :param port: port to bind to
+    :param workers: number of worker processes
+    :param threads: number of request threads per worker
+    :param max_requests: requests served before a worker is recycled (0: never)
+    :param max_requests_jitter: random extra requests before recycling
+    :param timeout: seconds a silent worker is allowed before it is restarted
+    :param graceful_timeout: seconds allowed for in-flight requests on shutdown
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class _Server(BaseApplication):                  # pylint: disable=abstract-method
+        """
+        Gunicorn application creating the app (with app_factory) in each
+        worker and shutting it down when the worker exits.
+        """
+        restobj = None
+
+        def load_config(self):
+            options = {'bind': '{}:{}'.format(host, port),
+                       'workers': workers,
+                       'threads': threads,
+                       'worker_class': 'gthread' if threads > 1 else 'sync',
+                       'max_requests': max_requests,
+                       'max_requests_jitter': max_requests_jitter,
+                       'timeout': timeout,
+                       'graceful_timeout': graceful_timeout,
+                       'preload_app': False,
+                       'worker_exit': self.worker_exit,
+                      }
+            for key, val in options.items():
+                self.cfg.set(key, val)
+
+        def load(self):
+            self.restobj = app_factory()
+            return self.restobj.wsgi_app
+
+        def worker_exit(self, server, worker):    # pylint: disable=unused-argument
+            """
+            Gunicorn worker_exit hook (runs in the exiting worker).
+            """
+            if self.restobj is not None:
+                self.restobj.shutdown()
+
+    LOGGER.info("Starting production server on %s:%s (%s workers x %s threads)",
+                host, port, workers, threads)
+    _Server().run()
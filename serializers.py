@@ -0,0 +1,266 @@
+"""
+T-Mobile PCF team REST response serializers.
+
+Each serializer turns result rows (dicts) into one output format, one row
+at a time, so that streamed results can be written out as they are
+produced.  Serializers are registered by format name in SERIALIZERS; to add
+a format define a Serializer subclass and add it there.
+
+'Document' formats (JSON, MessagePack) can represent any result.  'Record'
+formats (NDJSON, CSV) only represent rows: for a page result only the page
+items are written (the caller passes the 'next' cursor on separately).
+
+Rows may also be records (see records.py).  Streamed rows which are records
+are written field by field, with no intermediate dict: JSON with the field
+names encoded once per record type, MessagePack as a map of the field
+pairs.
+
+A format may stream rows under a media type of its own (stream_mimetype):
+streamed MessagePack rows are a sequence of packed rows, not one array, as
+an array header must hold the row count before the rows are written.  Records nested in a document are written as dicts (see
+JSONProvider, for the Flask JSON responses).
+
+Note(s):
+    1. Requires Python 3
+    2. The MessagePack format is only available if the 'msgpack' package
+       is installed
+"""
+import csv
+import functools
+import io
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app, has_app_context, json as flask_json
+from flask.json.provider import DefaultJSONProvider
+
+from records import Record
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider also writing records (as dicts).
+    """
+    @staticmethod
+    def default(o):                  # pylint: disable=method-hidden
+        if isinstance(o, Record):
+            return o._asdict()       # pylint: disable=protected-access
+        return DefaultJSONProvider.default(o)
+
+
+@functools.lru_cache(maxsize=256)
+def _record_json_keys(rtype, sort_keys):
+    """
+    The JSON encoded field names of a record type, in field order or name
+    order: list of (encoded name, field position).
+    """
+    keys = [(name, pos) for pos, name in enumerate(rtype._fields)]   # pylint: disable=protected-access
+    return [(encode_basestring_ascii(name) + ':', pos)
+            for name, pos in (sorted(keys) if sort_keys else keys)]
+
+
+class Serializer(object):
+    """
+    Base serializer: writes a head, each row, and a tail.
+    """
+    name = None
+    mimetype = None
+    stream_mimetype = None
+    records = False
+
+    def __init__(self, columns=None):
+        """
+        :param columns: result columns, in order (used by tabular formats)
+        """
+        self._columns = columns
+        super().__init__()
+
+    def head(self, first_row):   # pylint: disable=unused-argument
+        """
+        Output preceding the rows.
+
+        :param first_row: the first row (None if there are no rows)
+        :return: bytes
+        """
+        return b''
+
+    def item(self, row, index):
+        """
+        Output for one row.
+
+        :param row: row dict
+        :param index: row number (from 0)
+        :return: bytes
+        """
+        raise NotImplementedError
+
+    def tail(self, count):       # pylint: disable=unused-argument
+        """
+        Output following the rows.
+
+        :param count: number of rows written
+        :return: bytes
+        """
+        return b''
+
+    def document(self, result):
+        """
+        Output for a whole (non-row) result, for document formats.
+
+        :param result: any serializable result
+        :return: bytes
+        """
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    """
+    JSON: rows are written as a JSON array.
+    """
+    name = 'json'
+    mimetype = 'application/json'
+
+    @staticmethod
+    def _dumps(obj):
+        return flask_json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def _value(cls, value):
+        if value is None:
+            return 'null'
+        if value.__class__ is str:
+            return encode_basestring_ascii(value)
+        if value.__class__ is int:
+            return int.__repr__(value)
+        return cls._dumps(value).decode('utf-8')
+
+    @classmethod
+    def _record(cls, record):
+        # (the keys are ordered as flask_json.dumps orders a dict's)
+        sort_keys = has_app_context() and current_app.json.sort_keys
+        values = record._values()    # pylint: disable=protected-access
+        return ('{' + ','.join([key + cls._value(values[pos]) for key, pos
+                                in _record_json_keys(type(record), sort_keys)])
+                + '}').encode('utf-8')
+
+    def head(self, first_row):
+        return b'['
+
+    def item(self, row, index):
+        if isinstance(row, Record):
+            return (b',' if index else b'') + self._record(row)
+        return (b',' if index else b'') + self._dumps(row)
+
+    def tail(self, count):
+        return b']'
+
+    def document(self, result):
+        return self._dumps(result)
+
+
+class NDJSONSerializer(JSONSerializer):
+    """
+    Newline delimited JSON: one row per line.
+    """
+    name = 'ndjson'
+    mimetype = 'application/x-ndjson'
+    records = True
+
+    def head(self, first_row):
+        return b''
+
+    def item(self, row, index):
+        if isinstance(row, Record):
+            return self._record(row) + b'\n'
+        return self._dumps(row) + b'\n'
+
+    def tail(self, count):
+        return b''
+
+
+class CSVSerializer(Serializer):
+    """
+    CSV with a header line.  The columns are those given (the result
+    columns, see the agent 'columns'), so that they do not depend on the
+    rows: a row missing one has an empty cell.  Without columns given they
+    are those of the first row, in name order.  Nested values (lists,
+    dicts) are written as JSON.
+    """
+    name = 'csv'
+    mimetype = 'text/csv'
+    records = True
+
+    def __init__(self, columns=None):
+        super().__init__(columns)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._fields = None
+
+    def _line(self, values):
+        self._writer.writerow(values)
+        line = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return line.encode('utf-8')
+
+    @staticmethod
+    def _cell(value):
+        if value is None:
+            return ''
+        if isinstance(value, (dict, list, tuple)):
+            return json.dumps(value, sort_keys=True)
+        return value
+
+    def head(self, first_row):
+        if self._columns is not None:
+            self._fields = list(self._columns)
+        else:
+            self._fields = sorted(first_row or ())
+        return self._line(self._fields)
+
+    def item(self, row, index):
+        return self._line([self._cell(row.get(col)) for col in self._fields])
+
+
+class MsgPackSerializer(Serializer):
+    """
+    MessagePack: a result is packed as a whole (like JSON).  Streamed rows
+    are packed and written one by one, as a sequence of maps (with no array
+    header, which would need the row count up front): see stream_mimetype.
+    """
+    name = 'msgpack'
+    mimetype = 'application/x-msgpack'
+    stream_mimetype = 'application/x-msgpack-stream'
+
+    def __init__(self, columns=None):
+        super().__init__(columns)
+        self._packer = msgpack.Packer(use_bin_type=True, default=self._default)
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, Record):
+            return obj._asdict()     # pylint: disable=protected-access
+        return str(obj)
+
+    @classmethod
+    def _packb(cls, obj):
+        return msgpack.packb(obj, use_bin_type=True, default=cls._default)
+
+    def item(self, row, index):
+        if isinstance(row, Record):
+            return self._packer.pack_map_pairs(
+                list(zip(row._fields, row._values())))  # pylint: disable=protected-access
+        return self._packb(row)
+
+    def document(self, result):
+        return self._packb(result)
+
+
+SERIALIZERS = {serializer.name: serializer for serializer in
+               [JSONSerializer, NDJSONSerializer, CSVSerializer]
+               + ([MsgPackSerializer] if msgpack is not None else [])}
@@ -4,25 +4,303 @@ T-Mobile PCF team cf-stats DB objects
 Note(s):
     1. Requires Python 3
 """
+import collections
+import contextlib
+import hashlib
 import json
 import mysql.connector
 import os
+import re
+import threading
 import time
+import weakref
 
 import excepts as exc
-from logger import LOGGER
+from logger import SampledLogger, module_logger
+from metrics import METRICS, add_timing
+from parameters import PARAMS
+from records import RowDecoder
+from tables import ALL_TABLES
+
+LOGGER = module_logger(__name__)
+# (for the per row messages)
+SAMPLED_LOGGER = SampledLogger(LOGGER)
+
+# Errors indicating the connection itself is unusable (vs. a bad query)
+CONNECTION_ERRORS = (mysql.connector.errors.InterfaceError,
+                     mysql.connector.errors.OperationalError)
+
+# 'in' list placeholder counts are rounded up to one of these sizes (or a
+# multiple of the largest) so that similar requests share a statement
+IN_LIST_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+QUERY_SECONDS = METRICS.histogram('cfstats_db_query_seconds',
+                                  'StatsDB query latency by query shape',
+                                  ['shape'])
+QUERY_ROWS = METRICS.counter('cfstats_db_query_rows_total',
+                             'StatsDB rows returned by query shape', ['shape'])
+_QUERY_SHAPES = {}
+_QUERY_SAMPLES = {}
+MAX_QUERY_SHAPES = 1024
+
+# EXPLAIN access types which read a whole table or index
+FULL_SCAN_TYPES = {'ALL': 'table scan', 'index': 'index scan'}
+
+
+def query_shape(sql, params=None):
+    """
+    Metrics label for a query: the (first) table queried and a short hash
+    of the SQL.  Queries are parameterized, so the SQL identifies the
+    query shape.  New shapes are logged (debug) with their SQL, and the
+    first parameters a SELECT shape is run with are kept as a sample (see
+    StatsDB.full_scans).
+
+    :param sql: the SQL query string
+    :param params: the query parameters
+    :return: shape label, e.g. 'applications:1f2e3d4c'
+    """
+    shape = _QUERY_SHAPES.get(sql)
+    if shape is None:
+        match = re.search(r'\bFROM\s+(\w+)', sql, re.IGNORECASE)
+        shape = '{}:{}'.format(match.group(1) if match else 'none',
+                               hashlib.sha1(sql.encode()).hexdigest()[:8])
+        if len(_QUERY_SHAPES) < MAX_QUERY_SHAPES:
+            _QUERY_SHAPES[sql] = shape
+            if sql.lstrip().upper().startswith('SELECT'):
+                _QUERY_SAMPLES[shape] = (sql, list(params or []))
+        LOGGER.debug("Query shape %s: %s", shape, sql)
+    return shape
+
+
+class ConnectionPool(object):
+    """
+    A bounded, thread-safe pool of MySQL connections.
+
+    'min_size' connections are opened up front (by 'fill'), more are opened
+    on demand up to 'max_size'.  Connections are handed back to the pool after use
+    rather than closed.  A connection which has sat idle longer than
+    'ping_interval' seconds is pinged (and reconnected if stale) before
+    it is handed out.
+    """
+    def __init__(self, min_size=1, max_size=10, timeout=5, ping_interval=30,
+                 autocommit=False, connect=None, **conn_args):
+        """
+        Initialize the pool.  No connection is opened until 'fill' is
+        called or a connection is checked out.
+
+        :param min_size: number of connections to open up front
+        :param max_size: maximum number of connections (in use plus idle)
+        :param timeout: seconds to wait for a connection before giving up
+        :param ping_interval: idle seconds after which a connection is pinged
+        :param autocommit: connection autocommit setting
+        :param connect: connection factory (default mysql.connector.connect)
+        :param conn_args: mysql.connector.connect() arguments
+        """
+        self._connect = connect or mysql.connector.connect
+        self._conn_args = conn_args
+        self._autocommit = autocommit
+        self._min_size = max(0, min_size)
+        self._max_size = max(1, max_size, self._min_size)
+        self._timeout = timeout
+        self._ping_interval = ping_interval
+        self._cond = threading.Condition()
+        self._idle = collections.deque()    # (connection, time last used)
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = {'checkouts': 0,
+                       'waits': 0,
+                       'timeouts': 0,
+                       'reconnects': 0,
+                       'connects': 0,
+                      }
+        self._checkout_secs_total = 0.0
+        self._checkout_secs_max = 0.0
+
+        LOGGER.debug("Create connection pool (min %d, max %d)",
+                     self._min_size, self._max_size)
+        super().__init__()
+
+    def fill(self):
+        """
+        Open connections until the pool holds the minimum number.
+        """
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self._min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._new_connection()
+            except:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _new_connection(self):
+        """
+        Open a new connection to the database server.
+        """
+        LOGGER.debug("Make DB connection")
+        try:
+            conn = self._connect(**self._conn_args)
+            conn.autocommit = self._autocommit
+        except:
+            msg = "Failed to create MySQL connection"
+            LOGGER.error(msg)
+            LOGGER.debug("%s (user: %s, host: %s, db: %s)", msg,
+                         self._conn_args.get('user'),
+                         self._conn_args.get('host'),
+                         self._conn_args.get('database'))
+            raise
+        with self._cond:
+            self._stats['connects'] += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        """
+        Close a connection, ignoring errors (it may already be dead).
+        """
+        try:
+            conn.close()
+        except Exception:                   # pylint: disable=broad-except
+            pass
+
+    def _revive(self, conn):
+        """
+        Ping an idle connection, replacing it if it has gone stale.
+
+        :param conn: the connection to check
+        :return: a live connection (the original or a replacement)
+        """
+        try:
+            conn.ping(reconnect=False)
+        except CONNECTION_ERRORS:
+            LOGGER.info("Stale pooled DB connection, reconnecting")
+            self._close_quietly(conn)
+            conn = self._new_connection()
+            with self._cond:
+                self._stats['reconnects'] += 1
+        return conn
+
+    def checkout(self):
+        """
+        Take a connection from the pool, opening one if the pool is not
+        at capacity, or waiting up to 'timeout' seconds for one to be
+        returned.
+
+        :return: a live database connection
+        """
+        start = time.monotonic()
+        deadline = start + self._timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise exc.SQLPoolExhausted("Connection pool is closed")
+                if self._idle:
+                    # LIFO: the most recently used connection is the warmest
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self._max_size:
+                    conn, last_used = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    LOGGER.error("No DB connection available after %ss",
+                                 self._timeout)
+                    raise exc.SQLPoolExhausted(
+                        "No connection available after {}s".format(self._timeout))
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        try:
+            if conn is None:
+                conn = self._new_connection()
+            elif time.monotonic() - last_used > self._ping_interval:
+                conn = self._revive(conn)
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self._stats['checkouts'] += 1
+            self._stats['waits'] += int(waited)
+            self._checkout_secs_total += elapsed
+            self._checkout_secs_max = max(self._checkout_secs_max, elapsed)
+        return conn
+
+    def checkin(self, conn, discard=False):
+        """
+        Return a connection to the pool.  Any open transaction is rolled back
+        so that the next user does not inherit a stale read snapshot.
+
+        :param conn: the connection being returned
+        :param discard: close the connection rather than pool it
+        """
+        if not discard:
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except CONNECTION_ERRORS:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        """
+        Close all idle connections and refuse further checkouts.  Connections
+        in use are closed as they are returned.
+        """
+        LOGGER.debug("Close connection pool")
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close_quietly(conn)
+            self._cond.notify_all()
+
+    @property
+    def stats(self):
+        """
+        Pool usage statistics.
+        """
+        with self._cond:
+            checkouts = self._stats['checkouts']
+            rtn = dict(self._stats,
+                       min_size=self._min_size,
+                       max_size=self._max_size,
+                       size=self._size,
+                       idle=len(self._idle),
+                       in_use=self._in_use,
+                       avg_checkout_ms=round(1000 * self._checkout_secs_total
+                                             / checkouts, 3) if checkouts else 0,
+                       max_checkout_ms=round(1000 * self._checkout_secs_max, 3))
+        return rtn
 
 
 class StatsDB(object):
     """
     Generic PCF database object.
     """
-    # table index tuple: index name, table name, column name
-    _table_indices = [('ag', 'service_bindings', 'appGUID'),
-                      ('sig', 'service_bindings', 'serviceInstanceGUID'),
-                      ('dag', 'route_mappings', 'appGUID'),
-                      ('drg', 'route_mappings', 'routeGUID')
-                     ]
     def __init__(self, **kwargs):
         """
         """
@@ -64,21 +342,48 @@ class StatsDB(object):
         self._database = msql_creds['database']
         self._autocommit = msql_creds.get('autocommit', False)
         self._buffered = msql_creds.get('buffered', True)
-        self._conn = None
+        self._local = threading.local()
+        self._prepared = str(kwargs.get('prepared', PARAMS['DB_PREPARED_STATEMENTS'])
+                            ).lower() in ['true', 'yes']
+        self._stmt_cache_size = int(kwargs.get('statement_cache_size',
+                                               PARAMS['DB_STATEMENT_CACHE_SIZE']))
+        self._stmt_caches = weakref.WeakKeyDictionary()
+        self._stmt_lock = threading.Lock()
+        self._stmt_stats = {'prepares': 0, 'hits': 0, 'evictions': 0}
+        self._fetch_batch_size = int(kwargs.get('fetch_batch_size',
+                                                PARAMS['DB_FETCH_BATCH_SIZE']))
 
         super().__init__()
 
-        self._connect()
-        self._make_table_indices(self._table_indices)
+        self._pool = ConnectionPool(
+            min_size=int(kwargs.get('pool_min_size', PARAMS['DB_POOL_MIN_SIZE'])),
+            max_size=int(kwargs.get('pool_max_size', PARAMS['DB_POOL_MAX_SIZE'])),
+            timeout=float(kwargs.get('pool_timeout', PARAMS['DB_POOL_TIMEOUT'])),
+            ping_interval=float(kwargs.get('pool_ping_interval',
+                                           PARAMS['DB_POOL_PING_INTERVAL'])),
+            autocommit=self._autocommit,
+            connect=kwargs.get('connect'),
+            user=self._user,
+            password=self._password,
+            host=self._host,
+            database=self._database)
+
+    def warm_up(self):
+        """
+        Open the pool's minimum connections and create any missing table
+        indexes.  Not done on construction, so that the application can
+        start serving (and report that it is warming up) right away.
+
+        :raise: the connection error if the database cannot be reached
+        """
+        self._pool.fill()
+        self.ensure_indexes(ALL_TABLES)
 
     def end(self):
         """
-        Terminate the DB connection
+        Terminate the DB connection(s)
         """
-        self._cursor.close()
-        if self._conn:
-            self._conn.close()
-            self._conn = None
+        self._pool.close()
 
     def __enter__(self):
         """
@@ -94,53 +399,290 @@ class StatsDB(object):
         LOGGER.debug("DB object context exit")
         self.end()
 
-    def _make_table_indices(self, index_list):
+    def existing_indexes(self, tables):
         """
-        Create table indices.
+        Get the indexes on the given tables (from information_schema).
 
-        :param index_list: list of index tuples (index_name, table_name, column)
+        :param tables: list of table objects (from tables.py)
+        :return: dict of table name to dict of index name to list of
+                 columns (in index order)
         """
-        LOGGER.debug('Creating %d table indices', len(index_list))
-        index_sql = 'CREATE OR REPLACE INDEX {} ON {}({})'
-        for (index_name, table_name, column) in index_list:
-            sql = index_sql.format(index_name, table_name, column)
-            LOGGER.debug('Index: %s', sql)
-            self.query(sql)
+        placeholders, names = self.in_list([table.name for table in tables])
+        sql = ("SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME"
+               " FROM information_schema.STATISTICS"
+               " WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ({})"
+               " ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX".format(placeholders))
+        indexes = collections.defaultdict(lambda: collections.defaultdict(list))
+        for table_name, index_name, column in self.query(sql, [self._database] + names):
+            indexes[table_name][index_name].append(column)
+        return indexes
 
-    def _connect(self):
+    def ensure_indexes(self, tables):
         """
-        Create the connection to the database server
+        Create the indexes declared by the tables (see tables.py) which do
+        not exist yet.  A declared index exists if any index on the table,
+        whatever its name, starts with the declared columns (e.g. a primary
+        key on guid covers an index on guid).  Failures are logged, not
+        raised: the queries work without the indexes, only slower.
 
+        :param tables: list of table objects (from tables.py)
+        :return: list of (table name, index name) created
         """
-        LOGGER.debug("Make DB connection")
-        if self._conn:
-            self._conn.close()
         try:
-            self._conn = mysql.connector.connect(user=self._user,
-                                                 password=self._password,
-                                                 host=self._host,
-                                                 database=self._database)
-            self._cursor = self._conn.cursor(buffered=self._buffered)
-            self._conn.autocommit = self._autocommit
-        except:
-            msg = "Failed to create MySQL connection"
-            LOGGER.error(msg)
-            LOGGER.debug("%s (user: %s, pwd: %s, host: %s, db: %s)",
-                         msg, self._user, self._password, self._host,
-                         self._database)
-            self._conn = None
+            existing = self.existing_indexes(tables)
+        except Exception as exn:            # pylint: disable=broad-except
+            LOGGER.warning("Unable to read the table indexes: %s", exn)
+            return []
+
+        created = []
+        for table in tables:
+            present = [[col.lower() for col in columns]
+                       for columns in existing.get(table.name, {}).values()]
+            for index_name, columns in getattr(table, 'indexes', ()):
+                wanted = [col.lower() for col in columns]
+                if any(cols[:len(wanted)] == wanted for cols in present):
+                    continue
+                sql = 'CREATE INDEX {} ON {}({})'.format(index_name, table.name,
+                                                         ', '.join(columns))
+                LOGGER.info("Creating index: %s", sql)
+                try:
+                    self.query(sql)
+                except Exception as exn:    # pylint: disable=broad-except
+                    LOGGER.warning("Unable to create index %s on %s: %s",
+                                   index_name, table.name, exn)
+                    continue
+                present.append(wanted)
+                created.append((table.name, index_name))
+        LOGGER.debug("Table indexes checked, %d created", len(created))
+        return created
+
+    def explain(self, sql, params=None):
+        """
+        Get the query plan of a query (EXPLAIN).
+
+        :param sql: the SQL query string ('%s' placeholders if parameterized)
+        :param params: list of query parameters
+        :return: list of plan rows (dicts of EXPLAIN column to value)
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor(buffered=True)
+            try:
+                cursor.execute('EXPLAIN ' + sql, tuple(params or ()))
+                columns = [desc[0] for desc in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+
+    def full_scans(self):
+        """
+        EXPLAIN each SELECT query shape run so far (with its sample
+        parameters, see query_shape) and report the shapes whose plans
+        read a whole table or index.  Scans of small tables, or of the
+        table every row of which is returned, are expected; a scan of a
+        table which is only joined or filtered on points to a missing index.
+
+        :return: list of dicts: shape, sql and scans (table, type, rows
+                 estimate), most rows scanned first
+        """
+        report = []
+        for shape, (sql, params) in sorted(_QUERY_SAMPLES.copy().items()):
+            if shape.startswith('information_schema:'):
+                continue
+            try:
+                plan = self.explain(sql, params)
+            except Exception as exn:        # pylint: disable=broad-except
+                LOGGER.warning("Unable to EXPLAIN %s: %s", shape, exn)
+                continue
+            scans = [{'table': row.get('table'),
+                      'type': FULL_SCAN_TYPES[row.get('type')],
+                      'rows': row.get('rows')}
+                     for row in plan if row.get('type') in FULL_SCAN_TYPES]
+            if scans:
+                report.append({'shape': shape, 'sql': sql, 'scans': scans})
+        report.sort(key=lambda item: -sum(scan['rows'] or 0 for scan in item['scans']))
+        return report
+
+    def data_version(self, tables):
+        """
+        Get a fingerprint of the current contents of the given tables: their
+        live checksums (CHECKSUM TABLE), which change with any row written.
+        The table statistics (information_schema.TABLES update time and row
+        count) are not used: MySQL 8 caches them, the update time has a one
+        second resolution and the InnoDB row count is an estimate.  For
+        InnoDB tables the checksum reads the whole table, so callers cache
+        the version (see DATA_VERSION_TTL).  If any table has no checksum
+        None is returned.
+
+        :param tables: list of table objects (from tables.py)
+        :return: version string, or None if not available
+        """
+        sql = 'CHECKSUM TABLE {}'.format(', '.join(table.name for table in tables))
+        try:
+            rows = self.query(sql)
+        except Exception as exn:            # pylint: disable=broad-except
+            LOGGER.info("Unable to get table versions: %s", exn)
+            return None
+        if len(rows) != len(tables) or any(row[1] is None for row in rows):
+            return None
+        return ';'.join('{}:{}'.format(*row) for row in sorted(rows))
+
+    @property
+    def pool_stats(self):
+        """
+        Connection pool usage statistics.
+        """
+        return self._pool.stats
+
+    @property
+    def statement_stats(self):
+        """
+        Prepared statement cache statistics.
+        """
+        with self._stmt_lock:
+            rtn = dict(self._stmt_stats,
+                       enabled=self._prepared,
+                       cached=sum(len(c) for c in self._stmt_caches.values()))
+        return rtn
+
+    @staticmethod
+    def in_list(values):
+        """
+        Build the placeholder list for an SQL 'in' clause.  The number of
+        placeholders is rounded up to a size bucket (padding with the last
+        value, which does not change the match) so that lists of similar
+        length produce the same statement text and share a prepared
+        statement.
+
+        :param values: list of values (at least one)
+        :return: 2-tuple: (placeholder string, list of padded values)
+        """
+        count = len(values)
+        size = next((bkt for bkt in IN_LIST_BUCKETS if bkt >= count), None)
+        if size is None:
+            largest = IN_LIST_BUCKETS[-1]
+            size = -(-count // largest) * largest
+        values = list(values) + [values[-1]] * (size - count)
+        return (','.join(['%s'] * size), values)
+
+    def _cursor(self, conn, sql, params, buffered):
+        """
+        Get a cursor for running 'sql' on the connection.
+
+        Parameterized statements (params not None) use server-side prepared
+        statements.  Prepared cursors are cached per connection, keyed by the
+        statement text (the query 'shape'), so a repeated query skips the
+        server's parse and plan.  The least recently used statement is
+        closed when the cache is full.
+
+        The prepared cursor only reuses its statement when executed with the
+        very string object it was prepared with, so that string is returned
+        for the caller to execute.
+
+        :param conn: the (checked out) connection
+        :param sql: the SQL query string
+        :param params: statement parameters, or None for a plain statement
+        :param buffered: buffer the result set (plain statements only)
+        :return: 3-tuple: (cursor, SQL string to execute, true if cached)
+        """
+        if params is None or not self._prepared or not self._stmt_cache_size:
+            return (conn.cursor(buffered=buffered), sql, False)
+
+        with self._stmt_lock:
+            cache = self._stmt_caches.get(conn)
+            if cache is None:
+                cache = self._stmt_caches[conn] = collections.OrderedDict()
+            entry = cache.get(sql)
+            if entry is not None:
+                cache.move_to_end(sql)
+                self._stmt_stats['hits'] += 1
+                return entry + (True,)
+            self._stmt_stats['prepares'] += 1
+            evicted = None
+            if len(cache) >= self._stmt_cache_size:
+                _, (evicted, _) = cache.popitem(last=False)
+                self._stmt_stats['evictions'] += 1
+            entry = cache[sql] = (conn.cursor(prepared=True), sql)
+        if evicted is not None:
+            evicted.close()
+        return entry + (True,)
+
+    def _uncache(self, conn, sql):
+        """
+        Drop a (failed) statement from a connection's statement cache.
+        """
+        with self._stmt_lock:
+            cache = self._stmt_caches.get(conn)
+            entry = cache.pop(sql, None) if cache else None
+        if entry is not None:
+            try:
+                entry[0].close()
+            except Exception:               # pylint: disable=broad-except
+                pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check a connection out of the pool for the duration of the context.
+        Nested use within the same thread shares the outer connection, so a
+        caller may hold one connection across several queries.
+
+        :return: (context) a database connection
+        """
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+
+        conn = self._pool.checkout()
+        self._local.conn = conn
+        discard = False
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            discard = True
             raise
+        finally:
+            self._local.conn = None
+            self._pool.checkin(conn, discard=discard)
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Hold one connection for the duration of the context, in a read only
+        REPEATABLE READ transaction started WITH CONSISTENT SNAPSHOT: the
+        queries made in the context (by this thread) all see the data as of
+        its start.  Streamed queries (query_iter) use connections of their
+        own and are not part of the snapshot.  Nested use shares the outer
+        connection (and snapshot, if any).
+
+        :return: (context) the database connection
+        """
+        if getattr(self._local, 'conn', None) is not None:
+            with self.connection() as conn:
+                yield conn
+            return
+
+        with self.connection() as conn:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.start_transaction(consistent_snapshot=True,
+                                   isolation_level='REPEATABLE READ',
+                                   readonly=True)
+            # (the transaction is rolled back when the connection is returned)
+            yield conn
 
     @staticmethod
     def row_to_dict(row, column_list):
         """
-        Convert a query result row (tuple) into a dict.
+        Convert a query result row (tuple) into a dict.  (To convert every
+        row of a query use a RowDecoder, see records.py, resolving the
+        columns once.)
 
         :param row: cursor row
         :param column_list: column name mapping
         :return: dict
         """
-        LOGGER.debug("Convert query row to dict")
+        SAMPLED_LOGGER.debug("Convert query row to dict")
 
         if len(row) != len(column_list):
             LOGGER.warning("WARNING: query row %d items, %d expected",
@@ -148,30 +690,123 @@ class StatsDB(object):
             rtn = {}
         else:
             rtn = dict(zip(column_list, row))
-        LOGGER.debug("row_to_dict returning dict length %d", len(rtn))
+        SAMPLED_LOGGER.debug("row_to_dict returning dict length %d", len(rtn))
         return rtn
 
-    def query(self, sql):
+    def _execute(self, conn, sql, params, buffered):
         """
-        Set the cursor and run the query.
+        Execute a statement, returning the cursor holding its result.
 
-        If the connection is closed (timed out) then reconnect and try again.
-
-        :param sql: the SQL query string
-        :return: cursor object resulting from query
+        :param conn: the (checked out) connection
+        :param sql: the SQL query string ('%s' placeholders)
+        :param params: statement parameters, or None for a plain statement
+        :param buffered: buffer the result set (plain statements only)
+        :return: 2-tuple: (cursor, true if the cursor is cached)
         """
-        LOGGER.debug("Run SQL query: %s", sql)
-        self._connect()
+        cursor, stmt, cached = self._cursor(conn, sql, params, buffered)
         try:
-            LOGGER.debug("Execute SQL")
-            self._cursor.execute(sql)
+            if params is None:
+                cursor.execute(stmt)
+            else:
+                cursor.execute(stmt, tuple(params))
         except:
-            LOGGER.warning("mySQL query failed: %s", sql)
+            if cached:
+                self._uncache(conn, sql)
+            else:
+                cursor.close()
             raise
-        self._conn.close()
-        return self._cursor
+        return (cursor, cached)
 
-    def query_dict(self, sql, column_list):
+    def query(self, sql, params=None):
+        """
+        Check out a pooled connection and run the query.
+
+        If the connection is closed (timed out) then reconnect and try again.
+
+        :param sql: the SQL query string ('%s' placeholders if parameterized)
+        :param params: list of query parameters; if given the query is run
+                       as a (cached) server-side prepared statement
+        :return: list of result rows (tuples)
+        """
+        LOGGER.debug("Run SQL query: %s %s", sql, params or '')
+        nested = getattr(self._local, 'conn', None) is not None
+        retries = 0 if nested else 1
+        start = time.monotonic()
+        while True:
+            try:
+                with self.connection() as conn:
+                    LOGGER.debug("Execute SQL")
+                    cursor, cached = self._execute(conn, sql, params,
+                                                   self._buffered)
+                    try:
+                        rows = cursor.fetchall() if cursor.with_rows else []
+                    finally:
+                        if not cached:
+                            cursor.close()
+                elapsed = time.monotonic() - start
+                add_timing('db', elapsed)
+                shape = query_shape(sql, params)
+                QUERY_SECONDS.observe(elapsed, (shape,))
+                QUERY_ROWS.inc((shape,), len(rows))
+                return rows
+            except CONNECTION_ERRORS:
+                if not retries:
+                    LOGGER.warning("mySQL query failed: %s", sql)
+                    raise
+                retries -= 1
+                LOGGER.info("DB connection lost, retrying query")
+            except:
+                LOGGER.warning("mySQL query failed: %s", sql)
+                raise
+
+    def query_iter(self, sql, params=None, batch_size=None):
+        """
+        Run the query on a dedicated pooled connection using an unbuffered
+        cursor and yield result rows, fetched 'batch_size' rows at a time.
+        Only one batch is held in memory at once.  The connection is
+        returned to the pool when the iterator is exhausted or closed.
+
+        :param sql: the SQL query string ('%s' placeholders if parameterized)
+        :param params: list of query parameters (see query)
+        :param batch_size: number of rows per fetch
+        :return: (generator) result rows (tuples)
+        """
+        LOGGER.debug("Run SQL query (streamed): %s %s", sql, params or '')
+        batch_size = batch_size or self._fetch_batch_size
+        start = time.monotonic()
+        count = 0
+        conn = self._pool.checkout()
+        # an abandoned unbuffered cursor leaves unread results on the
+        # connection, so it is only pooled again if fully consumed
+        discard = True
+        try:
+            try:
+                cursor, cached = self._execute(conn, sql, params, False)
+            except:
+                LOGGER.warning("mySQL query failed: %s", sql)
+                raise
+            add_timing('db', time.monotonic() - start)
+            if cursor.with_rows:
+                fetch_start = time.monotonic()
+                rows = cursor.fetchmany(batch_size)
+                add_timing('db', time.monotonic() - fetch_start)
+                while rows:
+                    count += len(rows)
+                    yield from rows
+                    fetch_start = time.monotonic()
+                    rows = cursor.fetchmany(batch_size)
+                    add_timing('db', time.monotonic() - fetch_start)
+            if not cached:
+                cursor.close()
+            discard = False
+            # (includes the time the consumer spent between batches)
+            shape = query_shape(sql, params)
+            QUERY_SECONDS.observe(time.monotonic() - start, (shape,))
+            QUERY_ROWS.inc((shape,), count)
+        finally:
+            self._pool.checkin(conn, discard=discard)
+
+    def query_dict(self, sql, column_list, params=None):
         """
         Execute an SQL query, then return a list of dicts where each list
         entry is a row returned from the query, converted to a dict.  In
@@ -179,25 +814,53 @@ class StatsDB(object):
 
         :param sql: the SQL query string
         :param column_list: list of columns used to map the row->dictionary
+        :param params: list of query parameters (see query)
         :return: list of dicts
         """
         LOGGER.debug("Run SQL query, return dict: %s", sql)
-        rtn = [self.row_to_dict(row, column_list) for row in self.query(sql)]
-        return rtn
+        return list(map(RowDecoder(column_list).decode, self.query(sql, params)))
+
+    def query_dict_iter(self, sql, column_list, params=None):
+        """
+        Streaming counterpart of query_dict: yield each row, converted to
+        a dict, as it is fetched.
+
+        :param sql: the SQL query string
+        :param column_list: list of columns used to map the row->dictionary
+        :param params: list of query parameters (see query)
+        :return: (generator) dicts
+        """
+        LOGGER.debug("Run SQL query, stream dicts: %s", sql)
+        yield from RowDecoder(column_list).decode_rows(self.query_iter(sql, params))
 
-    def select(self, table, fields=None, where=None, as_dict=True):
+    def select(self, table, fields=None, where=None, as_dict=True,
+               stream=False, after=None, limit=None, key='guid', params=None):
         """
         Wrap up a simple generic select.
 
+        Keyset pagination: if 'after' is given only rows whose 'key' column
+        sorts after it are returned; with 'after' or 'limit' the rows are
+        ordered by 'key'.  Given an index on 'key' any page costs the same
+        as the first.
+
         :param table: table object to query
         :param fields: list of fields to query for ("select X")
-        :param where: match conditions ("where ...")
-        :param as_dict: return dict if true else return cursor
+        :param where: match conditions ("where ...", '%s' placeholders)
+        :param params: list of parameters for the 'where' placeholders
+        :param as_dict: return dict if true else return rows
+        :param stream: return an iterator rather than a list
+        :param after: key value to start after
+        :param limit: maximum number of rows to return
+        :param key: (unique) column to order and paginate on
 
-        :return: dict or cursor result from query
+        :return: dict or row list result from query
         """
         fields = [fields] if (fields and isinstance(fields, str)) else fields
-        where = [where] if (where and isinstance(where, str)) else where
+        where = [where] if (where and isinstance(where, str)) else list(where or [])
+        params = list(params or [])
+        if after is not None:
+            where.append('{} > %s'.format(key))
+            params.append(after)
         columns = fields if (fields and fields != '*') else table.columns
 
         itemspec = '{}'.format(','.join(fields)) if fields else '*'
@@ -209,9 +872,17 @@ class StatsDB(object):
             LOGGER.debug("%s table query for match: <%s>",
                          table.name, where)
             sql += " WHERE {}".format(' AND '.join(where))
+        if after is not None or limit:
+            sql += " ORDER BY {}".format(key)
+        if limit:
+            sql += " LIMIT %s"
+            params.append(int(limit))
 
-        if as_dict:
-            retn = self.query_dict(sql, columns)
+        if stream:
+            retn = self.query_dict_iter(sql, columns, params) if as_dict \
+                   else self.query_iter(sql, params)
+        elif as_dict:
+            retn = self.query_dict(sql, columns, params)
         else:
-            retn = self.query(sql)
+            retn = self.query(sql, params)
         return retn
@@ -1,6 +1,15 @@
 """
 T-Mobile PCF team CloudFoundry 'cf-stats' agent database table schemas.
 
+Each table also declares the indexes the agent's queries need: a list of
+(index name, columns) tuples.  The indexes on the join columns also carry
+the columns read from the joined table, so that the join is answered from
+the index alone (a covering index).  Missing indexes are created at startup
+(see StatsDB.ensure_indexes).
+
+Tables with numeric columns list them in 'numeric_columns', so that the
+'where' filters (see predicates.py) compare them as numbers.
+
 Note(s):
 """
 
@@ -30,6 +39,11 @@ class CFApps(object):
                "stagingFailedReason",
                "state"
               ]
+    numeric_columns = ("diskQuota", "healthCheckTimeout", "instances", "memory")
+    indexes = [('ap_guid', ('guid',)),
+               ('ap_space', ('spaceGUID',)),
+               ('ap_name', ('name',)),
+              ]
 
 
 class CFServiceBindings(object):
@@ -42,6 +56,9 @@ class CFServiceBindings(object):
                "appGUID",
                "serviceInstanceGUID"
               ]
+    indexes = [('sb_app', ('appGUID', 'serviceInstanceGUID')),
+               ('sb_instance', ('serviceInstanceGUID', 'appGUID')),
+              ]
 
 
 class CFServices(object):
@@ -51,7 +68,7 @@ class CFServices(object):
     name = 'service_instances'
     columns = ["dashboardURL",
                "guid",  # guid of the service instance
-               "lastOperation"
+               "lastOperation",
                "name",
                "serviceDescription",
                "serviceGUID",   # guid of the service (type)
@@ -62,6 +79,10 @@ class CFServices(object):
                "tags",
                "type",
               ]
+    indexes = [('si_guid', ('guid', 'name')),
+               ('si_space', ('spaceGUID',)),
+               ('si_name', ('name',)),
+              ]
 
 
 class CFSpaces(object):
@@ -75,6 +96,10 @@ class CFSpaces(object):
                "allowSSH",
                "spaceQuotaDefinitionGUID"
               ]
+    indexes = [('sp_guid', ('guid', 'organizationGUID', 'name')),
+               ('sp_org', ('organizationGUID',)),
+               ('sp_name', ('name',)),
+              ]
 
 
 class CFOrganizations(object):
@@ -87,6 +112,9 @@ class CFOrganizations(object):
                "quotaDefinitionGUID",
                "defaultIsolationSegmentGUID"
               ]
+    indexes = [('og_guid', ('guid', 'name')),
+               ('og_name', ('name',)),
+              ]
 
 
 class CFRouteMapping(object):
@@ -98,6 +126,9 @@ class CFRouteMapping(object):
                "appGUID",
                "routeGUID"
               ]
+    indexes = [('rm_app', ('appGUID', 'routeGUID')),
+               ('rm_route', ('routeGUID', 'appGUID')),
+              ]
 
 
 class CFDomains(object):
@@ -111,6 +142,8 @@ class CFDomains(object):
                "routerGroupType",
                "type"
               ]
+    indexes = [('dm_guid', ('guid', 'name')),
+              ]
 
 
 class CFRoutes(object):
@@ -125,3 +158,11 @@ class CFRoutes(object):
                "domainGUID",
                "spaceGUID"
               ]
+    numeric_columns = ("port",)
+    indexes = [('rt_guid', ('guid', 'domainGUID', 'host')),
+               ('rt_domain', ('domainGUID',)),
+              ]
+
+
+ALL_TABLES = (CFApps, CFServiceBindings, CFServices, CFSpaces,
+              CFOrganizations, CFRouteMapping, CFRoutes, CFDomains)